@@ -0,0 +1,252 @@
+"""Admission control and load shedding in front of the database.
+
+When Postgres slows down, requests used to pile up on blocked queries
+until every gunicorn thread was stuck and the whole site timed out. Now
+every request that touches the database is put into a route class and
+must get one of the worker's ADMISSION_SLOTS before it runs:
+
+    login    the login and registration pages
+    write    every other POST (bookings, cancellations, cards, listings)
+    lookup   other GET pages (dashboards, my bookings, booking forms)
+    search   /search, capped at ADMISSION_SEARCH_SHARE of the slots
+
+When all slots are busy a request waits in a bounded queue, for at most
+ADMISSION_MAX_WAIT seconds. Queued requests are admitted in class order
+(login, write, lookup, search) and first come, first served within a
+class; when the queue is full, a new request pushes out the newest
+waiter of a lower class, or is turned away itself. A request that is not
+admitted gets a small static 503 page with a Retry-After header instead
+of a rendered one, so shedding costs next to nothing.
+
+Each class also has its own statement timeout (DB_TIMEOUT_<CLASS>_MS,
+applied with SET LOCAL by db.begin), so one slow query cannot hold a
+slot for long. A statement cancelled by its timeout, or a pool checkout
+that timed out, is answered with the same 503 page.
+
+Slots and queue are per worker process, so the gate only works with
+threaded workers: gunicorn.conf.py runs gthread workers with more threads
+than ADMISSION_SLOTS, so that the extra threads wait here, where they can
+be prioritised and shed, rather than inside the database. Under sync
+workers it never has anything to do.
+"""
+import itertools
+import os
+import threading
+import time
+
+import psycopg2
+from flask import g, request
+
+import db
+import metrics
+
+ADMISSION_SLOTS = int(os.environ.get("ADMISSION_SLOTS", str(db.POOL_MAX)))  # 0 disables
+ADMISSION_QUEUE = int(os.environ.get("ADMISSION_QUEUE", str(ADMISSION_SLOTS)))
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "1"))
+ADMISSION_SEARCH_SHARE = float(os.environ.get("ADMISSION_SEARCH_SHARE", "0.5"))
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", "2"))
+
+LOGIN_ENDPOINTS = {"register", "login_renter", "login_agent", "logout"}
+SEARCH_ENDPOINTS = {"search"}
+# Endpoints that never run SQL are not admitted at all.
+EXEMPT_ENDPOINTS = {"static", "asset", "metrics", "cache_stats"}
+
+UNAVAILABLE_PAGE = (
+    b"<!doctype html><html><head><title>Busy</title></head><body>"
+    b"<h1>We're busy right now</h1><p>Please try again in a few seconds.</p>"
+    b"</body></html>"
+)
+
+ADMITTED = metrics.Counter(
+    "werent_admission_admitted_total", "Requests admitted to the database.", ("route_class",))
+SHED = metrics.Counter(
+    "werent_admission_shed_total", "Requests answered with 503 instead of being served.",
+    ("route_class", "reason"))
+WAIT_SECONDS = metrics.Histogram(
+    "werent_admission_wait_seconds", "Time admitted requests spent queued for a slot.",
+    ("route_class",))
+
+
+class RouteClass:
+    def __init__(self, name, priority, limit, statement_timeout):
+        self.name = name
+        self.priority = priority          # lower is admitted first
+        self.limit = limit                # slots this class may hold at once
+        self.statement_timeout = statement_timeout
+
+
+def _timeout(name, default):
+    return int(os.environ.get(f"DB_TIMEOUT_{name.upper()}_MS", default)) or None
+
+
+CLASSES = {
+    route_class.name: route_class for route_class in (
+        RouteClass("login", 0, ADMISSION_SLOTS, _timeout("login", "5000")),
+        RouteClass("write", 1, ADMISSION_SLOTS, _timeout("write", "10000")),
+        RouteClass("lookup", 2, ADMISSION_SLOTS, _timeout("lookup", "2000")),
+        RouteClass("search", 3, max(1, int(ADMISSION_SLOTS * ADMISSION_SEARCH_SHARE)),
+                   _timeout("search", "5000")),
+    )
+}
+
+
+def route_class(endpoint, method):
+    """The RouteClass a request belongs to, or None if it is not admitted."""
+    if endpoint is None or endpoint in EXEMPT_ENDPOINTS:
+        return None
+    if endpoint in LOGIN_ENDPOINTS:
+        return CLASSES["login"]
+    if method not in ("GET", "HEAD"):
+        return CLASSES["write"]
+    if endpoint in SEARCH_ENDPOINTS:
+        return CLASSES["search"]
+    return CLASSES["lookup"]
+
+
+class Gate:
+    """Bounded concurrency with a bounded, prioritised wait queue.
+
+    Waiters are ``[priority, seq, route_class]`` lists; a waiter is admitted
+    once a slot (and a slot of its class) is free and no waiter ahead of it
+    could take that slot instead.
+    """
+
+    def __init__(self, slots, queue_size, max_wait):
+        self.slots = slots
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.active = 0
+        self.by_class = dict.fromkeys(CLASSES, 0)
+        self._waiting = []
+        self._pushed_out = set()    # seq of waiters displaced from a full queue
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _fits(self, route_class):
+        return self.active < self.slots and self.by_class[route_class.name] < route_class.limit
+
+    def _next_in_line(self, entry):
+        return not any(other < entry and self._fits(other[2]) for other in self._waiting)
+
+    def _admit(self, route_class):
+        self.active += 1
+        self.by_class[route_class.name] += 1
+
+    def acquire(self, route_class):
+        """Take a slot; return None when admitted, else why not."""
+        entry = [route_class.priority, next(self._seq), route_class]
+        with self._cond:
+            if self._fits(route_class) and self._next_in_line(entry):
+                self._admit(route_class)
+                return None
+            if len(self._waiting) >= self.queue_size:
+                lowest = max(self._waiting, default=None)
+                if lowest is None or lowest[0] <= route_class.priority:
+                    return "queue_full"
+                self._waiting.remove(lowest)
+                self._pushed_out.add(lowest[1])
+                # Wake it, so it is turned away now rather than at its deadline.
+                self._cond.notify_all()
+            self._waiting.append(entry)
+            deadline = time.monotonic() + self.max_wait
+            try:
+                while True:
+                    if entry[1] in self._pushed_out:
+                        self._pushed_out.discard(entry[1])
+                        return "queue_full"
+                    if self._fits(route_class) and self._next_in_line(entry):
+                        self._admit(route_class)
+                        return None
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return "wait_timeout"
+                    self._cond.wait(remaining)
+            finally:
+                if entry in self._waiting:
+                    self._waiting.remove(entry)
+                # Leaving the queue may let a waiter behind this one in.
+                self._cond.notify_all()
+
+    def release(self, route_class):
+        with self._cond:
+            self.active -= 1
+            self.by_class[route_class.name] -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "slots": self.slots,
+                "active": dict(self.by_class),
+                "waiting": len(self._waiting),
+            }
+
+
+_gate = Gate(ADMISSION_SLOTS, ADMISSION_QUEUE, ADMISSION_MAX_WAIT)
+
+
+def unavailable():
+    """The lightweight 503 response, with a Retry-After hint."""
+    return UNAVAILABLE_PAGE, 503, {
+        "Content-Type": "text/html; charset=utf-8",
+        "Retry-After": str(ADMISSION_RETRY_AFTER),
+        "Cache-Control": "no-store",
+    }
+
+
+def admit():
+    route = route_class(request.endpoint, request.method)
+    if route is None:
+        return None
+    g.route_class = route
+    if not ADMISSION_SLOTS:
+        return None
+    start = time.perf_counter()
+    reason = _gate.acquire(route)
+    if reason is not None:
+        SHED.inc(route_class=route.name, reason=reason)
+        return unavailable()
+    g.admitted = True
+    ADMITTED.inc(route_class=route.name)
+    WAIT_SECONDS.observe(time.perf_counter() - start, route_class=route.name)
+    return None
+
+
+def hold_while_streaming(response):
+    # The request is torn down before a streamed body is sent, and the
+    # body keeps reading from the database, so its slot is released when
+    # the server closes the response instead (also if the client left).
+    if response.is_streamed and g.pop("admitted", False):
+        route = g.route_class
+        response.call_on_close(lambda: _gate.release(route))
+    return response
+
+
+def release(exc):
+    if g.pop("admitted", False):
+        _gate.release(g.route_class)
+
+
+def statement_timeout():
+    """Statement timeout in ms for the current request's class, if any."""
+    route = g.get("route_class")
+    return route.statement_timeout if route is not None else None
+
+
+def database_overloaded(exc):
+    route = g.get("route_class")
+    reason = "pool_timeout" if isinstance(exc, db.PoolTimeout) else "statement_timeout"
+    SHED.inc(route_class=route.name if route is not None else "none", reason=reason)
+    return unavailable()
+
+
+def stats():
+    return _gate.stats()
+
+
+def init_app(app):
+    app.before_request(admit)
+    app.after_request(hold_while_streaming)
+    app.teardown_request(release)
+    app.register_error_handler(psycopg2.errors.QueryCanceled, database_overloaded)
+    app.register_error_handler(db.PoolTimeout, database_overloaded)
@@ -1,162 +1,158 @@
+import base64
+import binascii
+import html
+import json
+import os
+import time
+from datetime import date, timedelta
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from urllib.parse import urlencode
+
+import psycopg2
 from flask import (
     Flask,
-    render_template_string,
+    Response,
+    abort,
+    jsonify,
+    render_template,
     request,
     redirect,
-    session
+    session,
+    stream_with_context
 )
-from db import run_query
+from jinja2.utils import concat
+from markupsafe import Markup
+import admission
+import assets
+import cache
+import db
+import metrics
+import partitions
+import profiler
+import queries
+import refdata
+import slowlog
+import snapshot
+import tracing
+from db import run_query, run_returning
+from queries import SEARCH_SORT_KEYS, build_search_query
 
 app = Flask(__name__)
 app.secret_key = "realestate-secret-key"  # any random string is fine
 
+# Fingerprinted /assets/ URLs and gzip/brotli responses (see assets.py).
+assets.init_app(app)
+
+# Per-request SQL timing and the /metrics endpoint (see metrics.py).
+metrics.init_app(app)
+
+# Opt-in cProfile capture (PROFILE_TOKEN) and the slow-query log with
+# EXPLAIN plans (SLOW_QUERY_MS); see profiler.py and slowlog.py.
+profiler.init_app(app)
+slowlog.init_app(app)
+
+# Sampled span traces exported as OTLP JSON (TRACE_SAMPLE_RATE, tracing.py).
+tracing.init_app(app)
+
+# Per-class concurrency slots, a prioritised wait queue, statement timeouts
+# and 503 + Retry-After when overloaded (ADMISSION_*, see admission.py).
+admission.init_app(app)
+
+# Near-static lookup tables, loaded once per worker (see refdata.py).
+CATEGORIES = refdata.register("PROPERTY_CATEGORY", queries.CATEGORIES)
+
+# Hot statements are prepared once per pooled connection (DB_PLAN_CACHE_MODE
+# and the registry are described in db.py); /search registers its shapes
+# as they come up.
+for _name, _sql in queries.PREPARED.items():
+    db.prepare(_sql, _name)
+
 # ===========================================================
-# BASE LAYOUT WITH BOOTSTRAP + "WeRent Homes" HEADER
+# ONE DATABASE TRANSACTION PER REQUEST
 # ===========================================================
-BASE_HTML = """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <title>WeRent Homes - Real Estate App</title>
-    <!-- Bootstrap CSS -->
-    <link
-      href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css"
-      rel="stylesheet"
-      integrity="sha384-QWTKZyjpPEjISv5WaRU9OFeRpok6YctnYmDr5pNlyT2bRjXh0JMhjY6hW+ALEwIH"
-      crossorigin="anonymous"
-    >
-    <style>
-        body {
-            background: linear-gradient(135deg, #0f172a, #1e293b);
-            min-height: 100vh;
-            margin: 0;
-            padding: 0;
-            color: #0f172a;
-        }
-        .app-container {
-            max-width: 1000px;
-            margin: 40px auto;
-            padding: 0 15px;
-        }
-        .card-main {
-            background: #f8fafc;
-            border-radius: 18px;
-            box-shadow: 0 15px 35px rgba(15,23,42,0.5);
-            padding: 24px 30px 30px 30px;
-        }
-        .brand-bar {
-            display: flex;
-            align-items: center;
-            justify-content: space-between;
-            margin-bottom: 18px;
-        }
-        .brand-left {
-            display: flex;
-            align-items: center;
-            gap: 10px;
-        }
-        .brand-logo {
-            width: 36px;
-            height: 36px;
-            border-radius: 999px;
-            background: #1d4ed8;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            color: white;
-            font-size: 20px;
-            box-shadow: 0 0 0 3px rgba(37,99,235,0.2);
-        }
-        .brand-title {
-            font-weight: 700;
-            font-size: 1.25rem;
-            color: #0f172a;
-        }
-        .brand-sub {
-            font-size: .8rem;
-            color: #64748b;
-        }
-        .nav-links a {
-            margin-left: 10px;
-        }
-        h1, h2, h3 {
-            color: #0f172a;
-        }
-        a {
-            color: #2563eb;
-            text-decoration: none;
-        }
-        a:hover {
-            text-decoration: underline;
-        }
-        .btn-primary {
-            background-color: #2563eb !important;
-            border-color: #2563eb !important;
-        }
-        .btn-primary:hover {
-            background-color: #1d4ed8 !important;
-        }
-        table {
-            background: white;
-        }
-        th {
-            background: #e2e8f0;
-        }
-        input, select {
-            border-radius: 0.5rem !important;
-        }
-        .badge-role {
-            font-size: 0.75rem;
-            background: #e0f2fe;
-            color: #0f172a;
-            border-radius: 999px;
-            padding: 3px 10px;
-        }
-    </style>
-</head>
-<body>
-    <div class="app-container">
-      <div class="card-main">
-        <div class="brand-bar">
-          <div class="brand-left">
-            <div class="brand-logo">🏠</div>
-            <div>
-                <div class="brand-title">WeRent Homes</div>
-                <div class="brand-sub">Real Estate Management Portal</div>
-            </div>
-          </div>
-          <div class="nav-links">
-            <a href="/" class="btn btn-sm btn-outline-secondary">Home</a>
-            {% if session.get('role') == 'renter' %}
-              <span class="badge-role">Renter: {{ session.get('renter_name', 'User') }}</span>
-              <a href="/renter_dashboard" class="btn btn-sm btn-outline-primary">Dashboard</a>
-            {% elif session.get('role') == 'agent' %}
-              <span class="badge-role">Agent: {{ session.get('agent_name', 'User') }}</span>
-              <a href="/agent_dashboard" class="btn btn-sm btn-outline-primary">Dashboard</a>
-            {% endif %}
-            {% if session.get('role') %}
-              <a href="/logout" class="btn btn-sm btn-danger">Logout</a>
-            {% endif %}
-          </div>
-        </div>
+# Every run_query call made while handling a request shares one pooled
+# connection and one transaction. Successful responses (2xx/3xx) commit once
+# at the end; error responses and exceptions roll everything back, so a
+# failing step never leaves half-written USER/ADDRESS/RENTER rows behind.
+#
+# With read replicas configured (db.py, READ REPLICAS), GET pages read from
+# a replica. A session that has just written reads from the primary for
+# DB_PRIMARY_PIN_SECONDS, so e.g. the booking made by POST /book shows up
+# on the /my_bookings page it redirects to even if the replicas lag.
+PRIMARY_PIN_SECONDS = float(os.environ.get("DB_PRIMARY_PIN_SECONDS", "5"))
+
+
+@app.before_request
+def begin_unit_of_work():
+    db.begin(replica_reads=request.method in ("GET", "HEAD")
+             and session.get("primary_until", 0) <= time.time(),
+             statement_timeout=admission.statement_timeout())
+
+
+@app.after_request
+def commit_unit_of_work(response):
+    if response.status_code < 400:
+        if db.REPLICA_URLS and db.wrote():
+            session["primary_until"] = time.time() + PRIMARY_PIN_SECONDS
+        db.commit()
+    else:
+        db.rollback()
+    return response
 
-        <div class="mt-2">
-          {{ content|safe }}
-        </div>
-      </div>
-    </div>
-    <!-- Bootstrap JS (optional, for dropdowns etc.) -->
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/js/bootstrap.bundle.min.js"
-            integrity="sha384-YvpcrYf0tY3lHB60NNkmXc5s9fDVZLESaAA55NDzOxhy9GkcIdslK1eN7N6jIeHz"
-            crossorigin="anonymous"></script>
-</body>
-</html>
-"""
+
+@app.teardown_request
+def end_unit_of_work(exc):
+    db.end()
+
+# ===========================================================
+# PAGE RENDERING
+# ===========================================================
+# The Bootstrap layout lives in templates/layout.html. Jinja compiles each
+# template once per worker and caches it, so requests only pay for
+# rendering. Table-heavy pages extend the layout and are streamed: their
+# rows come from a generator and are rendered ROW_CHUNK at a time through
+# the template's "rows" block, instead of being concatenated into one big
+# string first.
+ROW_CHUNK = 200
 
 def render_page(content: str):
     """Wrap page content in the base layout."""
-    return render_template_string(BASE_HTML, content=content)
+    return render_template("layout.html", content=content)
+
+class RowChunks:
+    """Iterable of rendered <tr> markup, one string per chunk of rows.
+
+    String cells are escaped here with html.escape, which is far cheaper
+    than per-cell autoescaping; the "rows" block itself runs with autoescape
+    off. ``empty`` tells the template whether any row was produced.
+    """
+
+    def __init__(self, template, rows, chunk_size=ROW_CHUNK):
+        self.template = template
+        self.rows = rows
+        self.chunk_size = chunk_size
+        self.empty = True
+
+    def __iter__(self):
+        render_rows = self.template.blocks["rows"]
+        rows = iter(self.rows)
+        while True:
+            chunk = [
+                tuple(html.escape(v) if isinstance(v, str) else v for v in row)
+                for row in islice(rows, self.chunk_size)
+            ]
+            if not chunk:
+                return
+            self.empty = False
+            yield Markup(concat(render_rows(self.template.new_context({"rows": chunk}))))
+
+def stream_page(template_name: str, rows, **context):
+    """Stream a table page that extends the layout, chunk by chunk."""
+    template = app.jinja_env.get_template(template_name)
+    context["rows"] = RowChunks(template, rows)
+    app.update_template_context(context)
+    return Response(stream_with_context(template.generate(context)), mimetype="text/html")
 
 # ===========================================================
 # HOME PAGE
@@ -210,11 +206,18 @@ def register():
         middle = request.form.get("middle_name").strip() or None
         last = request.form.get("last_name").strip()
 
-        existing = run_query(
-            'SELECT user_id FROM "USER" WHERE email = %s;',
-            (email,), fetch=True
+        # ON CONFLICT turns the "email already registered" check and the
+        # insert into a single statement; no row back means a duplicate.
+        user_row = run_returning(
+            '''
+            INSERT INTO "USER" (email, phone_number, first_name, middle_name, last_name)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (email) DO NOTHING
+            RETURNING user_id;
+            ''',
+            (email, phone, first, middle, last)
         )
-        if existing:
+        if user_row is None:
             return render_page("""
                 <h2>Register</h2>
                 <div class="alert alert-danger">That email is already registered.</div>
@@ -222,20 +225,7 @@ def register():
                 <a href="/login_agent" class="btn btn-outline-primary btn-sm ms-2">Login as Agent</a>
             """)
 
-        run_query(
-            '''
-            INSERT INTO "USER" (email, phone_number, first_name, middle_name, last_name)
-            VALUES (%s, %s, %s, %s, %s);
-            ''',
-            (email, phone, first, middle, last),
-            fetch=False
-        )
-
-        user_row = run_query(
-            'SELECT user_id FROM "USER" WHERE email = %s;',
-            (email,), fetch=True
-        )
-        user_id = user_row[0][0]
+        user_id = user_row[0]
 
         line_1 = request.form.get("line_1").strip()
         city = request.form.get("city").strip()
@@ -244,24 +234,15 @@ def register():
 
         addr_id = None
         if line_1:
-            run_query(
+            addr_row = run_returning(
                 '''
                 INSERT INTO ADDRESS (line_1, city, state_, zip_code)
-                VALUES (%s, %s, %s, %s);
-                ''',
-                (line_1, city, state_, zip_code),
-                fetch=False
-            )
-            addr_row = run_query(
-                '''
-                SELECT address_id FROM ADDRESS
-                WHERE line_1 = %s AND city = %s AND state_ = %s
-                ORDER BY address_id DESC LIMIT 1;
+                VALUES (%s, %s, %s, %s)
+                RETURNING address_id;
                 ''',
-                (line_1, city, state_),
-                fetch=True
+                (line_1, city, state_, zip_code)
             )
-            addr_id = addr_row[0][0]
+            addr_id = addr_row[0]
 
         if role == "renter":
             move_in = request.form.get("move_in_date") or None
@@ -395,12 +376,7 @@ def login_renter():
     if request.method == "POST":
         email = request.form["email"].strip()
 
-        rows = run_query("""
-            SELECT r.renter_id, u.first_name
-            FROM RENTER r
-            JOIN "USER" u ON r.user_id = u.user_id
-            WHERE u.email = %s;
-        """, (email,), fetch=True)
+        rows = run_query(queries.RENTER_LOGIN, (email,), fetch=True)
 
         if rows:
             renter_id = rows[0][0]
@@ -440,12 +416,7 @@ def login_agent():
     if request.method == "POST":
         email = request.form["email"].strip()
 
-        rows = run_query("""
-            SELECT a.agent_id, u.first_name
-            FROM AGENT a
-            JOIN "USER" u ON a.user_id = u.user_id
-            WHERE u.email = %s;
-        """, (email,), fetch=True)
+        rows = run_query(queries.AGENT_LOGIN, (email,), fetch=True)
 
         if rows:
             agent_id = rows[0][0]
@@ -520,51 +491,8 @@ def agent_dashboard():
 
     name = session.get("agent_name", "Agent")
 
-    props = run_query("""
-        SELECT p.prop_id, a.line_1, a.city, a.state_,
-               p.price, pc.category_name, pd.rooms
-        FROM PROPERTY p
-        JOIN ADDRESS a ON p.address_id = a.address_id
-        JOIN PROPERTY_DETAILS pd ON p.prop_id = pd.prop_id
-        JOIN PROPERTY_CATEGORY pc ON pd.property_category_id = pc.property_category_id
-        WHERE p.agent_id = %s
-        ORDER BY p.prop_id;
-    """, (session["agent_id"],), fetch=True)
-
-    rows_html = ""
-    for row in props:
-        prop_id, addr, city, state_, price, cat, rooms = row
-        rows_html += f"""
-        <tr>
-            <td>{prop_id}</td>
-            <td>{addr}, {city}, {state_}</td>
-            <td>{cat}</td>
-            <td>{rooms if rooms is not None else '-'}</td>
-            <td>${price}</td>
-            <td>
-                <form method="post" action="/agent/property/{prop_id}/delete" style="display:inline;">
-                    <button type="submit" class="btn btn-sm btn-outline-danger">Delete</button>
-                </form>
-            </td>
-        </tr>
-        """
-
-    return render_page(f"""
-        <h2 class="mb-3">Welcome, {name} (Agent)</h2>
-        <a href="/agent/property/new" class="btn btn-primary btn-sm mb-3">+ Add New Property</a>
-        <h5>Your Properties</h5>
-        <table class="table table-striped table-bordered align-middle">
-            <thead>
-                <tr>
-                    <th>ID</th><th>Address</th><th>Type</th><th>Rooms</th><th>Price</th><th>Actions</th>
-                </tr>
-            </thead>
-            <tbody>
-                {rows_html if rows_html else '<tr><td colspan="6" class="text-muted">No properties yet.</td></tr>'}
-            </tbody>
-        </table>
-        <a href="/agent_bookings" class="btn btn-outline-primary btn-sm mt-2">View Bookings on My Properties</a>
-    """)
+    props = run_query(queries.AGENT_PROPERTIES, (session["agent_id"],), fetch=True)
+    return stream_page("agent_dashboard.html", name=name, rows=props)
 
 # ===========================================================
 # AGENT: ADD PROPERTY
@@ -580,79 +508,47 @@ def agent_new_property():
         state_ = request.form.get("state_").strip()
         zip_code = request.form.get("zip_code").strip() or None
 
-        run_query(
-            '''
-            INSERT INTO ADDRESS (line_1, city, state_, zip_code)
-            VALUES (%s, %s, %s, %s);
-            ''',
-            (line_1, city, state_, zip_code),
-            fetch=False
-        )
-
-        addr_row = run_query(
-            '''
-            SELECT address_id FROM ADDRESS
-            WHERE line_1 = %s AND city = %s AND state_ = %s
-            ORDER BY address_id DESC LIMIT 1;
-            ''',
-            (line_1, city, state_),
-            fetch=True
-        )
-        address_id = addr_row[0][0]
-
         sq_ft = request.form.get("sq_ft") or None
         price = request.form.get("price") or None
         date_avail = request.form.get("date_avail") or None
         utilities = bool(request.form.get("utilities"))
         parking = bool(request.form.get("parking"))
 
-        run_query(
-            '''
-            INSERT INTO PROPERTY (agent_id, address_id, Sq_ft, Price, Date_of_availability, Utilities, Parking)
-            VALUES (%s, %s, %s, %s, %s, %s, %s);
-            ''',
-            (session["agent_id"], address_id, sq_ft, price, date_avail, utilities, parking),
-            fetch=False
-        )
-
-        prop_row = run_query(
-            '''
-            SELECT prop_id FROM PROPERTY
-            WHERE agent_id = %s AND address_id = %s
-            ORDER BY prop_id DESC LIMIT 1;
-            ''',
-            (session["agent_id"], address_id),
-            fetch=True
-        )
-        prop_id = prop_row[0][0]
-
         category_name = request.form.get("category")
         desc = request.form.get("description") or None
         rooms = request.form.get("rooms") or None
         crime = request.form.get("crime_rate") or None
         btype = request.form.get("business_type") or None
 
-        cat_row = run_query(
-            "SELECT property_category_id FROM PROPERTY_CATEGORY WHERE category_name = %s;",
-            (category_name,), fetch=True
-        )
-        if not cat_row:
+        category_id = CATEGORIES.id_for(category_name)
+        if category_id is None:
             return "Invalid category", 400
-        category_id = cat_row[0][0]
 
-        run_query(
+        # ADDRESS -> PROPERTY -> PROPERTY_DETAILS in one round trip.
+        run_returning(
             '''
+            WITH new_addr AS (
+                INSERT INTO ADDRESS (line_1, city, state_, zip_code)
+                VALUES (%s, %s, %s, %s)
+                RETURNING address_id
+            ), new_prop AS (
+                INSERT INTO PROPERTY (agent_id, address_id, Sq_ft, Price, Date_of_availability, Utilities, Parking)
+                SELECT %s, address_id, %s, %s, %s, %s, %s FROM new_addr
+                RETURNING prop_id
+            )
             INSERT INTO PROPERTY_DETAILS (prop_id, property_category_id, Description_, Rooms, Crime_rate, business_type)
-            VALUES (%s, %s, %s, %s, %s, %s);
+            SELECT prop_id, %s, %s, %s, %s, %s FROM new_prop
+            RETURNING prop_id;
             ''',
-            (prop_id, category_id, desc, rooms, crime, btype),
-            fetch=False
+            (line_1, city, state_, zip_code,
+             session["agent_id"], sq_ft, price, date_avail, utilities, parking,
+             category_id, desc, rooms, crime, btype)
         )
 
+        db.after_commit(lambda: invalidate_search_cache(city))
         return redirect("/agent_dashboard")
 
-    cats = run_query("SELECT category_name FROM PROPERTY_CATEGORY ORDER BY category_name;", fetch=True)
-    options = "".join([f'<option value="{c[0]}">{c[0]}</option>' for c in cats])
+    options = CATEGORIES.options_html()
 
     return render_page(f"""
         <h2>Add New Property</h2>
@@ -738,189 +634,405 @@ def agent_delete_property(prop_id):
     if session.get("role") != "agent":
         return redirect("/login_agent")
 
-    run_query(
-        "DELETE FROM PROPERTY WHERE prop_id = %s AND agent_id = %s;",
-        (prop_id, session["agent_id"]),
-        fetch=False
-    )
+    deleted = run_returning(queries.DELETE_AGENT_PROPERTY, (prop_id, session["agent_id"]))
+    if deleted is not None:
+        db.after_commit(lambda: invalidate_search_cache(deleted[0]))
     return redirect("/agent_dashboard")
 
 # ===========================================================
 # AGENT: VIEW BOOKINGS
 # ===========================================================
+# BOOKING is partitioned by month of booking_date (migrations/0007). The
+# booking lists show the last BOOKINGS_RECENT_MONTHS whole months plus
+# everything ahead, so they read only those partitions; ?history=1 shows
+# every month still in the database, and ?history=archive adds the
+# archived months, read from the cold store (see partitions.py) at most
+# ARCHIVE_PAGE_LIMIT bookings at a time.
+BOOKINGS_RECENT_MONTHS = int(os.environ.get("BOOKINGS_RECENT_MONTHS", "12"))
+ARCHIVE_PAGE_LIMIT = int(os.environ.get("ARCHIVE_PAGE_LIMIT", "500"))
+
+
+def bookings_since(history):
+    """Earliest booking_date a booking list shows."""
+    if history:
+        return date.min
+    today = date.today()
+    month = today.year * 12 + today.month - 1 - BOOKINGS_RECENT_MONTHS
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def archived_bookings(**where):
+    """Up to ARCHIVE_PAGE_LIMIT archived bookings, and whether there are more."""
+    found = list(islice(partitions.archived_bookings(**where), ARCHIVE_PAGE_LIMIT + 1))
+    return found[:ARCHIVE_PAGE_LIMIT], len(found) > ARCHIVE_PAGE_LIMIT
+
+
+def history_context():
+    """Template context for the booking lists' history modes."""
+    mode = request.args.get("history")
+    return {
+        "history_mode": mode in ("1", "archive"),
+        "archive_mode": mode == "archive",
+        "archived_through": partitions.archived_through() if mode else None,
+    }
+
+
 @app.route("/agent_bookings")
 def agent_bookings():
     if session.get("role") != "agent":
         return redirect("/login_agent")
 
-    rows = run_query("""
-        SELECT b.booking_id, b.booking_date,
-               p.prop_id, a.line_1, a.city, p.price,
-               u.email AS renter_email
-        FROM BOOKING b
-        JOIN PROPERTY p ON b.prop_id = p.prop_id
-        JOIN ADDRESS a ON p.address_id = a.address_id
-        JOIN RENTER r ON b.renter_id = r.renter_id
-        JOIN "USER" u ON r.user_id = u.user_id
-        WHERE p.agent_id = %s
-        ORDER BY b.booking_id DESC;
-    """, (session["agent_id"],), fetch=True)
-
-    body = ""
-    for row in rows:
-        bid, bdate, pid, addr, city, price, remail = row
-        body += f"""
-        <tr>
-            <td>{bid}</td>
-            <td>{bdate}</td>
-            <td>{pid}</td>
-            <td>{addr}, {city}</td>
-            <td>${price}</td>
-            <td>{remail}</td>
-        </tr>
-        """
+    context = history_context()
+    since = bookings_since(context["history_mode"])
+    archived, archive_more = [], False
+    if context["archive_mode"]:
+        props = {row[0]: row for row in
+                 run_query(queries.AGENT_PROPERTIES, (session["agent_id"],), fetch=True)}
+        found, archive_more = archived_bookings(props=list(props))
+        renters = {int(row["renter_id"]) for row in found}
+        emails = dict(run_query(queries.RENTER_EMAILS, (list(renters),), fetch=True))
+        for row in found:
+            pid = int(row["prop_id"])
+            _, line1, city, _, price, _, _ = props[pid]
+            archived.append((row["booking_id"], row["booking_date"], pid, line1, city, price,
+                             emails.get(int(row["renter_id"]), "-")))
+    rows = db.iter_rows(queries.AGENT_BOOKINGS, (session["agent_id"], since))
+    return stream_page("agent_bookings.html", rows=rows, since=since, archived=archived,
+                       archive_more=archive_more, **context)
 
-    return render_page(f"""
-        <h2>Bookings on Your Properties</h2>
-        <table class="table table-striped table-bordered align-middle">
-            <thead>
-                <tr>
-                    <th>Booking ID</th><th>Date</th><th>Property ID</th>
-                    <th>Address</th><th>Price</th><th>Renter Email</th>
-                </tr>
-            </thead>
-            <tbody>
-                {body if body else '<tr><td colspan="6" class="text-muted">No bookings yet.</td></tr>'}
-            </tbody>
-        </table>
-        <a href="/agent_dashboard" class="btn btn-outline-secondary btn-sm mt-2">Back to Agent Dashboard</a>
-    """)
+# ===========================================================
+# AGENT: ANALYTICS
+# ===========================================================
+ANALYTICS_WEEKS_BACK = 12    # weeks before the current one
+ANALYTICS_WEEKS_AHEAD = 4    # and after it, for stays already booked
+ANALYTICS_TOP_CITIES = 5
+
+
+@app.route("/agent_analytics")
+def agent_analytics():
+    if session.get("role") != "agent":
+        return redirect("/login_agent")
+
+    agent_id = session["agent_id"]
+    props = run_query(queries.AGENT_ROLLUP_PROPERTIES, (agent_id,), fetch=True)
+
+    this_week = date.today() - timedelta(days=date.today().weekday())
+    first = this_week - timedelta(weeks=ANALYTICS_WEEKS_BACK)
+    end = this_week + timedelta(weeks=ANALYTICS_WEEKS_AHEAD + 1)
+    found = {
+        week: (check_ins, nights, revenue)
+        for week, check_ins, nights, revenue in run_query(
+            queries.AGENT_ROLLUP_WEEKS, (agent_id, first, end), fetch=True)
+    }
+    capacity = len(props) * 7
+    weeks = []
+    for n in range((end - first).days // 7):
+        week = first + timedelta(weeks=n)
+        check_ins, nights, revenue = found.get(week, (0, 0, 0))
+        occupancy = 100 * nights / capacity if capacity else 0
+        weeks.append((week, check_ins, nights, revenue, occupancy, week == this_week))
+
+    cities = {}
+    for _, city, bookings, nights, revenue in props:
+        listed = cities.setdefault(city or "-", [0, 0, 0])
+        listed[0] += 1
+        listed[1] += bookings
+        listed[2] += revenue
+    top_cities = sorted(cities.items(), key=lambda item: (-item[1][1], item[0]))
+    totals = (
+        len(props),
+        sum(row[2] for row in props),
+        sum(row[3] for row in props),
+        sum((row[4] for row in props), Decimal(0)),
+    )
+    return stream_page(
+        "agent_analytics.html",
+        rows=props,
+        totals=totals,
+        weeks=weeks,
+        top_cities=top_cities[:ANALYTICS_TOP_CITIES],
+    )
 
 # ===========================================================
 # RENTER: SEARCH
 # ===========================================================
-@app.route("/search", methods=["GET"])
-def search():
-    if session.get("role") != "renter":
-        return redirect("/login_renter")
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", "20"))
+SEARCH_STREAM_CHUNK = int(os.environ.get("SEARCH_STREAM_CHUNK", "500"))
+
+# Result pages are cached per normalized filter tuple + cursor. Entries are
+# tagged with the city they cover ("*" when unfiltered), and adding or
+# deleting a property invalidates exactly those tags after commit.
+# SEARCH_CACHE_SHARED points at a local file shared by all workers.
+# Without it each worker learns of other workers' writes from the change
+# feed only, so its entries are not used while the feed is down.
+SEARCH_CACHE = cache.TaggedCache(
+    "search",
+    max_entries=int(os.environ.get("SEARCH_CACHE_SIZE", "1024")),
+    ttl=float(os.environ.get("SEARCH_CACHE_TTL", "60")),
+    shared_path=os.environ.get("SEARCH_CACHE_SHARED") or None,
+    live=db.change_feed_live,
+)
+
+
+def _normalize_number(value, cast):
+    try:
+        return str(cast(value))
+    except (ValueError, InvalidOperation):
+        return value
 
-    city = request.args.get("city") or ""
-    min_price = request.args.get("min_price") or ""
-    max_price = request.args.get("max_price") or ""
-    category = request.args.get("category") or ""
-    rooms = request.args.get("rooms") or ""
-    sort_by = request.args.get("sort_by") or "price"
 
-    conditions = []
-    params = []
+def parse_stay(check_in, check_out=""):
+    """(check-in, check-out) dates from YYYY-MM-DD strings.
+
+    The check-out day is not part of the stay and defaults to the day after
+    check-in. Raises ValueError for malformed or reversed dates.
+    """
+    start = date.fromisoformat(check_in)
+    end = date.fromisoformat(check_out) if check_out else start + timedelta(days=1)
+    if end <= start:
+        raise ValueError("check-out must be after check-in")
+    return start, end
+
 
+def normalize_search_filters(filters):
+    """Canonical filter values, so equivalent searches share a cache entry.
+
+    Raises ValueError for malformed availability dates.
+    """
+    available_from = available_to = ""
+    if filters["available_from"] or filters["available_to"]:
+        start, end = parse_stay(filters["available_from"] or date.today().isoformat(),
+                                filters["available_to"])
+        available_from, available_to = start.isoformat(), end.isoformat()
+    return {
+        "q": " ".join(filters["q"].split()).lower(),
+        "city": filters["city"].strip().lower(),
+        "min_price": _normalize_number(filters["min_price"], lambda v: Decimal(v).normalize()),
+        "max_price": _normalize_number(filters["max_price"], lambda v: Decimal(v).normalize()),
+        "category": filters["category"],
+        "rooms": _normalize_number(filters["rooms"], int),
+        "available_from": available_from,
+        "available_to": available_to,
+    }
+
+
+def search_cache_tags(filters):
+    tags = ["city:" + (filters["city"] or "*")]
+    if filters["available_from"]:
+        # Booking or cancelling anything can change what is available.
+        tags.append("availability")
+    return tags
+
+
+def invalidate_search_cache(city):
+    tags = ["city:*"]
     if city:
-        conditions.append("LOWER(a.city) = LOWER(%s)")
-        params.append(city)
-    if min_price:
-        conditions.append("p.price >= %s")
-        params.append(min_price)
-    if max_price:
-        conditions.append("p.price <= %s")
-        params.append(max_price)
-    if category:
-        conditions.append("pc.category_name = %s")
-        params.append(category)
-    if rooms:
-        conditions.append("pd.rooms = %s")
-        params.append(rooms)
-
-    where_clause = "WHERE 1=1"
-    if conditions:
-        where_clause += " AND " + " AND ".join(conditions)
-
-    order_clause = "ORDER BY p.price"
-    if sort_by == "rooms":
-        order_clause = "ORDER BY pd.rooms"
-    elif sort_by == "city":
-        order_clause = "ORDER BY a.city"
-
-    sql = f"""
-        SELECT p.prop_id, a.line_1, a.city, a.state_,
-               p.price, pd.rooms, pc.category_name
-        FROM PROPERTY p
-        JOIN ADDRESS a ON p.address_id = a.address_id
-        JOIN PROPERTY_DETAILS pd ON p.prop_id = pd.prop_id
-        JOIN PROPERTY_CATEGORY pc ON pd.property_category_id = pc.property_category_id
-        {where_clause}
-        {order_clause};
+        tags.append("city:" + city.strip().lower())
+    SEARCH_CACHE.invalidate(tags)
+    snapshot.mark_stale()
+
+
+def on_data_change(event):
+    """Change-feed callback (db.on_change) for writes by any worker or host."""
+    if event["t"] == "booking":
+        SEARCH_CACHE.invalidate(["availability"])
+    if event["t"] not in ("property", "property_details", "*"):
+        return
+    if event.get("all"):
+        SEARCH_CACHE.invalidate_all()
+    else:
+        SEARCH_CACHE.invalidate(["city:*"] + ["city:" + city for city in event.get("cities", [])])
+    snapshot.mark_stale()
+
+
+db.on_change(on_data_change)
+
+
+def fetch_search_rows(ids, sort_by):
+    """Display rows for prop ids chosen from the listing snapshot, in order.
+
+    A listing deleted since the snapshot was built is simply left out.
     """
+    if not ids:
+        return []
+    found = run_query(db.prepare(queries.build_search_rows_query(sort_by)), (ids,), fetch=True)
+    by_id = {row[0]: row for row in found}
+    return [by_id[i] for i in ids if i in by_id]
 
-    rows = run_query(sql, tuple(params), fetch=True)
-
-    body = ""
-    for row in rows:
-        pid, line1, ccity, sstate, price, rrooms, cat = row
-        body += f"""
-        <tr>
-            <td>{pid}</td>
-            <td>{line1}, {ccity}, {sstate}</td>
-            <td>{cat}</td>
-            <td>{rrooms if rrooms is not None else '-'}</td>
-            <td>${price}</td>
-            <td><a href="/book/{pid}" class="btn btn-sm btn-primary">Book</a></td>
-        </tr>
-        """
-
-    cats = run_query("SELECT category_name FROM PROPERTY_CATEGORY ORDER BY category_name;", fetch=True)
-    cat_options = '<option value="">Any</option>' + "".join(
-        [f'<option value="{c[0]}" {"selected" if c[0]==category else ""}>{c[0]}</option>' for c in cats]
-    )
 
-    return render_page(f"""
-        <h2>Search Properties</h2>
-        <form method="get" class="row g-3 mb-3">
-            <div class="col-md-3">
-                <label class="form-label">City</label>
-                <input type="text" name="city" value="{city}" class="form-control">
-            </div>
-            <div class="col-md-3">
-                <label class="form-label">Min Price</label>
-                <input type="number" step="0.01" name="min_price" value="{min_price}" class="form-control">
-            </div>
-            <div class="col-md-3">
-                <label class="form-label">Max Price</label>
-                <input type="number" step="0.01" name="max_price" value="{max_price}" class="form-control">
-            </div>
-            <div class="col-md-3">
-                <label class="form-label">Category</label>
-                <select name="category" class="form-select">
-                    {cat_options}
-                </select>
-            </div>
-            <div class="col-md-3">
-                <label class="form-label">Rooms</label>
-                <input type="number" name="rooms" value="{rooms}" class="form-control">
-            </div>
-            <div class="col-md-3">
-                <label class="form-label">Sort by</label>
-                <select name="sort_by" class="form-select">
-                    <option value="price" {"selected" if sort_by=="price" else ""}>Price</option>
-                    <option value="rooms" {"selected" if sort_by=="rooms" else ""}>Rooms</option>
-                    <option value="city" {"selected" if sort_by=="city" else ""}>City</option>
-                </select>
-            </div>
-            <div class="col-md-3 d-flex align-items-end">
-                <button type="submit" class="btn btn-primary">Search</button>
-            </div>
-        </form>
-        <table class="table table-striped table-bordered align-middle">
-            <thead>
-                <tr>
-                    <th>ID</th><th>Address</th><th>Type</th><th>Rooms</th><th>Price</th><th>Action</th>
-                </tr>
-            </thead>
-            <tbody>
-                {body if body else '<tr><td colspan="6" class="text-muted">No properties found.</td></tr>'}
-            </tbody>
-        </table>
-        <a href="/renter_dashboard" class="btn btn-outline-secondary btn-sm mt-2">Back to Renter Dashboard</a>
-    """)
+def snapshot_search(snap, filters, sort_by, after, before, facets):
+    """(rows, facet counts) of a /search page picked from the snapshot, or None.
+
+    Like the SQL path, up to SEARCH_PAGE_SIZE + 1 rows, the extra one
+    saying there is a next page. Listings deleted since the snapshot leave
+    gaps, so more ids are taken from the snapshot until the page is full
+    or it has no more.
+    """
+    want = SEARCH_PAGE_SIZE + 1
+    limit = want
+    while True:
+        # The facet counts do not depend on the page; count them once.
+        found = snap.search(filters, sort_by, after=after, before=before, limit=limit,
+                            facets=facets and limit == want)
+        if found is None:
+            return None
+        ids, page_counts = found
+        if limit == want:
+            counts = page_counts
+        rows = fetch_search_rows(ids, sort_by)
+        if len(rows) >= want or len(ids) < limit:
+            return rows[:want], counts
+        limit *= 2
+
+
+def _price_bucket(bucket):
+    """(label, min_price, max_price) of a queries.PRICE_BUCKET_EDGES bucket."""
+    edges = queries.PRICE_BUCKET_EDGES
+    if bucket == 0:
+        return f"Under ${edges[0]:,}", "", str(edges[0] - 0.01)
+    if bucket == len(edges):
+        return f"${edges[-1]:,}+", str(edges[-1]), ""
+    low, high = edges[bucket - 1], edges[bucket]
+    return f"${low:,}–{high:,}", str(low), str(high - 0.01)
+
+
+def search_facets(counts, base_args):
+    """Facet groups [(title, [(label, count, url), ...])] from the query's counts.
+
+    Each link narrows the current search by that value and starts again at
+    page one.
+    """
+    groups = {"category": [], "rooms": [], "price": [], "city": []}
+    # Price buckets read best in price order, the others by count.
+    counts = sorted(counts, key=lambda c: int(c[1]) if c[0] == "price" else 0)
+    for facet, value, count in counts:
+        if facet == "price":
+            label, low, high = _price_bucket(int(value))
+            args = dict(base_args, min_price=low, max_price=high)
+        else:
+            label = f"{value} rooms" if facet == "rooms" else value
+            args = dict(base_args, **{facet: value})
+        groups[facet].append((label, count, "/search?" + urlencode(args)))
+    titles = (("category", "Type"), ("rooms", "Rooms"), ("price", "Price"), ("city", "City"))
+    return [(title, groups[facet]) for facet, title in titles if groups[facet]]
+
+
+def encode_cursor(sort_value, prop_id):
+    raw = json.dumps([str(sort_value), prop_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """Inverse of encode_cursor; raises ValueError on a malformed token."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        sort_value, prop_id = json.loads(raw)
+        return str(sort_value), int(prop_id)
+    except (TypeError, ValueError, binascii.Error) as e:
+        raise ValueError("invalid search cursor") from e
+
+
+@app.route("/search", methods=["GET"])
+def search():
+    if session.get("role") != "renter":
+        return redirect("/login_renter")
+
+    filters = {
+        "q": (request.args.get("q") or "").strip(),
+        "city": request.args.get("city") or "",
+        "min_price": request.args.get("min_price") or "",
+        "max_price": request.args.get("max_price") or "",
+        "category": request.args.get("category") or "",
+        "rooms": request.args.get("rooms") or "",
+        "available_from": request.args.get("available_from") or "",
+        "available_to": request.args.get("available_to") or "",
+    }
+    # Keyword searches rank by relevance unless another order is asked for;
+    # relevance means nothing without keywords.
+    sort_by = request.args.get("sort_by") or ("relevance" if filters["q"] else "price")
+    if sort_by not in SEARCH_SORT_KEYS or (sort_by == "relevance" and not filters["q"]):
+        sort_by = "price"
+    try:
+        after = decode_cursor(request.args["after"]) if request.args.get("after") else None
+        before = decode_cursor(request.args["before"]) if request.args.get("before") else None
+    except ValueError:
+        return "Invalid search cursor", 400
+    try:
+        key_filters = normalize_search_filters(filters)
+    except ValueError:
+        return "Invalid availability dates", 400
+    stream = request.args.get("stream") == "1"
+
+    cat_options = CATEGORIES.options_html(selected=filters["category"], blank="Any")
+    base_args = dict(filters, sort_by=sort_by)
+    page = dict(filters=filters, sort_by=sort_by, cat_options=cat_options)
+
+    if stream:
+        # Every remaining match, pulled through a server-side cursor and
+        # written out as it arrives: memory stays flat however many rows.
+        sql, params = build_search_query(key_filters, sort_by, after=after)
+        rows = db.iter_rows(sql, params, chunk_size=SEARCH_STREAM_CHUNK)
+        return stream_page(
+            "search.html", rows=rows, paged_url="/search?" + urlencode(base_args), **page
+        )
+
+    # Pages picked from the listing snapshot are only as fresh as its
+    # generation, so they are cached per generation.
+    snap = snapshot.current()
+    generation = snap.generation if snap is not None else None
+    cache_key = repr((sorted(key_filters.items()), sort_by, after, before, SEARCH_PAGE_SIZE, generation))
+    facets_key = repr(("facets", sorted(key_filters.items()), generation))
+    rows = SEARCH_CACHE.get(cache_key)
+    counts = SEARCH_CACHE.get(facets_key)
+    if rows is cache.MISS or counts is cache.MISS:
+        versions = SEARCH_CACHE.tag_versions(search_cache_tags(key_filters))
+        with_facets = counts is cache.MISS
+        found = None
+        if snap is not None:
+            found = snapshot_search(snap, key_filters, sort_by, after, before, with_facets)
+        if found is not None:
+            result, new_counts = found
+        else:
+            # One statement returns the page and, when not cached yet, the
+            # facet counts for this filter combination; paging then reuses
+            # the counts.
+            sql, params = build_search_query(
+                key_filters, sort_by, after=after, before=before, limit=SEARCH_PAGE_SIZE + 1,
+                facets=with_facets,
+            )
+            result = run_query(db.prepare(sql), params, fetch=True)
+            if with_facets:
+                new_counts = next((r[0] for r in result if r[0] is not None), [])
+                result = [r[1:] for r in result if r[1] is not None]
+        if with_facets:
+            counts = new_counts
+            SEARCH_CACHE.set(facets_key, counts, versions)
+        if rows is cache.MISS:
+            rows = result
+            SEARCH_CACHE.set(cache_key, rows, versions)
+    rows = list(rows)
+    more = len(rows) > SEARCH_PAGE_SIZE
+    rows = rows[:SEARCH_PAGE_SIZE]
+    if before is not None:
+        rows.reverse()
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = after is not None, more
+
+    prev_url = next_url = all_url = None
+    if rows and has_prev:
+        first = rows[0]
+        prev_url = "/search?" + urlencode(dict(base_args, before=encode_cursor(first[-1], first[0])))
+    if rows and has_next:
+        last = rows[-1]
+        next_url = "/search?" + urlencode(dict(base_args, after=encode_cursor(last[-1], last[0])))
+    if rows:
+        all_url = "/search?" + urlencode(dict(base_args, stream=1))
+
+    return stream_page(
+        "search.html", rows=rows, prev_url=prev_url, next_url=next_url, all_url=all_url,
+        facets=search_facets(counts, base_args), **page
+    )
 
 # ===========================================================
 # RENTER: MY CARDS
@@ -940,115 +1052,31 @@ def my_cards():
         billing_state = request.form.get("billing_state").strip()
         billing_zip = request.form.get("billing_zip").strip() or None
 
-        run_query(
-            '''
-            INSERT INTO ADDRESS (line_1, city, state_, zip_code)
-            VALUES (%s, %s, %s, %s);
-            ''',
-            (billing_line1, billing_city, billing_state, billing_zip),
-            fetch=False
-        )
-        addr_row = run_query(
-            '''
-            SELECT address_id FROM ADDRESS
-            WHERE line_1 = %s AND city = %s AND state_ = %s
-            ORDER BY address_id DESC LIMIT 1;
-            ''',
-            (billing_line1, billing_city, billing_state),
-            fetch=True
-        )
-        billing_addr_id = addr_row[0][0]
-
-        run_query(
+        run_returning(
             '''
+            WITH billing AS (
+                INSERT INTO ADDRESS (line_1, city, state_, zip_code)
+                VALUES (%s, %s, %s, %s)
+                RETURNING address_id
+            )
             INSERT INTO CARD_DETAILS (renter_id, Card_no, billing_address_id, Name_on_card)
-            VALUES (%s, %s, %s, %s);
+            SELECT %s, %s, address_id, %s FROM billing
+            RETURNING card_id;
             ''',
-            (renter_id, card_no, billing_addr_id, name_on_card),
-            fetch=False
+            (billing_line1, billing_city, billing_state, billing_zip,
+             renter_id, card_no, name_on_card)
         )
 
-    cards = run_query("""
-        SELECT c.card_id, c.card_no, c.name_on_card,
-               a.line_1, a.city, a.state_
-        FROM CARD_DETAILS c
-        JOIN ADDRESS a ON c.billing_address_id = a.address_id
-        WHERE c.renter_id = %s
-        ORDER BY c.card_id;
-    """, (renter_id,), fetch=True)
-
-    rows_html = ""
-    for card in cards:
-        cid, cno, cname, line1, city, state_ = card
-        rows_html += f"""
-        <tr>
-            <td>{cid}</td>
-            <td>{cno}</td>
-            <td>{cname}</td>
-            <td>{line1}, {city}, {state_}</td>
-            <td>
-                <form method="post" action="/delete_card/{cid}" style="display:inline;">
-                    <button type="submit" class="btn btn-sm btn-outline-danger">Delete</button>
-                </form>
-            </td>
-        </tr>
-        """
+    cards = run_query(queries.RENTER_CARDS, (renter_id,), fetch=True)
 
-    return render_page(f"""
-        <h2>My Cards</h2>
-        <div class="row g-3">
-          <div class="col-md-6">
-            <h5>Add New Card</h5>
-            <form method="post">
-                <label class="form-label">Card Number</label>
-                <input type="text" name="card_no" class="form-control" required>
-                <label class="form-label mt-2">Name on Card</label>
-                <input type="text" name="name_on_card" class="form-control" required>
-                <label class="form-label mt-2">Billing Address Line 1</label>
-                <input type="text" name="billing_line1" class="form-control" required>
-                <div class="row mt-2">
-                    <div class="col-md-4">
-                        <label class="form-label">City</label>
-                        <input type="text" name="billing_city" class="form-control" required>
-                    </div>
-                    <div class="col-md-4">
-                        <label class="form-label">State</label>
-                        <input type="text" name="billing_state" class="form-control" required>
-                    </div>
-                    <div class="col-md-4">
-                        <label class="form-label">Zip</label>
-                        <input type="text" name="billing_zip" class="form-control">
-                    </div>
-                </div>
-                <button type="submit" class="btn btn-primary mt-3">Add Card</button>
-            </form>
-          </div>
-          <div class="col-md-6">
-            <h5>Saved Cards</h5>
-            <table class="table table-striped table-bordered align-middle">
-                <thead>
-                    <tr>
-                        <th>ID</th><th>Card No</th><th>Name</th><th>Billing Address</th><th>Action</th>
-                    </tr>
-                </thead>
-                <tbody>
-                    {rows_html if rows_html else '<tr><td colspan="5" class="text-muted">No cards yet.</td></tr>'}
-                </tbody>
-            </table>
-          </div>
-        </div>
-        <a href="/renter_dashboard" class="btn btn-outline-secondary btn-sm mt-2">Back to Renter Dashboard</a>
-    """)
+    return stream_page("my_cards.html", rows=cards)
 
 @app.route("/delete_card/<int:card_id>", methods=["POST"])
 def delete_card(card_id):
     if session.get("role") != "renter":
         return redirect("/login_renter")
 
-    used = run_query(
-        "SELECT 1 FROM BOOKING WHERE card_id = %s LIMIT 1;",
-        (card_id,), fetch=True
-    )
+    used = run_query(queries.CARD_IN_USE, (card_id, card_id), fetch=True)
     if used:
         return render_page("""
             <h2>Delete Card</h2>
@@ -1059,7 +1087,7 @@ def delete_card(card_id):
         """)
 
     run_query(
-        "DELETE FROM CARD_DETAILS WHERE card_id = %s AND renter_id = %s;",
+        queries.DELETE_RENTER_CARD,
         (card_id, session["renter_id"]),
         fetch=False
     )
@@ -1075,60 +1103,51 @@ def book_property(prop_id):
 
     renter_id = session["renter_id"]
 
-    prop_rows = run_query("""
-        SELECT p.prop_id, a.line_1, a.city, a.state_,
-               p.price, pd.rooms, pc.category_name
-        FROM PROPERTY p
-        JOIN ADDRESS a ON p.address_id = a.address_id
-        JOIN PROPERTY_DETAILS pd ON p.prop_id = pd.prop_id
-        JOIN PROPERTY_CATEGORY pc ON pd.property_category_id = pc.property_category_id
-        WHERE p.prop_id = %s;
-    """, (prop_id,), fetch=True)
+    prop_rows = run_query(queries.PROPERTY_FOR_BOOKING, (prop_id,), fetch=True)
     if not prop_rows:
         return "Property not found", 404
 
     pid, line1, city, state_, price, rooms, cat = prop_rows[0]
 
-    cards = run_query("""
-        SELECT card_id, card_no, name_on_card
-        FROM CARD_DETAILS
-        WHERE renter_id = %s
-        ORDER BY card_id;
-    """, (renter_id,), fetch=True)
+    cards = run_query(queries.RENTER_CARD_CHOICES, (renter_id,), fetch=True)
 
     if request.method == "POST":
         card_id = request.form.get("card_id")
-        booking_date = request.form.get("booking_date") or None
-
-        run_query(
-            '''
-            INSERT INTO BOOKING (prop_id, renter_id, card_id, booking_date)
-            VALUES (%s, %s, %s, %s);
-            ''',
-            (prop_id, renter_id, card_id, booking_date),
-            fetch=False
-        )
-
-        b_row = run_query(
-            '''
-            SELECT booking_id FROM BOOKING
-            WHERE prop_id = %s AND renter_id = %s
-            ORDER BY booking_id DESC LIMIT 1;
-            ''',
-            (prop_id, renter_id),
-            fetch=True
-        )
-        booking_id = b_row[0][0]
+        try:
+            check_in, check_out = parse_stay(request.form.get("booking_date") or "",
+                                             request.form.get("checkout_date") or "")
+        except ValueError:
+            return booking_problem(pid, "Please enter a valid check-in date and a later check-out date."), 400
 
         points = int(price) if price is not None else 0
-        run_query(
-            '''
-            INSERT INTO REWARD (booking_id, renter_id, Points)
-            VALUES (%s, %s, %s);
-            ''',
-            (booking_id, renter_id, points),
-            fetch=False
-        )
+        try:
+            run_returning(
+                '''
+                WITH new_booking AS (
+                    INSERT INTO BOOKING (prop_id, renter_id, card_id, booking_date, stay)
+                    VALUES (%s, %s, %s, %s, daterange(%s, %s))
+                    RETURNING booking_id, booking_date, renter_id
+                )
+                INSERT INTO REWARD (booking_id, booking_date, renter_id, Points)
+                SELECT booking_id, booking_date, renter_id, %s FROM new_booking
+                RETURNING booking_id;
+                ''',
+                (prop_id, renter_id, card_id, check_in, check_in, check_out, points)
+            )
+        except psycopg2.errors.ExclusionViolation:
+            # booking_stay_no_overlap: someone holds part of this stay,
+            # possibly a booking committed a moment ago.
+            return booking_problem(
+                pid, f"Property #{pid} is already booked for part of "
+                     f"{check_in:%b %d} – {check_out:%b %d, %Y}. Please pick other dates."
+            ), 409
+        except psycopg2.errors.CheckViolation:
+            # No BOOKING partition holds this check-in: the month is archived
+            # or further ahead than partitions.py has opened.
+            return booking_problem(
+                pid, f"Bookings are not open for {check_in:%B %Y}. Please pick other dates."
+            ), 400
+        db.after_commit(lambda: SEARCH_CACHE.invalidate(["availability"]))
 
         return redirect("/my_bookings")
 
@@ -1157,8 +1176,12 @@ def book_property(prop_id):
         <form method="post">
             <div class="row g-3">
                 <div class="col-md-4">
-                    <label class="form-label">Booking date (YYYY-MM-DD)</label>
-                    <input type="text" name="booking_date" class="form-control">
+                    <label class="form-label">Check-in</label>
+                    <input type="date" name="booking_date" class="form-control" required>
+                </div>
+                <div class="col-md-4">
+                    <label class="form-label">Check-out (default: next day)</label>
+                    <input type="date" name="checkout_date" class="form-control">
                 </div>
                 <div class="col-md-4">
                     <label class="form-label">Payment card</label>
@@ -1172,9 +1195,19 @@ def book_property(prop_id):
         <a href="/search" class="btn btn-outline-secondary btn-sm mt-3">Back to Search</a>
     """)
 
+
+def booking_problem(prop_id, message):
+    return render_page(f"""
+        <h2>Book Property #{prop_id}</h2>
+        <div class="alert alert-danger">{html.escape(message)}</div>
+        <a href="/book/{prop_id}" class="btn btn-outline-secondary btn-sm">Back to Booking</a>
+    """)
+
 # ===========================================================
 # RENTER: MY BOOKINGS
 # ===========================================================
+REWARD_HISTORY_PAGE_SIZE = int(os.environ.get("REWARD_HISTORY_PAGE_SIZE", "20"))
+
 @app.route("/my_bookings")
 def my_bookings():
     if session.get("role") != "renter":
@@ -1182,66 +1215,84 @@ def my_bookings():
 
     renter_id = session["renter_id"]
 
-    rows = run_query("""
-        SELECT b.booking_id, b.booking_date,
-               p.prop_id, a.line_1, a.city, p.price,
-               COALESCE(rw.points, 0)
-        FROM BOOKING b
-        JOIN PROPERTY p ON b.prop_id = p.prop_id
-        JOIN ADDRESS a ON p.address_id = a.address_id
-        LEFT JOIN REWARD rw ON b.booking_id = rw.booking_id
-        WHERE b.renter_id = %s
-        ORDER BY b.booking_id DESC;
-    """, (renter_id,), fetch=True)
-
-    body = ""
-    for row in rows:
-        bid, bdate, pid, line1, city, price, points = row
-        body += f"""
-        <tr>
-            <td>{bid}</td>
-            <td>{bdate}</td>
-            <td>{pid}</td>
-            <td>{line1}, {city}</td>
-            <td>${price}</td>
-            <td>{points}</td>
-            <td>
-                <form method="post" action="/cancel_booking/{bid}" style="display:inline;">
-                    <button type="submit" class="btn btn-sm btn-outline-danger">Cancel</button>
-                </form>
-            </td>
-        </tr>
-        """
-
-    return render_page(f"""
-        <h2>My Bookings</h2>
-        <table class="table table-striped table-bordered align-middle">
-            <thead>
-                <tr>
-                    <th>Booking ID</th><th>Date</th><th>Property ID</th>
-                    <th>Address</th><th>Price</th><th>Reward Points</th><th>Action</th>
-                </tr>
-            </thead>
-            <tbody>
-                {body if body else '<tr><td colspan="7" class="text-muted">No bookings yet.</td></tr>'}
-            </tbody>
-        </table>
-        <a href="/renter_dashboard" class="btn btn-outline-secondary btn-sm mt-2">Back to Renter Dashboard</a>
-    """)
+    balance = run_query(queries.RENTER_REWARD_BALANCE, (renter_id,), fetch=True)
+    try:
+        before = int(request.args.get("history_before") or queries.REWARD_HISTORY_START)
+    except ValueError:
+        before = queries.REWARD_HISTORY_START
+    # One extra row tells whether an older page exists.
+    history = run_query(
+        queries.RENTER_REWARD_HISTORY,
+        (renter_id, before, REWARD_HISTORY_PAGE_SIZE + 1),
+        fetch=True,
+    )
+    older_url = None
+    if len(history) > REWARD_HISTORY_PAGE_SIZE:
+        history = history[:REWARD_HISTORY_PAGE_SIZE]
+        older_url = f"/my_bookings?history_before={history[-1][0]}#rewards"
+
+    context = history_context()
+    since = bookings_since(context["history_mode"])
+    archived, archive_more = [], False
+    if context["archive_mode"]:
+        found, archive_more = archived_bookings(renter=renter_id)
+        props = {row[0]: row for row in run_query(
+            queries.PROPERTY_SUMMARIES, (list({int(row["prop_id"]) for row in found}),),
+            fetch=True)}
+        for row in found:
+            pid = int(row["prop_id"])
+            # The listing may have been deleted since.
+            _, line1, city, price = props.get(pid, (pid, "-", "-", "-"))
+            archived.append((row["booking_id"], row["booking_date"], pid, line1, city, price,
+                             row["points"] or 0))
+    rows = db.iter_rows(queries.RENTER_BOOKINGS, (since, renter_id, since))
+    return stream_page(
+        "my_bookings.html",
+        rows=rows,
+        since=since,
+        archived=archived,
+        archive_more=archive_more,
+        **context,
+        reward_balance=balance[0][0] if balance else 0,
+        history=history,
+        older_url=older_url,
+        latest_url="/my_bookings#rewards" if before != queries.REWARD_HISTORY_START else None,
+    )
 
 @app.route("/cancel_booking/<int:booking_id>", methods=["POST"])
 def cancel_booking(booking_id):
     if session.get("role") != "renter":
         return redirect("/login_renter")
 
-    run_query("DELETE FROM REWARD WHERE booking_id = %s;", (booking_id,), fetch=False)
+    run_query(queries.DELETE_BOOKING_REWARD, (booking_id, session["renter_id"], booking_id),
+              fetch=False)
     run_query(
-        "DELETE FROM BOOKING WHERE booking_id = %s AND renter_id = %s;",
-        (booking_id, session["renter_id"]),
+        queries.DELETE_RENTER_BOOKING,
+        (booking_id, session["renter_id"], booking_id),
         fetch=False
     )
+    db.after_commit(lambda: SEARCH_CACHE.invalidate(["availability"]))
     return redirect("/my_bookings")
 
+# ===========================================================
+# CACHE STATS
+# ===========================================================
+# Internal: cache keys, counters and replica state, for agents and the
+# METRICS_TOKEN bearer only, like /metrics.
+@app.route("/cache_stats")
+def cache_stats():
+    if not metrics.authorized():
+        abort(404)
+    return jsonify(dict(
+        cache.stats(),
+        listing_snapshot=snapshot.stats(),
+        change_feed={"events": db.changes_received, "reconnects": db.listener_reconnects,
+                     "live": db.change_feed_live()},
+        prepared_statements=db.prepared_stats(),
+        replicas=db.replica_stats(),
+        admission=admission.stats(),
+    ))
+
 # ===========================================================
 # MAIN
 # ===========================================================
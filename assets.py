@@ -0,0 +1,192 @@
+"""Fingerprinted static assets and compressed HTML responses.
+
+Static files under static/ are served from ``/assets/<name>.<hash>.<ext>``
+with a year-long ``immutable`` Cache-Control: the hash changes whenever the
+file does, so browsers never revalidate and never see a stale file.
+``python assets.py`` writes gzip (and, when the optional ``brotli`` package
+is installed, brotli) variants next to each file; they are served as-is to
+clients that accept them.
+
+HTML / text responses at least COMPRESS_MIN_SIZE bytes long are compressed
+on the fly, including streamed pages, which are compressed chunk by chunk
+with a sync flush so rows still reach the browser as they are rendered.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import sys
+import zlib
+
+from flask import abort, request, send_file
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+ASSET_MAX_AGE = 365 * 24 * 3600
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", "6"))
+COMPRESSIBLE_TYPES = ("text/html", "text/css", "text/plain", "application/json",
+                      "application/javascript")
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))
+
+_fingerprints = {}
+_static_files = None
+
+
+def static_files():
+    """{name: path} of every file under static/, listed once per worker.
+
+    Only these are ever served: a requested name is looked up here, never
+    joined onto STATIC_DIR, so "../" tricks cannot reach other files.
+    """
+    global _static_files
+    if _static_files is None:
+        found = {}
+        for root, _, files in os.walk(STATIC_DIR):
+            for filename in files:
+                if filename.endswith((".gz", ".br")):
+                    continue
+                path = os.path.join(root, filename)
+                found[os.path.relpath(path, STATIC_DIR).replace(os.sep, "/")] = path
+        _static_files = found
+    return _static_files
+
+
+def fingerprint(name):
+    """Short content hash of static/<name>, computed once per worker."""
+    digest = _fingerprints.get(name)
+    if digest is None:
+        with open(os.path.join(STATIC_DIR, name), "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:12]
+        _fingerprints[name] = digest
+    return digest
+
+
+def asset_url(name):
+    """Versioned URL for static/<name>, e.g. /assets/css/app.3f2a9c1b0d4e.css."""
+    base, ext = os.path.splitext(name)
+    return f"/assets/{base}.{fingerprint(name)}{ext}"
+
+
+def _accepts(encoding):
+    return encoding in request.headers.get("Accept-Encoding", "").lower()
+
+
+def serve_asset(filename):
+    base, ext = os.path.splitext(filename)
+    base, _, digest = base.rpartition(".")
+    name = base + ext
+    path = static_files().get(name)
+    if path is None or digest != fingerprint(name):
+        abort(404)
+
+    # A variant older than its source was left over from a previous build.
+    encoding = None
+    for candidate, suffix in PRECOMPRESSED:
+        variant = path + suffix
+        if (_accepts(candidate) and os.path.isfile(variant)
+                and os.path.getmtime(variant) >= os.path.getmtime(path)):
+            encoding, path = candidate, variant
+            break
+
+    mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    response = send_file(path, mimetype=mimetype, max_age=ASSET_MAX_AGE, etag=False)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+# ===========================================================
+# RESPONSE COMPRESSION
+# ===========================================================
+def _gzip_stream(chunks):
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _brotli_stream(chunks):
+    compressor = brotli.Compressor(quality=5)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = compressor.process(chunk) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def compress_response(response):
+    """after_request hook: gzip/brotli-encode text responses."""
+    if (
+        response.status_code < 200
+        or response.status_code in (204, 304)
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_TYPES
+    ):
+        return response
+
+    use_brotli = brotli is not None and _accepts("br")
+    if not use_brotli and not _accepts("gzip"):
+        return response
+
+    if response.is_streamed:
+        # Size unknown up front; streamed pages are the large ones anyway.
+        stream = _brotli_stream if use_brotli else _gzip_stream
+        response.response = stream(response.response)
+        response.headers.pop("Content-Length", None)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_SIZE:
+            return response
+        if use_brotli:
+            response.set_data(brotli.compress(body, quality=5))
+        else:
+            response.set_data(gzip.compress(body, COMPRESS_LEVEL, mtime=0))
+    response.headers["Content-Encoding"] = "br" if use_brotli else "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def init_app(app):
+    app.add_url_rule("/assets/<path:filename>", "asset", serve_asset)
+    app.jinja_env.globals["asset_url"] = asset_url
+    app.after_request(compress_response)
+
+
+# ===========================================================
+# BUILD: precompressed variants
+# ===========================================================
+def build(out=sys.stdout):
+    """Write .gz (and .br when available) next to every static file."""
+    for root, _, files in os.walk(STATIC_DIR):
+        for filename in files:
+            if filename.endswith((".gz", ".br")):
+                continue
+            path = os.path.join(root, filename)
+            with open(path, "rb") as f:
+                data = f.read()
+            with open(path + ".gz", "wb") as f:
+                f.write(gzip.compress(data, 9, mtime=0))
+            if brotli is not None:
+                with open(path + ".br", "wb") as f:
+                    f.write(brotli.compress(data, quality=11))
+            name = os.path.relpath(path, STATIC_DIR)
+            print(f"{name}: {len(data)} bytes -> {asset_url(name)}", file=out)
+
+
+if __name__ == "__main__":
+    build()
@@ -0,0 +1,404 @@
+"""Route-level load benchmark with regression gates.
+
+Starts the app under gunicorn (or targets a running server with --url) and
+drives scripted journeys from --concurrency virtual users for --duration
+seconds:
+
+    renter: login -> search (random filters) -> book page -> book -> my_bookings
+    agent:  login -> agent_dashboard -> new property form -> add property
+            -> agent_bookings -> agent_analytics
+
+For every route it reports throughput, p50/p95/p99 latency and the average
+number of SQL statements per request, taken from the app's own metrics
+(see metrics.py). Run it against a scratch database filled by datagen.py:
+the journeys create bookings and properties (use --read-only to skip the
+write steps).
+
+Usage:
+    python bench/loadbench.py --concurrency 16 --duration 60 --save bench/baseline.json
+    python bench/loadbench.py --compare bench/baseline.json --tolerance 0.15
+
+With --compare the run exits non-zero when a route's p95 or p99 latency
+grows, or its throughput shrinks, by more than --tolerance (a fraction), or
+when it issues more than --statement-tolerance extra statements per request.
+"""
+import argparse
+import glob
+import http.client
+import http.cookiejar
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import date, timedelta
+
+APP_DIR = os.environ.get("BENCH_APP_DIR") or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import db  # noqa: E402
+
+CITIES = ["Chicago", "New York", "Los Angeles", "Houston", "Austin", "Seattle", "Evanston", ""]
+CATEGORIES = ["", "", "HOUSE", "APARTMENT"]
+SORTS = ["price", "price", "rooms", "city"]
+BOOK_LINK = re.compile(r'href="/book/(\d+)"')
+CARD_OPTION = re.compile(r'<option value="(\d+)"')
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Each hop is timed as its own route, so redirects are not followed.
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+        self.recording = False
+
+    def add(self, route, seconds, ok):
+        if not self.recording:
+            return
+        with self.lock:
+            self.latencies[route].append(seconds)
+            if not ok:
+                self.errors[route] += 1
+
+
+class VirtualUser:
+    def __init__(self, base_url, recorder, rng):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.rng = rng
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect)
+
+    def request(self, route, path, form=None):
+        """Fetch path (POSTing form if given), record it under route, return the body."""
+        data = urllib.parse.urlencode(form).encode() if form is not None else None
+        start = time.perf_counter()
+        try:
+            with self.opener.open(self.base_url + path, data, timeout=30) as response:
+                body = response.read().decode("utf-8", "replace")
+            ok = True
+        except urllib.error.HTTPError as exc:
+            body = exc.read().decode("utf-8", "replace")
+            # 409: the stay was taken by a concurrent booking, a valid outcome.
+            ok = exc.code in (301, 302, 303, 409)
+        except (OSError, http.client.HTTPException):
+            body, ok = "", False
+        self.recorder.add(route, time.perf_counter() - start, ok)
+        return body
+
+    def search_params(self):
+        rng = self.rng
+        params = {"city": rng.choice(CITIES), "category": rng.choice(CATEGORIES),
+                  "sort_by": rng.choice(SORTS)}
+        if rng.random() < 0.5:
+            low = rng.choice([500, 1000, 1500])
+            params.update(min_price=low, max_price=low + rng.choice([500, 1000, 3000]))
+        if rng.random() < 0.3:
+            params["rooms"] = rng.randint(1, 4)
+        return params
+
+    def renter_journey(self, email, write):
+        self.request("POST /login_renter", "/login_renter", {"email": email})
+        check_in = date.today() + timedelta(days=self.rng.randint(1, 365))
+        check_out = check_in + timedelta(days=self.rng.randint(1, 7))
+        params = self.search_params()
+        if self.rng.random() < 0.3:
+            params.update(available_from=check_in.isoformat(), available_to=check_out.isoformat())
+        page = self.request("GET /search", "/search?" + urllib.parse.urlencode(
+            {k: v for k, v in params.items() if v != ""}))
+        props = BOOK_LINK.findall(page)
+        if props:
+            prop_id = self.rng.choice(props)
+            page = self.request("GET /book/<id>", f"/book/{prop_id}")
+            cards = CARD_OPTION.findall(page)
+            if write and cards:
+                self.request("POST /book/<id>", f"/book/{prop_id}", {
+                    "card_id": self.rng.choice(cards),
+                    "booking_date": check_in.isoformat(),
+                    "checkout_date": check_out.isoformat(),
+                })
+        self.request("GET /my_bookings", "/my_bookings")
+
+    def agent_journey(self, email, write):
+        self.request("POST /login_agent", "/login_agent", {"email": email})
+        self.request("GET /agent_dashboard", "/agent_dashboard")
+        self.request("GET /agent/property/new", "/agent/property/new")
+        if write:
+            rooms = self.rng.randint(1, 5)
+            self.request("POST /agent/property/new", "/agent/property/new", {
+                "line_1": f"{self.rng.randint(1, 9999)} Bench Street",
+                "city": self.rng.choice(CITIES[:-1]), "state_": "Illinois", "zip_code": "60601",
+                "sq_ft": rooms * 400, "price": self.rng.randint(800, 4000), "rooms": rooms,
+                "category": self.rng.choice(CATEGORIES[2:]), "description": "Load test listing",
+            })
+        self.request("GET /agent_bookings", "/agent_bookings")
+        self.request("GET /agent_analytics", "/agent_analytics")
+
+
+# Route label -> (Flask endpoint, method) in the app's metrics.
+ENDPOINTS = {
+    "POST /login_renter": ("login_renter", "POST"),
+    "GET /search": ("search", "GET"),
+    "GET /book/<id>": ("book_property", "GET"),
+    "POST /book/<id>": ("book_property", "POST"),
+    "GET /my_bookings": ("my_bookings", "GET"),
+    "POST /login_agent": ("login_agent", "POST"),
+    "GET /agent_dashboard": ("agent_dashboard", "GET"),
+    "GET /agent/property/new": ("agent_new_property", "GET"),
+    "POST /agent/property/new": ("agent_new_property", "POST"),
+    "GET /agent_bookings": ("agent_bookings", "GET"),
+    "GET /agent_analytics": ("agent_analytics", "GET"),
+}
+
+
+def bench_accounts(limit):
+    """Emails of existing renters that own a card, and of agents."""
+    conn = db.get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT u.email FROM RENTER r JOIN "USER" u ON u.user_id = r.user_id
+                WHERE EXISTS (SELECT 1 FROM CARD_DETAILS c WHERE c.renter_id = r.renter_id)
+                ORDER BY r.renter_id LIMIT %s;
+            """, (limit,))
+            renters = [row[0] for row in cur.fetchall()]
+            cur.execute("""
+                SELECT u.email FROM AGENT a JOIN "USER" u ON u.user_id = a.user_id
+                ORDER BY a.agent_id LIMIT %s;
+            """, (limit,))
+            agents = [row[0] for row in cur.fetchall()]
+    finally:
+        conn.close()
+    if not renters or not agents:
+        raise SystemExit("need at least one renter with a card and one agent (see datagen.py)")
+    return renters, agents
+
+
+def worker_loop(base_url, recorder, seed, args, renters, agents, stop):
+    rng = random.Random(seed)
+    user = VirtualUser(base_url, recorder, rng)
+    while not stop.is_set():
+        if rng.random() < args.agent_share:
+            user.agent_journey(rng.choice(agents), not args.read_only)
+        else:
+            user.renter_journey(rng.choice(renters), not args.read_only)
+
+
+# ===========================================================
+# SERVER AND STATEMENT COUNTS
+# ===========================================================
+def start_server(args, metrics_dir):
+    env = dict(os.environ, METRICS_DIR=metrics_dir)
+    cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app",
+           "--bind", f"127.0.0.1:{args.port}", "--workers", str(args.workers),
+           "--threads", str(args.threads), "--log-level", "warning"]
+    server = subprocess.Popen(cmd, cwd=APP_DIR, env=env)
+    url = f"http://127.0.0.1:{args.port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url + "/", timeout=1).close()
+            return server, url
+        except OSError:
+            if server.poll() is not None:
+                raise SystemExit("gunicorn exited during startup")
+            time.sleep(0.2)
+    server.terminate()
+    raise SystemExit("gunicorn did not start within 30s")
+
+
+def _statement_totals(samples):
+    totals = {}
+    for (endpoint, method), (total, count) in samples:
+        previous = totals.get((endpoint, method), (0, 0))
+        totals[(endpoint, method)] = (previous[0] + total, previous[1] + count)
+    return totals
+
+
+def statements_from_snapshots(metrics_dir):
+    """{(endpoint, method): (statements, requests)} from the workers' snapshots."""
+    samples = []
+    for path in glob.glob(os.path.join(metrics_dir, "worker-*.json")):
+        with open(path) as f:
+            metric = json.load(f).get("werent_db_queries_per_request", {})
+        for labels, counts in metric.get("samples", []):
+            samples.append((tuple(labels), (counts[-1], sum(counts[:-1]))))
+    return _statement_totals(samples)
+
+
+def statements_from_endpoint(base_url):
+    """The same totals scraped from a running server's /metrics."""
+    scrape = urllib.request.Request(base_url + "/metrics")
+    if os.environ.get("METRICS_TOKEN"):
+        scrape.add_header("Authorization", "Bearer " + os.environ["METRICS_TOKEN"])
+    text = urllib.request.urlopen(scrape, timeout=10).read().decode()
+    pattern = re.compile(r'^werent_db_queries_per_request_(sum|count)'
+                         r'\{endpoint="([^"]*)",method="([^"]*)"\} (\S+)$', re.M)
+    values = defaultdict(lambda: [0.0, 0.0])
+    for kind, endpoint, method, value in pattern.findall(text):
+        values[(endpoint, method)][0 if kind == "sum" else 1] += float(value)
+    return _statement_totals((k, tuple(v)) for k, v in values.items())
+
+
+# ===========================================================
+# REPORTING AND COMPARISON
+# ===========================================================
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    rank = math.ceil(fraction * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def summarize(recorder, elapsed, before, after):
+    routes = {}
+    for route, values in sorted(recorder.latencies.items()):
+        values.sort()
+        key = ENDPOINTS.get(route)
+        statements = None
+        if key is not None:
+            total = after.get(key, (0, 0))[0] - before.get(key, (0, 0))[0]
+            count = after.get(key, (0, 0))[1] - before.get(key, (0, 0))[1]
+            statements = round(total / count, 2) if count else None
+        routes[route] = {
+            "requests": len(values),
+            "errors": recorder.errors[route],
+            "rps": round(len(values) / elapsed, 2),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+            "statements": statements,
+        }
+    return routes
+
+
+def print_report(routes, out=sys.stdout):
+    print(f"{'route':26} {'reqs':>7} {'err':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'stmts':>6}", file=out)
+    for route, r in routes.items():
+        statements = "-" if r["statements"] is None else f"{r['statements']:.2f}"
+        print(f"{route:26} {r['requests']:7} {r['errors']:5} {r['rps']:8.1f} {r['p50_ms']:8.1f} "
+              f"{r['p95_ms']:8.1f} {r['p99_ms']:8.1f} {statements:>6}", file=out)
+
+
+def compare(routes, baseline, tolerance, statement_tolerance):
+    """Return a list of human-readable regressions against a baseline run."""
+    failures = []
+    for route, old in baseline["routes"].items():
+        new = routes.get(route)
+        if new is None:
+            failures.append(f"{route}: not exercised in this run")
+            continue
+        for field in ("p95_ms", "p99_ms"):
+            if new[field] > old[field] * (1 + tolerance):
+                failures.append(f"{route}: {field} {old[field]} -> {new[field]}")
+        if new["rps"] < old["rps"] * (1 - tolerance):
+            failures.append(f"{route}: rps {old['rps']} -> {new['rps']}")
+        if (new["statements"] is not None and old["statements"] is not None
+                and new["statements"] > old["statements"] + statement_tolerance):
+            failures.append(f"{route}: statements/request {old['statements']} -> {new['statements']}")
+        if new["errors"] > old["errors"]:
+            failures.append(f"{route}: errors {old['errors']} -> {new['errors']}")
+    return failures
+
+
+def run(args):
+    renters, agents = bench_accounts(args.accounts)
+    metrics_dir = tempfile.mkdtemp(prefix="loadbench-metrics-")
+    server = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        server, base_url = start_server(args, metrics_dir)
+
+    recorder = Recorder()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=worker_loop, daemon=True,
+                         args=(base_url, recorder, args.seed + n, args, renters, agents, stop))
+        for n in range(args.concurrency)
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        time.sleep(args.warmup)
+        before = statements_from_endpoint(base_url) if args.url else statements_from_snapshots(metrics_dir)
+        recorder.recording = True
+        started = time.monotonic()
+        time.sleep(args.duration)
+        recorder.recording = False
+        elapsed = time.monotonic() - started
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=35)
+        if args.url:
+            after = statements_from_endpoint(base_url)
+    finally:
+        if server is not None:
+            # Workers write their final metrics snapshot on exit.
+            server.terminate()
+            server.wait(timeout=30)
+    if not args.url:
+        after = statements_from_snapshots(metrics_dir)
+
+    routes = summarize(recorder, elapsed, before, after)
+    result = {
+        "meta": {"concurrency": args.concurrency, "duration": args.duration,
+                 "workers": args.workers, "threads": args.threads, "read_only": args.read_only,
+                 "seed": args.seed, "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "routes": routes,
+    }
+    print_report(routes)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"saved {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            failures = compare(routes, json.load(f), args.tolerance, args.statement_tolerance)
+        for failure in failures:
+            print("REGRESSION", failure)
+        if failures:
+            return 1
+        print(f"no regressions against {args.compare}")
+    return 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="benchmark a running server instead of starting gunicorn")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=4, help="threads per gunicorn worker")
+    parser.add_argument("--concurrency", type=int, default=16, help="virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="unmeasured seconds first")
+    parser.add_argument("--agent-share", type=float, default=0.2,
+                        help="fraction of journeys that are agent journeys")
+    parser.add_argument("--accounts", type=int, default=1000,
+                        help="distinct renter and agent accounts to log in as")
+    parser.add_argument("--read-only", action="store_true", help="skip booking / adding properties")
+    parser.add_argument("--seed", type=int, default=425)
+    parser.add_argument("--save", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", help="baseline JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    parser.add_argument("--statement-tolerance", type=float, default=0.5)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(run(parse_args(sys.argv[1:])))
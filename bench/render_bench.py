@@ -0,0 +1,123 @@
+"""Micro-benchmark of page rendering, isolated from the database.
+
+The db layer is replaced by an in-memory fake that returns N synthetic rows
+for every SELECT, so the numbers measure only what the app does in Python:
+building HTML and rendering the layout. Each page is requested through the
+Flask test client and its body is consumed chunk by chunk, the way a WSGI
+server writes it out, so peak memory reflects what a worker really holds.
+
+Usage:
+    python bench/render_bench.py [--rows 5000] [--repeat 50]
+
+Set BENCH_APP_DIR to a checkout of another revision to benchmark that
+revision's app.py with the same harness.
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+
+sys.path.insert(0, os.environ.get("BENCH_APP_DIR") or os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+
+def fake_rows(sql, n):
+    if "FROM BOOKING b" in sql and "u.email" in sql:
+        row = (1, datetime.date(2025, 1, 1), 7, "123 Main St", "Chicago", Decimal("1500.00"), "renter@example.com")
+    elif "FROM BOOKING b" in sql:
+        row = (1, datetime.date(2025, 1, 1), 7, "123 Main St", "Chicago", Decimal("1500.00"), 1500)
+    elif "FROM PROPERTY_ROLLUP" in sql:
+        row = (7, "Chicago", 12, 30, Decimal("18000.00"))
+    elif "FROM CARD_DETAILS c" in sql:
+        row = (1, "4111111111111111", "Jane Doe", "123 Main St", "Chicago", "IL")
+    elif "pc.category_name, pd.rooms" in sql and "sort_key" not in sql:
+        row = (7, "123 Main St", "Chicago", "IL", Decimal("1500.00"), "APARTMENT", 2)
+    elif "FROM PROPERTY p" in sql:
+        row = (7, "123 Main St", "Chicago", "IL", Decimal("1500.00"), 2, "APARTMENT", None, Decimal("1500.00"))
+    elif "PROPERTY_CATEGORY" in sql:
+        return [(1, "APARTMENT"), (2, "HOUSE"), (3, "COMMERCIAL"), (4, "LAND")]
+    else:
+        return []
+    if "facet_counts" in sql:
+        counts = [["category", "APARTMENT", n], ["rooms", "2", n], ["price", "1", n], ["city", "Chicago", n]]
+        return [(counts,) + row] + [(None,) + row] * (n - 1)
+    return [row] * n
+
+
+def install_fake_db(n):
+    def _execute(sql, params, fetch):
+        class Cursor:
+            rows = fake_rows(sql, n)
+
+            def fetchall(self):
+                return list(self.rows)
+
+            def fetchone(self):
+                return self.rows[0] if self.rows else None
+        return fetch(Cursor())
+
+    def stream_query(sql, params=(), chunk_size=500):
+        rows = fake_rows(sql, n)
+        for i in range(0, len(rows), chunk_size):
+            yield rows[i:i + chunk_size]
+
+    db._execute = _execute
+    db.stream_query = stream_query
+    db.begin = db.end = db.commit = db.rollback = lambda *args, **kwargs: None
+
+
+PAGES = [
+    ("renter", "/search"),
+    ("renter", "/search?stream=1"),
+    ("renter", "/my_bookings"),
+    ("renter", "/my_cards"),
+    ("agent", "/agent_dashboard"),
+    ("agent", "/agent_bookings"),
+    ("agent", "/agent_analytics"),
+]
+
+
+def fetch(client, url):
+    """GET url and consume the body; return its size in bytes."""
+    response = client.get(url, buffered=False)
+    size = 0
+    for chunk in response.response:
+        size += len(chunk)
+    response.close()
+    return size
+
+
+def run(rows, repeat):
+    install_fake_db(rows)
+    import app as webapp
+    webapp.SEARCH_CACHE.ttl = webapp.SEARCH_CACHE.local.ttl = 0  # always render from "db" rows
+    client = webapp.app.test_client()
+    print(f"{'page':28} {'ms/request':>10} {'peak KiB':>10} {'KiB out':>8}")
+    for role, url in PAGES:
+        with client.session_transaction() as s:
+            s.clear()
+            s["role"] = role
+            s["renter_id"] = s["agent_id"] = 1
+            s["renter_name"] = s["agent_name"] = "Bench"
+        size = fetch(client, url)  # warm-up
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fetch(client, url)
+        elapsed = (time.perf_counter() - start) / repeat * 1000
+        tracemalloc.start()
+        fetch(client, url)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{url:28} {elapsed:10.2f} {peak / 1024:10.0f} {size / 1024:8.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+    run(args.rows, args.repeat)
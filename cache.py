@@ -0,0 +1,279 @@
+"""Result caching with tag-based invalidation.
+
+A ``TaggedCache`` has an in-process LRU tier and, optionally, a shared tier
+in a local SQLite file that every gunicorn worker on the host opens. Each
+entry is stored together with the version of every tag it depends on;
+invalidating a tag bumps its version, and an entry whose tag versions no
+longer match is treated as a miss. With the shared tier enabled the tag
+versions live in the shared file too, so an invalidation in one worker is
+seen by all of them on their next lookup. Without it, another worker's
+write reaches this worker's tier only if something broadcasts it (the
+app's change feed); ``live`` tells the cache whether that is happening,
+and while it is not the in-process tier is bypassed.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+MISS = object()
+
+# Every entry also depends on this tag, so invalidate_all() is as safe
+# against concurrent readers as any other invalidation.
+ALL_TAG = "*"
+
+# Every cache created through TaggedCache, for stats reporting.
+_registry = {}
+
+# Lookup observers (e.g. tracing): callback(cache_name, result, seconds),
+# result being "hit", "shared_hit" or "miss".
+_hooks = []
+
+
+def add_hook(callback):
+    _hooks.append(callback)
+
+
+class LRUCache:
+    """Bounded, thread-safe in-process LRU with a per-entry TTL."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return MISS
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return MISS
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteTier:
+    """Cache entries and tag versions shared through a local SQLite file.
+
+    SQLite in WAL mode gives cross-process atomicity without running a
+    server; it stands in for a shared cache such as a local Redis.
+    """
+
+    PRUNE_EVERY = 200
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._sets = 0
+        conn = self._conn()
+        conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS entries (
+                key       TEXT PRIMARY KEY,
+                value     BLOB NOT NULL,
+                expires   REAL NOT NULL,
+                stored_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS tag_versions (
+                tag     TEXT PRIMARY KEY,
+                version INTEGER NOT NULL
+            );
+        """)
+
+    def _conn(self):
+        # One connection per thread and per process: sqlite handles must
+        # not cross threads or survive a fork.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute(
+            "SELECT value FROM entries WHERE key = ? AND expires > ?;",
+            (key, time.time()),
+        ).fetchone()
+        return MISS if row is None else pickle.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, value, expires, stored_at) VALUES (?, ?, ?, ?);",
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), now + ttl, now),
+        )
+        self._sets += 1
+        if self._sets % self.PRUNE_EVERY == 0:
+            conn.execute("DELETE FROM entries WHERE expires <= ?;", (now,))
+            conn.execute(
+                "DELETE FROM entries WHERE key NOT IN "
+                "(SELECT key FROM entries ORDER BY stored_at DESC LIMIT ?);",
+                (self.max_entries,),
+            )
+
+    def tag_versions(self, tags):
+        if not tags:
+            return {}
+        marks = ",".join("?" * len(tags))
+        rows = self._conn().execute(
+            f"SELECT tag, version FROM tag_versions WHERE tag IN ({marks});", tuple(tags)
+        ).fetchall()
+        versions = dict.fromkeys(tags, 0)
+        versions.update(rows)
+        return versions
+
+    def bump(self, tags):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            for tag in tags:
+                conn.execute(
+                    "INSERT INTO tag_versions (tag, version) VALUES (?, 1) "
+                    "ON CONFLICT(tag) DO UPDATE SET version = version + 1;",
+                    (tag,),
+                )
+            conn.execute("COMMIT;")
+        except Exception:
+            conn.execute("ROLLBACK;")
+            raise
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM entries;")
+
+
+class TaggedCache:
+    """Two-tier cache whose entries are invalidated by tag."""
+
+    def __init__(self, name, max_entries=1024, ttl=60, shared_path=None, live=None):
+        self.name = name
+        self.ttl = ttl
+        self.local = LRUCache(max_entries, ttl)
+        self.shared = SQLiteTier(shared_path, max_entries) if shared_path else None
+        self.live = live
+        self.bypassed = 0
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        _registry[name] = self
+
+    def tag_versions(self, tags):
+        """Current version of each tag; snapshot this *before* reading the
+        database so a concurrent invalidation makes the stored entry stale."""
+        tags = list(tags) + [ALL_TAG]
+        if self.shared is not None:
+            return self.shared.tag_versions(tags)
+        with self._lock:
+            return {tag: self._versions.get(tag, 0) for tag in tags}
+
+    def _fresh(self, entry):
+        versions, _ = entry
+        return versions == self.tag_versions(list(versions))
+
+    def get(self, key):
+        start = time.perf_counter()
+        result, value = self._lookup(key)
+        for callback in _hooks:
+            callback(self.name, result, time.perf_counter() - start)
+        return value
+
+    def _usable(self):
+        """Whether entries may be served: always with the shared tier, whose
+        tag versions every worker bumps, otherwise only while ``live``."""
+        return self.shared is not None or self.live is None or self.live()
+
+    def _lookup(self, key):
+        if not self._usable():
+            self.bypassed += 1
+            self.misses += 1
+            return "miss", MISS
+        entry = self.local.get(key)
+        if entry is not MISS and self._fresh(entry):
+            self.hits += 1
+            return "hit", entry[1]
+        if self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not MISS and self._fresh(entry):
+                self.local.set(key, entry)
+                self.shared_hits += 1
+                return "shared_hit", entry[1]
+        self.misses += 1
+        return "miss", MISS
+
+    def set(self, key, value, versions):
+        """Store ``value`` under the tag ``versions`` captured before it was read."""
+        entry = (versions, value)
+        if not self._usable():
+            return
+        self.local.set(key, entry)
+        if self.shared is not None:
+            self.shared.set(key, entry, self.ttl)
+
+    def invalidate(self, tags):
+        tags = sorted(set(tags))
+        if self.shared is not None:
+            self.shared.bump(tags)
+        with self._lock:
+            for tag in tags:
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+        self.invalidations += 1
+
+    def invalidate_all(self):
+        """Invalidate every entry, e.g. after missing change notifications."""
+        self.invalidate([ALL_TAG])
+        self.clear()
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "evictions": self.local.evictions,
+            "bypassed": self.bypassed,
+            "entries": len(self.local),
+        }
+
+
+def stats():
+    """Counters of every registered cache, keyed by cache name."""
+    return {name: c.stats() for name, c in _registry.items()}
@@ -0,0 +1,498 @@
+"""Production-scale synthetic data, bulk-loaded with COPY.
+
+Generates USER, ADDRESS, AGENT, RENTER, PROPERTY, PROPERTY_DETAILS,
+CARD_DETAILS, BOOKING and REWARD rows with realistic skew:
+
+* cities follow a Zipf distribution, so a few hot cities hold most
+  listings and prices scale with the city;
+* listings per agent and bookings per property and per renter follow
+  power laws (--agent-skew, --booking-skew, --renter-skew);
+* each property's stays never overlap (migration 0004 rejects overlaps):
+  its bookings get disjoint slots of the booking period, so a property
+  holds at most one booking per two days of it;
+* every booking is paid with one of the renter's own cards and earns
+  ``int(price)`` reward points, exactly like /book;
+* the loaders' sessions set ``werent.bulk_load``, so the reward balance
+  trigger (migration 0005) and the analytics rollup trigger (0006) skip
+  their COPY chunks (see 0008): they would fire for every chunk, and the
+  parallel loaders would queue on the same balance and rollup rows. Other
+  sessions keep the triggers. Balances and rollups are then computed
+  once, set-based, by ``rewards.py --fix`` and ``rollups.py refresh``, so
+  each renter's ledger gets one ``adjustment`` entry for the generated
+  bookings;
+* the monthly BOOKING / REWARD partitions (migration 0007) are created
+  for the whole booking period before loading.
+
+Rows get explicit ids above the current maximum of each table (or from 1
+with --truncate), so nothing depends on sequence round trips and parallel
+loaders never collide; the sequences are moved past the new ids at the end.
+Each table is split into chunks that ``--workers`` processes stream into
+the database through ``COPY ... FROM STDIN`` on their own connections.
+Tables load in foreign-key order, so referential integrity holds
+throughout.
+
+Usage:
+    python datagen.py --bookings 10000000 --properties 200000 --renters 500000
+    python datagen.py --truncate --seed 7       # replace all existing data
+"""
+import argparse
+import bisect
+import multiprocessing
+import os
+import random
+import sys
+import time
+from array import array
+from datetime import date, timedelta
+from itertools import accumulate
+
+import rewards
+import rollups
+from db import get_connection
+
+# (city, state, zip prefix, price factor), most popular first.
+CITIES = [
+    ("Chicago", "Illinois", "606", 1.00), ("New York", "New York", "100", 1.80),
+    ("Los Angeles", "California", "900", 1.60), ("Houston", "Texas", "770", 0.75),
+    ("Phoenix", "Arizona", "850", 0.80), ("Philadelphia", "Pennsylvania", "191", 0.85),
+    ("San Antonio", "Texas", "782", 0.70), ("San Diego", "California", "921", 1.50),
+    ("Dallas", "Texas", "752", 0.85), ("Austin", "Texas", "787", 1.10),
+    ("San Jose", "California", "951", 1.90), ("Seattle", "Washington", "981", 1.45),
+    ("Denver", "Colorado", "802", 1.10), ("Boston", "Massachusetts", "021", 1.55),
+    ("Nashville", "Tennessee", "372", 0.90), ("Portland", "Oregon", "972", 1.05),
+    ("Atlanta", "Georgia", "303", 0.90), ("Miami", "Florida", "331", 1.20),
+    ("Minneapolis", "Minnesota", "554", 0.85), ("Detroit", "Michigan", "482", 0.60),
+    ("Naperville", "Illinois", "605", 0.95), ("Evanston", "Illinois", "602", 1.05),
+    ("Aurora", "Illinois", "605", 0.75), ("Oak Park", "Illinois", "603", 0.95),
+    ("Madison", "Wisconsin", "537", 0.80), ("Columbus", "Ohio", "432", 0.70),
+    ("Indianapolis", "Indiana", "462", 0.65), ("Kansas City", "Missouri", "641", 0.65),
+    ("Raleigh", "North Carolina", "276", 0.85), ("Salt Lake City", "Utah", "841", 0.90),
+]
+STREETS = ["Oak", "Maple", "Cedar", "Lake", "River", "Park", "Main", "Elm", "Washington",
+           "Lincoln", "Hill", "Pine", "Sunset", "Church", "Spring", "Highland"]
+FIRST_NAMES = ["James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael", "Linda",
+               "David", "Elizabeth", "William", "Barbara", "Priya", "Wei", "Carlos", "Aisha",
+               "Noah", "Olivia", "Liam", "Emma", "Arjun", "Sofia", "Mateo", "Fatima"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis",
+              "Rodriguez", "Martinez", "Patel", "Nguyen", "Kim", "Chen", "Lopez", "Wilson",
+              "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Lee", "Shah", "Khan"]
+AGENCIES = ["Keystone Realty", "Lakeside Homes", "Urban Nest", "Prairie Properties",
+            "Summit Realty", "Harbor Group"]
+LANGUAGES = ["English", "English, Spanish", "English, Hindi", "English, Mandarin",
+             "English, Polish", "English, Arabic"]
+CRIME_RATES = ["Low (2.1/10)", "Low (3.2/10)", "Medium (4.8/10)", "Medium (5.5/10)",
+               "High (7.0/10)"]
+ROOM_WEIGHTS = [(1, 20), (2, 30), (3, 25), (4, 15), (5, 7), (6, 3)]
+
+# Sequence behind each SERIAL primary key that gets explicit ids.
+ID_COLUMNS = [
+    ('"USER"', "user_id"), ("ADDRESS", "address_id"), ("AGENT", "agent_id"),
+    ("RENTER", "renter_id"), ("PROPERTY", "prop_id"), ("CARD_DETAILS", "card_id"),
+    ("BOOKING", "booking_id"), ("REWARD", "reward_id"),
+]
+
+NULL = "\\N"
+
+# Set in every loader process by _init_worker.
+MODEL = None
+
+
+def zipf_cumulative(n, skew, rng):
+    """Cumulative Zipf weights over n items in a random rank order."""
+    ranks = list(range(1, n + 1))
+    rng.shuffle(ranks)
+    return array("d", accumulate(1.0 / r ** skew for r in ranks))
+
+
+def pick(cumulative, rng):
+    return bisect.bisect_left(cumulative, rng.random() * cumulative[-1])
+
+
+def booking_counts(total, properties, skew, capacity, rng):
+    """Bookings per property: Zipf-skewed, but at most ``capacity`` each."""
+    weights = [1.0 / r ** skew for r in range(1, properties + 1)]
+    rng.shuffle(weights)
+    counts = array("l", [0] * properties)
+    # Heaviest first, each taking its share of what is left, so the
+    # overflow of capped properties spreads over the lighter ones.
+    order = sorted(range(properties), key=weights.__getitem__, reverse=True)
+    remaining, weight_left = total, sum(weights)
+    for p in order:
+        counts[p] = min(capacity, round(remaining * weights[p] / weight_left))
+        remaining -= counts[p]
+        weight_left -= weights[p]
+    for p in order:
+        if not remaining:
+            break
+        extra = min(capacity - counts[p], remaining)
+        counts[p] += extra
+        remaining -= extra
+    return counts
+
+
+def cards_before(renter):
+    """Renters own 1, 2, 3, 1, 2, 3, ... cards: index of the first one."""
+    return 6 * (renter // 3) + (0, 1, 3)[renter % 3]
+
+
+def card_count(renter):
+    return renter % 3 + 1
+
+
+# ===========================================================
+# MODEL (built once, shared with every loader)
+# ===========================================================
+def build_model(args, base, categories):
+    rng = random.Random(args.seed)
+    city_cum = array("d", accumulate(1.0 / (i + 1) ** args.city_skew for i in range(len(CITIES))))
+    rooms_values = [r for r, _ in ROOM_WEIGHTS]
+    rooms_cum = list(accumulate(w for _, w in ROOM_WEIGHTS))
+
+    prop_city = array("H")
+    prop_rooms = array("b")
+    prop_price = array("d")
+    for _ in range(args.properties):
+        city = pick(city_cum, rng)
+        rooms = rooms_values[bisect.bisect_left(rooms_cum, rng.random() * rooms_cum[-1])]
+        price = round(rng.lognormvariate(7.0, 0.35) * CITIES[city][3] * (0.6 + 0.25 * rooms), 2)
+        prop_city.append(city)
+        prop_rooms.append(rooms)
+        prop_price.append(price)
+
+    return {
+        "seed": args.seed,
+        "base": base,
+        "agents": args.agents,
+        "renters": args.renters,
+        "properties": args.properties,
+        "days": args.years * 365,
+        "today": date.today(),
+        "categories": categories,
+        "city_cum": city_cum,
+        "prop_city": prop_city,
+        "prop_rooms": prop_rooms,
+        "prop_price": prop_price,
+        "agent_cum": zipf_cumulative(args.agents, args.agent_skew, rng),
+        # Booking i belongs to the property p with booking_start[p] <= i < booking_start[p + 1].
+        "booking_start": array("q", accumulate(
+            booking_counts(args.bookings, args.properties, args.booking_skew,
+                           args.years * 365 // 2, rng), initial=0)),
+        "renter_cum": zipf_cumulative(args.renters, args.renter_skew, rng),
+    }
+
+
+# ===========================================================
+# ROW GENERATORS: one per table, over item indexes [lo, hi)
+# ===========================================================
+def _name(rng):
+    return rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+
+
+def gen_users(m, rng, lo, hi):
+    base = m["base"]["user_id"]
+    for i in range(lo, hi):
+        uid = base + i + 1
+        first, last = _name(rng)
+        yield (uid, f"{first.lower()}.{uid}@werent.test", f"+1{uid:012d}", first, NULL, last)
+
+
+def gen_addresses(m, rng, lo, hi):
+    # Agents first, then renters, then one address per property.
+    base = m["base"]["address_id"]
+    people = m["agents"] + m["renters"]
+    for i in range(lo, hi):
+        city = m["prop_city"][i - people] if i >= people else pick(m["city_cum"], rng)
+        name, state, zip_prefix, _ = CITIES[city]
+        yield (base + i + 1, f"{rng.randint(1, 9999)} {rng.choice(STREETS)} Street",
+               name, state, f"{zip_prefix}{rng.randint(0, 99):02d}")
+
+
+def gen_agents(m, rng, lo, hi):
+    b = m["base"]
+    for i in range(lo, hi):
+        yield (b["agent_id"] + i + 1, b["user_id"] + i + 1, "Real Estate Agent",
+               rng.choice(AGENCIES), b["address_id"] + i + 1, rng.choice(LANGUAGES))
+
+
+def gen_renters(m, rng, lo, hi):
+    b = m["base"]
+    agents = m["agents"]
+    for i in range(lo, hi):
+        move_in = m["today"] + timedelta(days=rng.randint(-60, 180))
+        city = CITIES[pick(m["city_cum"], rng)][0]
+        yield (b["renter_id"] + i + 1, b["user_id"] + agents + i + 1,
+               b["address_id"] + agents + i + 1, move_in,
+               f"{rng.randint(8, 60) * 100}.00", city, NULL)
+
+
+def gen_properties(m, rng, lo, hi):
+    b = m["base"]
+    first_address = b["address_id"] + m["agents"] + m["renters"]
+    for i in range(lo, hi):
+        rooms = m["prop_rooms"][i]
+        available = m["today"] + timedelta(days=rng.randint(-30, 120))
+        yield (b["prop_id"] + i + 1, b["agent_id"] + pick(m["agent_cum"], rng) + 1,
+               first_address + i + 1, rooms * rng.randint(300, 500),
+               f"{m['prop_price'][i]:.2f}", available,
+               "t" if rng.random() < 0.6 else "f", "t" if rng.random() < 0.4 else "f")
+
+
+def gen_property_details(m, rng, lo, hi):
+    base = m["base"]["prop_id"]
+    for i in range(lo, hi):
+        category_id, category = rng.choice(m["categories"])
+        rooms = m["prop_rooms"][i]
+        city = CITIES[m["prop_city"][i]][0]
+        yield (base + i + 1, category_id,
+               f"{category.replace('_', ' ').title()} with {rooms} rooms in {city}",
+               rooms, rng.choice(CRIME_RATES), NULL)
+
+
+def gen_cards(m, rng, lo, hi):
+    # Indexed by renter; each renter's cards bill to their home address.
+    b = m["base"]
+    agents = m["agents"]
+    for r in range(lo, hi):
+        first, last = _name(rng)
+        for j in range(card_count(r)):
+            card_id = b["card_id"] + cards_before(r) + j + 1
+            yield (card_id, b["renter_id"] + r + 1, f"4{card_id:015d}",
+                   b["address_id"] + agents + r + 1, f"{first} {last}")
+
+
+def _bookings(m, rng, lo, hi):
+    """(booking index, property index, renter index, card id, check-in, check-out), replayable.
+
+    A property with n bookings has its booking period cut into n equal
+    slots and its k-th stay falls inside slot k. The period ends 90 days
+    from today, so some stays are still ahead.
+    """
+    b = m["base"]
+    starts = m["booking_start"]
+    first_day = m["today"] + timedelta(days=90 - m["days"])
+    for i in range(lo, hi):
+        prop = bisect.bisect_right(starts, i) - 1
+        slot = m["days"] // (starts[prop + 1] - starts[prop])
+        renter = pick(m["renter_cum"], rng)
+        card_id = b["card_id"] + cards_before(renter) + rng.randrange(card_count(renter)) + 1
+        nights = rng.randint(1, min(slot, 7))
+        check_in = first_day + timedelta(days=(i - starts[prop]) * slot + rng.randrange(slot - nights + 1))
+        yield i, prop, renter, card_id, check_in, check_in + timedelta(days=nights)
+
+
+def gen_bookings(m, rng, lo, hi):
+    b = m["base"]
+    for i, prop, renter, card_id, check_in, check_out in _bookings(m, rng, lo, hi):
+        yield (b["booking_id"] + i + 1, b["prop_id"] + prop + 1, b["renter_id"] + renter + 1,
+               card_id, check_in, f"[{check_in},{check_out})")
+
+
+def gen_rewards(m, rng, lo, hi):
+    b = m["base"]
+    for i, prop, renter, _, check_in, _ in _bookings(m, rng, lo, hi):
+        yield (b["reward_id"] + i + 1, b["booking_id"] + i + 1, check_in,
+               b["renter_id"] + renter + 1, int(m["prop_price"][prop]))
+
+
+# Load order (foreign keys) and, per step, the COPY targets run by each
+# chunk: (table, columns, generator). BOOKING and REWARD share a step and a
+# transaction, the rewards replaying the same random stream as the bookings.
+STEPS = [
+    ("users", lambda a: a.agents + a.renters, [
+        ('"USER"', "user_id, email, phone_number, first_name, middle_name, last_name",
+         gen_users)]),
+    ("addresses", lambda a: a.agents + a.renters + a.properties, [
+        ("ADDRESS", "address_id, line_1, city, state_, zip_code", gen_addresses)]),
+    ("agents", lambda a: a.agents, [
+        ("AGENT", "agent_id, user_id, job_title, agency, address_id, lang_spoken",
+         gen_agents)]),
+    ("renters", lambda a: a.renters, [
+        ("RENTER", "renter_id, user_id, address_id, move_in_date, budget, pref_location, "
+         "referral_code", gen_renters)]),
+    ("properties", lambda a: a.properties, [
+        ("PROPERTY", "prop_id, agent_id, address_id, sq_ft, price, date_of_availability, "
+         "utilities, parking", gen_properties)]),
+    ("property details", lambda a: a.properties, [
+        ("PROPERTY_DETAILS", "prop_id, property_category_id, description_, rooms, "
+         "crime_rate, business_type", gen_property_details)]),
+    ("cards", lambda a: a.renters, [
+        ("CARD_DETAILS", "card_id, renter_id, card_no, billing_address_id, name_on_card",
+         gen_cards)]),
+    ("bookings", lambda a: a.bookings, [
+        ("BOOKING", "booking_id, prop_id, renter_id, card_id, booking_date, stay",
+         gen_bookings),
+        ("REWARD", "reward_id, booking_id, booking_date, renter_id, points", gen_rewards)]),
+]
+
+
+# ===========================================================
+# COPY LOADING
+# ===========================================================
+class RowStream:
+    """File-like object feeding generated rows to COPY in text format."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = ""
+        self.count = 0
+
+    def read(self, size=-1):
+        lines = [self.buffer]
+        length = len(self.buffer)
+        while size <= 0 or length < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            line = "\t".join(map(str, row)) + "\n"
+            lines.append(line)
+            length += len(line)
+            self.count += 1
+        data = "".join(lines)
+        if size > 0:
+            data, self.buffer = data[:size], data[size:]
+        else:
+            self.buffer = ""
+        return data
+
+
+def _init_worker(model):
+    global MODEL
+    MODEL = model
+
+
+def load_chunk(task):
+    """Load one chunk of one step on this worker's own connection."""
+    step_index, chunk, lo, hi = task
+    _, _, targets = STEPS[step_index]
+    conn = get_connection()
+    rows = 0
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SET synchronous_commit = off;")
+            cur.execute("SET werent.bulk_load = on;")
+            for table, columns, generate in targets:
+                # Same seed for every target of a chunk, so REWARD replays BOOKING.
+                rng = random.Random(f"{MODEL['seed']}:{step_index}:{chunk}")
+                stream = RowStream(generate(MODEL, rng, lo, hi))
+                cur.copy_expert(f"COPY {table} ({columns}) FROM STDIN", stream)
+                rows += stream.count
+        conn.commit()
+    finally:
+        conn.close()
+    return rows
+
+
+def _chunks(total, count):
+    size = max(1, -(-total // count))
+    return [(lo, min(lo + size, total)) for lo in range(0, total, size)]
+
+
+def prepare(args):
+    """Current id bases and category ids; TRUNCATE first with --truncate.
+
+    Also creates the BOOKING / REWARD partitions for the booking period.
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            if args.truncate:
+                cur.execute(
+                    'TRUNCATE REWARD, BOOKING, CARD_DETAILS, PROPERTY_DETAILS, PROPERTY, '
+                    'RENTER, AGENT, ADDRESS, "USER" RESTART IDENTITY CASCADE;'
+                )
+            # Same period as _bookings: ending 90 days from today.
+            last_day = date.today() + timedelta(days=90)
+            cur.execute("SELECT create_booking_partitions(%s, %s);",
+                        (last_day - timedelta(days=args.years * 365), last_day))
+            base = {}
+            for table, column in ID_COLUMNS:
+                cur.execute(f"SELECT COALESCE(MAX({column}), 0) FROM {table};")
+                base[column] = cur.fetchone()[0]
+            cur.execute("SELECT property_category_id, category_name FROM PROPERTY_CATEGORY "
+                        "ORDER BY property_category_id;")
+            categories = cur.fetchall()
+        conn.commit()
+    finally:
+        conn.close()
+    if not categories:
+        raise SystemExit("PROPERTY_CATEGORY is empty: load schema.sql first")
+    return base, categories
+
+
+def finish(tables):
+    """Move every sequence past the loaded ids and refresh planner stats."""
+    conn = get_connection()
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for table, column in ID_COLUMNS:
+                cur.execute(
+                    f"SELECT setval(pg_get_serial_sequence(%s, %s), "
+                    f"(SELECT COALESCE(MAX({column}), 0) + 1 FROM {table}), false);",
+                    (table, column),
+                )
+            for table in tables:
+                cur.execute(f"ANALYZE {table};")
+    finally:
+        conn.close()
+
+
+def run(args, out=sys.stdout):
+    started = time.monotonic()
+    base, categories = prepare(args)
+    model = build_model(args, base, categories)
+    print(f"model built in {time.monotonic() - started:.1f}s", file=out)
+
+    ctx = multiprocessing.get_context("spawn")
+    try:
+        with ctx.Pool(args.workers, _init_worker, (model,)) as pool:
+            for step_index, (label, size, targets) in enumerate(STEPS):
+                step_started = time.monotonic()
+                chunks = _chunks(size(args), args.workers * 4)
+                tasks = [(step_index, n, lo, hi) for n, (lo, hi) in enumerate(chunks)]
+                rows = sum(pool.imap_unordered(load_chunk, tasks))
+                elapsed = time.monotonic() - step_started
+                print(f"{label:>16}: {rows:>11,} rows in {elapsed:6.1f}s "
+                      f"({rows / max(elapsed, 1e-9):,.0f} rows/s)", file=out)
+    except BaseException:
+        print("load failed: the chunks loaded so far are committed; run "
+              "python rewards.py --fix and python rollups.py refresh", file=out)
+        raise
+
+    # What the skipped triggers would have maintained, in one pass each.
+    rewards.reconcile(fix=True, out=out)
+    rollups.refresh(out=out)
+
+    finish([table for _, _, targets in STEPS for table, _, _ in targets]
+           + ["REWARD_BALANCE", "REWARD_LEDGER", "PROPERTY_ROLLUP", "PROPERTY_DAILY_ROLLUP",
+              "BOOKING_STAY"])
+    print(f"done in {time.monotonic() - started:.1f}s", file=out)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--agents", type=int, default=2_000)
+    parser.add_argument("--renters", type=int, default=100_000)
+    parser.add_argument("--properties", type=int, default=50_000)
+    parser.add_argument("--bookings", type=int, default=1_000_000)
+    parser.add_argument("--years", type=int, default=3,
+                        help="stays span this many years, ending 90 days from today")
+    parser.add_argument("--city-skew", type=float, default=1.1)
+    parser.add_argument("--agent-skew", type=float, default=1.0)
+    parser.add_argument("--booking-skew", type=float, default=1.0,
+                        help="Zipf exponent of bookings per property")
+    parser.add_argument("--renter-skew", type=float, default=0.8)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--seed", type=int, default=425)
+    parser.add_argument("--truncate", action="store_true",
+                        help="delete all users, properties and bookings first")
+    args = parser.parse_args(argv)
+    if min(args.agents, args.renters, args.properties) < 1:
+        parser.error("--agents, --renters and --properties must be at least 1")
+    if args.bookings > args.properties * (args.years * 365 // 2):
+        parser.error("too many --bookings: a property holds at most one per two days of --years")
+    return args
+
+
+if __name__ == "__main__":
+    run(parse_args(sys.argv[1:]))
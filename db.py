@@ -1,28 +1,932 @@
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import itertools
 import os
+import re
+import select
+import threading
+import time
+from contextlib import contextmanager
+
 import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INERROR
+
+# Pool sizing can be tuned per deployment without touching code.
+POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+# Connections idle longer than POOL_IDLE_CHECK get a health check before
+# reuse, extra connections idle longer than POOL_MAX_IDLE are closed, and
+# connections older than POOL_MAX_AGE are replaced. All values in seconds.
+POOL_IDLE_CHECK = float(os.environ.get("DB_POOL_IDLE_CHECK", "30"))
+POOL_MAX_IDLE = float(os.environ.get("DB_POOL_MAX_IDLE", "300"))
+POOL_MAX_AGE = float(os.environ.get("DB_POOL_MAX_AGE", "1800"))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+
+log = logging.getLogger(__name__)
+
+
+class Connection(psycopg2.extensions.connection):
+    """psycopg2's connection, which can carry the pool's bookkeeping
+    (``_created_at``, ``_prepared``); the C type takes no attributes."""
+
+    # Whether a prepared statement already ran in the current transaction
+    # (see _execute_prepared).
+    _statements_checked = False
+
+    def commit(self):
+        self._statements_checked = False
+        super().commit()
+
+    def rollback(self):
+        self._statements_checked = False
+        super().rollback()
+
 
 def get_connection():
     # 1) If DATABASE_URL is set (Render / other host), use it
     db_url = os.environ.get("DATABASE_URL")
     if db_url:
-        return psycopg2.connect(db_url)
+        return psycopg2.connect(db_url, connection_factory=Connection)
 
     # 2) Otherwise use your local Postgres for development
     return psycopg2.connect(
+        connection_factory=Connection,
         host="localhost",
         database="realestate",
         user="postgres",        # change if your local user is different
         password="yourpassword" # change to your local password
     )
 
-def run_query(sql, params=(), fetch=False):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(sql, params)
-    data = None
-    if fetch:
-        data = cur.fetchall()
-    conn.commit()
-    cur.close()
-    conn.close()
+
+# ===========================================================
+# CONNECTION POOL
+# ===========================================================
+class PoolTimeout(Exception):
+    """Raised when no connection became free within DB_POOL_TIMEOUT."""
+
+
+class ConnectionPool:
+    """Thread-safe, bounded pool of psycopg2 connections.
+
+    Idle connections are kept on a LIFO stack so the warmest one is reused
+    first. Connections idle longer than DB_POOL_IDLE_CHECK get a ``SELECT 1``
+    before being handed out, connections idle longer than DB_POOL_MAX_IDLE
+    (above the minimum) or older than DB_POOL_MAX_AGE are closed. When all
+    ``maxconn`` connections are busy, callers wait up to ``timeout`` seconds.
+    """
+
+    def __init__(self, minconn, maxconn, timeout=POOL_TIMEOUT, connect=None):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._connect = connect or get_connection
+        self._idle = []       # [(conn, released_at)], most recent last
+        self._size = 0        # open connections, idle + checked out
+        self._cond = threading.Condition()
+        self.closed = False
+
+    def _open(self):
+        conn = self._connect()
+        conn._created_at = time.monotonic()
+        _configure_session(conn)
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn, released_at):
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        if now - conn._created_at > POOL_MAX_AGE:
+            return False
+        if now - released_at > POOL_IDLE_CHECK:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1;")
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _reap_idle(self, now):
+        # Oldest idle connections sit at the bottom of the stack.
+        while self._size > self.minconn and self._idle:
+            conn, released_at = self._idle[0]
+            if now - released_at <= POOL_MAX_IDLE:
+                break
+            self._idle.pop(0)
+            self._size -= 1
+            self._discard(conn)
+
+    def checkout(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                if self.closed:
+                    raise PoolTimeout("connection pool is closed")
+                self._reap_idle(time.monotonic())
+                while not self._idle and self._size >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            "no database connection free after %.1fs" % self.timeout
+                        )
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                else:
+                    conn, released_at = None, None
+                    self._size += 1
+
+            # Connect / health-check outside the lock so one slow socket
+            # never blocks every other thread in the worker.
+            if conn is None:
+                try:
+                    return self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            if self._healthy(conn, released_at):
+                return conn
+            self._discard(conn)
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+
+    def checkin(self, conn):
+        if not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            # Never hand out a connection with a half-finished transaction.
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self._discard(conn)
+        with self._cond:
+            if conn.closed or self.closed:
+                self._size -= 1
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self.closed = True
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._size -= len(self._idle)
+            self._idle = []
+            self._cond.notify_all()
+
+
+# ===========================================================
+# INSTRUMENTATION HOOKS
+# ===========================================================
+# Observers (metrics, tracing, ...) subscribe to database events here
+# instead of wrapping the query helpers:
+#   "query":    callback(sql, params, seconds, rows) after every statement
+#   "checkout": callback(seconds) after every pool checkout, with the time
+#               spent waiting for (or opening) the connection
+_hooks = {"query": [], "checkout": []}
+
+
+def add_hook(event, callback):
+    _hooks[event].append(callback)
+
+
+def _emit(event, *args):
+    for callback in _hooks[event]:
+        try:
+            callback(*args)
+        except Exception:
+            # Instrumentation must never fail a query.
+            log.exception("db %s hook failed", event)
+
+
+def _checkout():
+    start = time.perf_counter()
+    conn = get_pool().checkout()
+    _emit("checkout", time.perf_counter() - start)
+    return conn
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+# Pools inherited from a parent process. They are kept referenced so the
+# child never garbage-collects (and thereby terminates) the parent's sessions.
+_orphaned_pools = []
+
+
+def get_pool():
+    """Return this process's pool, creating it lazily.
+
+    The pool is keyed on the PID: gunicorn forks workers after the master
+    has imported the app, and sockets inherited across a fork must never be
+    shared, so a child always builds its own pool on first use.
+    """
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                if _pool is not None:
+                    _orphaned_pools.append(_pool)
+                _pool = ConnectionPool(POOL_MIN, POOL_MAX)
+                _pool_pid = pid
+    return _pool
+
+
+def close_pool():
+    """Close every pooled connection (e.g. from a gunicorn worker_exit hook)."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+        _pool_pid = None
+        if _replicas_pid == os.getpid():
+            for replica in _replicas:
+                replica.pool.closeall()
+
+
+@contextmanager
+def pooled_connection():
+    """Borrow a connection from the pool for the duration of a block."""
+    conn = _checkout()
+    try:
+        yield conn
+    finally:
+        get_pool().checkin(conn)
+
+
+# ===========================================================
+# READ REPLICAS
+# ===========================================================
+# With DATABASE_REPLICA_URLS (comma-separated DSNs of streaming replicas)
+# set, a unit of work begun with replica_reads=True sends its read-only
+# statements to a replica, round-robin, as long as it has not written
+# anything; writes, and every statement after the first write, go to the
+# primary. Whether a request may read from a replica at all is the app's
+# call (it pins a session to the primary for a while after it writes, so
+# users see their own writes). A monitor thread per process measures each
+# replica's replay lag every DB_REPLICA_CHECK_INTERVAL seconds; a replica
+# that is unreachable or more than DB_REPLICA_MAX_LAG seconds behind gets
+# no reads until it catches up, and with none left reads use the primary.
+REPLICA_URLS = [url.strip() for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",")
+                if url.strip()]
+REPLICA_MAX_LAG = float(os.environ.get("DB_REPLICA_MAX_LAG", "2"))
+REPLICA_CHECK_INTERVAL = float(os.environ.get("DB_REPLICA_CHECK_INTERVAL", "1"))
+
+_READS = re.compile(r"^\s*(SELECT|WITH|VALUES|TABLE)\b", re.IGNORECASE)
+_WRITES = re.compile(
+    r"\b(INSERT|UPDATE|DELETE|MERGE|TRUNCATE|FOR\s+(NO\s+KEY\s+)?UPDATE|FOR\s+(KEY\s+)?SHARE"
+    r"|nextval|setval|pg_advisory_\w+|pg_notify)\b",
+    re.IGNORECASE,
+)
+
+# A standby that has replayed everything it received is current, however
+# long ago the primary last committed; otherwise the lag is the age of the
+# last replayed transaction. A server that is not in recovery has no lag.
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END;
+"""
+
+
+@functools.lru_cache(maxsize=1024)
+def is_read_only(sql):
+    """True for statements a replica can run: plain queries that lock or write nothing."""
+    return bool(_READS.match(sql)) and not _WRITES.search(sql)
+
+
+class Replica:
+    """One replica: its connection pool, last measured lag and read count."""
+
+    def __init__(self, url):
+        self.url = url
+        dsn = psycopg2.extensions.parse_dsn(url)
+        self.name = "%s:%s/%s" % (dsn.get("host", "localhost"), dsn.get("port", 5432),
+                                  dsn.get("dbname", ""))
+        self.pool = ConnectionPool(POOL_MIN, POOL_MAX, connect=lambda: psycopg2.connect(
+            url, connection_factory=Connection))
+        self.lag = None     # seconds; None while unknown or unreachable
+        self.reads = 0
+
+    @property
+    def usable(self):
+        return self.lag is not None and self.lag <= REPLICA_MAX_LAG
+
+
+_replicas = []
+_replicas_pid = None
+_replicas_lock = threading.Lock()
+_next_replica = itertools.count()
+
+
+def get_replicas():
+    """This process's replicas; the first call after a fork starts the lag monitor."""
+    global _replicas, _replicas_pid
+    if _replicas_pid != os.getpid():
+        with _replicas_lock:
+            if _replicas_pid != os.getpid():
+                _replicas = [Replica(url) for url in REPLICA_URLS]
+                _replicas_pid = os.getpid()
+                if _replicas:
+                    threading.Thread(target=_monitor_replicas, args=(_replicas,),
+                                     name="replica-lag", daemon=True).start()
+    return _replicas
+
+
+def _monitor_replicas(replicas):
+    conns = {}
+    while True:
+        for replica in replicas:
+            conn = conns.get(replica.url)
+            try:
+                if conn is None or conn.closed:
+                    conn = conns[replica.url] = psycopg2.connect(replica.url)
+                    conn.set_session(autocommit=True)
+                with conn.cursor() as cur:
+                    cur.execute(REPLICA_LAG_SQL)
+                    lag = float(cur.fetchone()[0])
+                if lag > REPLICA_MAX_LAG and replica.usable:
+                    log.warning("replica %s is %.1fs behind; reading from the others",
+                                replica.name, lag)
+                replica.lag = lag
+            except Exception:
+                if replica.lag is not None:
+                    log.warning("replica %s unreachable", replica.name, exc_info=True)
+                replica.lag = None
+                conns.pop(replica.url, None)
+                if conn is not None and not conn.closed:
+                    conn.close()
+        time.sleep(REPLICA_CHECK_INTERVAL)
+
+
+def _replica_checkout():
+    """(replica, connection) for a read, or (None, None) to use the primary."""
+    usable = [replica for replica in get_replicas() if replica.usable]
+    if not usable:
+        return None, None
+    first = next(_next_replica) % len(usable)
+    for replica in usable[first:] + usable[:first]:
+        start = time.perf_counter()
+        try:
+            conn = replica.pool.checkout()
+        except PoolTimeout:
+            continue
+        except psycopg2.Error:
+            # Down since the last check; the monitor will notice it is back.
+            log.warning("replica %s refused a connection", replica.name, exc_info=True)
+            replica.lag = None
+            continue
+        _emit("checkout", time.perf_counter() - start)
+        return replica, conn
+    return None, None
+
+
+def replica_stats():
+    """Lag, availability and read count of every configured replica."""
+    return [
+        {"replica": r.name, "lag": r.lag, "usable": r.usable, "reads": r.reads}
+        for r in get_replicas()
+    ]
+
+
+# ===========================================================
+# PREPARED STATEMENTS
+# ===========================================================
+# Statements registered with prepare() are PREPAREd on each pooled
+# connection the first time they run there and executed by name from then
+# on, so Postgres parses and plans them once per session instead of on
+# every call. Any other statement runs as plain SQL. With
+# DB_PLAN_CACHE_MODE every pooled connection sets Postgres' plan_cache_mode:
+# "auto" (the default: custom plans for the first five executions, then a
+# generic plan unless it looks costlier), "force_generic_plan" (plan once,
+# least CPU) or "force_custom_plan" (plan for every parameter set, best for
+# skewed filters). DB_PREPARED_STATEMENTS=0 turns prepared statements off,
+# e.g. behind a transaction-pooling pgbouncer, which does not keep session
+# state. At most DB_PREPARED_MAX statements are registered per process.
+PREPARED_STATEMENTS = os.environ.get("DB_PREPARED_STATEMENTS", "1") != "0"
+PLAN_CACHE_MODE = os.environ.get("DB_PLAN_CACHE_MODE", "")
+PREPARED_MAX = int(os.environ.get("DB_PREPARED_MAX", "200"))
+
+_PLACEHOLDER = re.compile(r"%[s%]")
+
+
+class PreparedStatement:
+    """A registered statement and its counters (summed over connections)."""
+
+    def __init__(self, name, sql):
+        self.name = name
+        # psycopg2 placeholders become $1, $2, ... for PREPARE.
+        numbers = iter(range(1, sql.count("%s") + 1))
+        body = _PLACEHOLDER.sub(
+            lambda m: "%" if m.group() == "%%" else "$%d" % next(numbers), sql)
+        self.prepare_sql = "PREPARE %s AS %s" % (name, body.strip().rstrip(";"))
+        nparams = sql.count("%s")
+        self.execute_sql = "EXECUTE %s (%s);" % (name, ", ".join(["%s"] * nparams)) \
+            if nparams else "EXECUTE %s;" % name
+        self.executions = 0
+        self.prepares = 0
+        self.unpreparable = False
+
+
+_registry = {}   # sql text -> PreparedStatement
+_registry_lock = threading.Lock()
+
+
+def prepare(sql, name=None):
+    """Run ``sql`` as a prepared statement from now on; returns ``sql``.
+
+    ``name`` defaults to one derived from the text, so dynamically built
+    statements (the /search shapes) can be registered as they are met.
+    Statements with named (``%(x)s``) placeholders are left alone.
+    """
+    if not PREPARED_STATEMENTS or sql in _registry or "%(" in sql:
+        return sql
+    with _registry_lock:
+        if sql not in _registry and len(_registry) < PREPARED_MAX:
+            name = name or "q_" + hashlib.md5(sql.encode()).hexdigest()[:16]
+            _registry[sql] = PreparedStatement(name, sql)
+    return sql
+
+
+def _configure_session(conn):
+    conn._prepared = set()
+    if PLAN_CACHE_MODE:
+        with conn.cursor() as cur:
+            cur.execute("SET plan_cache_mode = %s;", (PLAN_CACHE_MODE,))
+        conn.commit()
+
+
+def _prepare(cur, statement):
+    """PREPARE ``statement`` on this connection; False if Postgres refuses."""
+    conn = cur.connection
+    # In a savepoint, so a refusal leaves the request's transaction usable.
+    savepoint = not conn.autocommit
+    try:
+        if savepoint:
+            cur.execute("SAVEPOINT prepare_statement;")
+        cur.execute(statement.prepare_sql)
+        if savepoint:
+            cur.execute("RELEASE SAVEPOINT prepare_statement;")
+    except psycopg2.errors.DuplicatePreparedStatement:
+        # Still there after all (see _execute_prepared).
+        if savepoint:
+            cur.execute("ROLLBACK TO SAVEPOINT prepare_statement;")
+    except psycopg2.Error as exc:
+        if savepoint:
+            cur.execute("ROLLBACK TO SAVEPOINT prepare_statement;")
+        statement.unpreparable = True
+        log.warning("cannot prepare %s (%s); running it as plain SQL",
+                    statement.name, str(exc).strip())
+        return False
+    else:
+        statement.prepares += 1
+    conn._prepared.add(statement.name)
+    return True
+
+
+def _execute_prepared(cur, statement, params):
+    """EXECUTE ``statement``, PREPAREing it on this connection first.
+
+    Returns False when Postgres refused to prepare it (e.g. a parameter
+    whose type it cannot infer); the caller then runs the plain SQL, and
+    so does every later call.
+
+    The session can lose its statements between transactions (DISCARD
+    ALL, a pooler), though not within one. So the first EXECUTE of a
+    transaction is the one that may find its statement gone. It then
+    prepares it again and retries once. If that EXECUTE opened the
+    transaction, a rollback undoes the failure; otherwise it runs in a
+    savepoint. Later statements of the transaction run unguarded.
+    """
+    conn = cur.connection
+    if getattr(conn, "_prepared", None) is None:
+        conn._prepared = set()
+    if statement.name not in conn._prepared:
+        if statement.unpreparable or not _prepare(cur, statement):
+            return False
+    elif conn.autocommit or not getattr(conn, "_statements_checked", True):
+        opens = conn.autocommit or conn.info.transaction_status == TRANSACTION_STATUS_IDLE
+        try:
+            cur.execute(statement.execute_sql if opens else
+                        "SAVEPOINT execute_statement; " + statement.execute_sql, params)
+        except psycopg2.errors.InvalidSqlStatementName:
+            if opens:
+                if not conn.autocommit:
+                    conn.rollback()
+            else:
+                cur.execute("ROLLBACK TO SAVEPOINT execute_statement;")
+            log.info("session lost prepared statement %s; preparing it again", statement.name)
+            # Whatever reset the session took every statement with it.
+            conn._prepared.clear()
+            if not _prepare(cur, statement):
+                return False
+        else:
+            if not opens:
+                with conn.cursor() as release:
+                    release.execute("RELEASE SAVEPOINT execute_statement;")
+            conn._statements_checked = not conn.autocommit
+            statement.executions += 1
+            return True
+    cur.execute(statement.execute_sql, params)
+    if not conn.autocommit:
+        conn._statements_checked = True
+    statement.executions += 1
+    return True
+
+
+def prepared_stats():
+    """Registry settings and per-statement counters for this process."""
+    return {
+        "enabled": PREPARED_STATEMENTS,
+        "plan_cache_mode": PLAN_CACHE_MODE or "server default",
+        "statements": {
+            s.name: {"executions": s.executions, "prepares": s.prepares,
+                     "unpreparable": s.unpreparable}
+            for s in list(_registry.values())
+        },
+    }
+
+
+# ===========================================================
+# UNIT OF WORK (one connection + one transaction per request)
+# ===========================================================
+class UnitOfWork:
+    """A lazily opened transaction shared by every statement of a request.
+
+    No connection is borrowed until the first statement runs, so requests
+    that never touch the database never wait on the pool.
+    """
+
+    def __init__(self, replica_reads=False, statement_timeout=None):
+        self.conn = None
+        self.statement_timeout = statement_timeout
+        self.replica_reads = replica_reads and bool(REPLICA_URLS)
+        self.replica = None
+        self.replica_conn = None
+        self.wrote = False
+        self.on_commit = []
+
+    def connection(self, read_only=False):
+        """The connection for the next statement (see READ REPLICAS)."""
+        if read_only and self.replica_reads and self.conn is None:
+            if self.replica_conn is None:
+                self.replica, self.replica_conn = _replica_checkout()
+                self.replica_reads = self.replica_conn is not None
+            if self.replica_conn is not None:
+                self.replica.reads += 1
+                _start_transaction(self.replica_conn, self.statement_timeout)
+                return self.replica_conn
+        if self.conn is None:
+            self.conn = _checkout()
+        _start_transaction(self.conn, self.statement_timeout)
+        return self.conn
+
+    def commit(self):
+        if self.conn is not None:
+            self.conn.commit()
+        callbacks, self.on_commit = self.on_commit, []
+        for callback in callbacks:
+            callback()
+
+    def rollback(self):
+        self.on_commit = []
+        if self.conn is not None and not self.conn.closed:
+            self.conn.rollback()
+
+    def release(self):
+        if self.conn is not None:
+            get_pool().checkin(self.conn)
+            self.conn = None
+        if self.replica_conn is not None:
+            # checkin() rolls back the read-only transaction.
+            self.replica.pool.checkin(self.replica_conn)
+            self.replica_conn = None
+
+
+_current_uow = contextvars.ContextVar("db_unit_of_work", default=None)
+# Kept after end(), so a page body streamed after the unit of work reads
+# from where the request was allowed to, under the same statement timeout;
+# the next begin() resets them.
+_replica_reads = contextvars.ContextVar("db_replica_reads", default=False)
+_statement_timeout = contextvars.ContextVar("db_statement_timeout", default=None)
+
+
+def begin(replica_reads=False, statement_timeout=None):
+    """Bind a new unit of work to the current context (thread / request).
+
+    With ``replica_reads`` its read-only statements may go to a replica
+    until it writes (see READ REPLICAS). ``statement_timeout`` (in ms)
+    bounds every statement it runs.
+    """
+    uow = UnitOfWork(replica_reads, statement_timeout)
+    _current_uow.set(uow)
+    _replica_reads.set(uow.replica_reads)
+    _statement_timeout.set(statement_timeout)
+    return uow
+
+
+def _start_transaction(conn, statement_timeout):
+    """Apply the statement timeout when a new transaction starts on ``conn``.
+
+    It is set with SET LOCAL semantics, so it ends with the transaction and
+    never leaks to the next borrower of the pooled connection.
+    """
+    if statement_timeout and conn.info.transaction_status == TRANSACTION_STATUS_IDLE:
+        with conn.cursor() as cur:
+            cur.execute("SELECT set_config('statement_timeout', %s, true);",
+                        (str(int(statement_timeout)),))
+
+
+def wrote():
+    """Whether the current unit of work has run a statement that writes."""
+    uow = _current_uow.get()
+    return uow is not None and uow.wrote
+
+
+def commit():
+    uow = _current_uow.get()
+    if uow is not None:
+        uow.commit()
+
+
+def rollback():
+    uow = _current_uow.get()
+    if uow is not None:
+        uow.rollback()
+
+
+def end():
+    """Roll back anything uncommitted, return the connection and unbind."""
+    uow = _current_uow.get()
+    if uow is None:
+        return
+    try:
+        uow.rollback()
+    finally:
+        uow.release()
+        _current_uow.set(None)
+
+
+def after_commit(callback):
+    """Run ``callback`` once the current unit of work has committed.
+
+    Used for side effects that must not happen for a rolled-back write,
+    such as cache invalidation. Outside a unit of work every statement
+    commits on its own, so the callback runs immediately.
+    """
+    uow = _current_uow.get()
+    if uow is None:
+        callback()
+    else:
+        uow.on_commit.append(callback)
+
+
+@contextmanager
+def transaction():
+    """Run a block as one transaction; joins the enclosing one if present."""
+    if _current_uow.get() is not None:
+        yield _current_uow.get()
+        return
+    uow = begin()
+    try:
+        yield uow
+        uow.commit()
+    finally:
+        end()
+
+
+def _run(cur, sql, params, fetch):
+    start = time.perf_counter()
+    try:
+        statement = _registry.get(sql)
+        if statement is None or not _execute_prepared(cur, statement, params):
+            cur.execute(sql, params)
+        return fetch(cur)
+    finally:
+        _emit("query", sql, params, time.perf_counter() - start, max(cur.rowcount, 0))
+
+
+def _execute(sql, params, fetch):
+    """Run one statement and return ``fetch(cursor)``'s result."""
+    uow = _current_uow.get()
+    if uow is not None:
+        # Inside a unit of work: share its connection, leave the commit to
+        # whoever owns the transaction.
+        read_only = is_read_only(sql)
+        uow.wrote = uow.wrote or not read_only
+        with uow.connection(read_only).cursor() as cur:
+            return _run(cur, sql, params, fetch)
+
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        try:
+            data = _run(cur, sql, params, fetch)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
     return data
+
+
+def run_query(sql, params=(), fetch=False):
+    return _execute(sql, params, lambda cur: cur.fetchall() if fetch else None)
+
+
+def run_returning(sql, params=()):
+    """Run an INSERT/UPDATE/DELETE ... RETURNING and return its first row.
+
+    Returns ``None`` when the statement touched no rows, so callers can
+    branch on it exactly like an empty SELECT.
+    """
+    return _execute(sql, params, lambda cur: cur.fetchone())
+
+
+def stream_query(sql, params=(), chunk_size=500):
+    """Yield the rows of a SELECT in chunks through a server-side cursor.
+
+    Only ``chunk_size`` rows are held in memory at a time. Inside a unit of
+    work the cursor runs on the request's connection; otherwise (e.g. in a
+    streamed response body, which is sent after the request's unit of work
+    has ended) it borrows its own pooled connection.
+    """
+    uow = _current_uow.get()
+    if uow is not None:
+        yield from _stream(uow.connection(is_read_only(sql)), sql, params, chunk_size)
+        return
+    replica, conn = (None, None)
+    if _replica_reads.get() and is_read_only(sql):
+        replica, conn = _replica_checkout()
+    if replica is not None:
+        replica.reads += 1
+        try:
+            _start_transaction(conn, _statement_timeout.get())
+            yield from _stream(conn, sql, params, chunk_size)
+        finally:
+            replica.pool.checkin(conn)
+        return
+    with pooled_connection() as conn:
+        try:
+            _start_transaction(conn, _statement_timeout.get())
+            yield from _stream(conn, sql, params, chunk_size)
+        finally:
+            conn.rollback()
+
+
+def _stream(conn, sql, params, chunk_size):
+    cur = conn.cursor(name="stream_%d" % id(conn))
+    cur.itersize = chunk_size
+    # Reported as one statement once the cursor is drained (or abandoned);
+    # the time counts database round trips only, not the consumer's work.
+    elapsed, total = 0.0, 0
+    try:
+        start = time.perf_counter()
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            elapsed += time.perf_counter() - start
+            if not rows:
+                break
+            total += len(rows)
+            yield rows
+            start = time.perf_counter()
+    finally:
+        _emit("query", sql, params, elapsed, total)
+        if not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_INERROR:
+            cur.close()
+
+
+def iter_rows(sql, params=(), chunk_size=500):
+    """Row-by-row generator over stream_query, for feeding templates."""
+    for rows in stream_query(sql, params, chunk_size):
+        yield from rows
+
+
+# ===========================================================
+# CHANGE FEED (LISTEN / NOTIFY)
+# ===========================================================
+# migrations/0003 makes every write to the listing, booking, reward and
+# card tables NOTIFY a compact JSON event on CHANGE_CHANNEL when it
+# commits, whichever worker or host made it. Each worker runs one listener
+# thread on a dedicated connection and hands every event to the callbacks
+# registered with on_change(). Notifications sent while the listener is
+# disconnected are lost, so after a reconnect the callbacks receive
+# FLUSH_EVENT and must drop everything they cache.
+CHANGE_CHANNEL = "werent_changes"
+CHANGE_FEED_PING = float(os.environ.get("CHANGE_FEED_PING", "30"))
+CHANGE_FEED_RECONNECT = float(os.environ.get("CHANGE_FEED_RECONNECT", "5"))
+
+FLUSH_EVENT = {"t": "*", "op": "F", "all": True}
+
+_change_callbacks = []
+_listener_pid = None
+_listener_lock = threading.Lock()
+_listening = False
+changes_received = 0
+listener_reconnects = 0
+
+
+def on_change(callback):
+    """Register ``callback(event)`` for change events (see CHANGE FEED above)."""
+    _change_callbacks.append(callback)
+
+
+def _dispatch_change(event):
+    for callback in _change_callbacks:
+        try:
+            callback(event)
+        except Exception:
+            log.exception("change feed callback failed")
+
+
+def _decode_change(payload):
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        event = None
+    if not isinstance(event, dict) or "t" not in event:
+        log.warning("unreadable change event %r; flushing", payload[:200])
+        return FLUSH_EVENT
+    return event
+
+
+def _listen(conn):
+    global changes_received
+    while True:
+        if select.select([conn], [], [], CHANGE_FEED_PING) == ([], [], []):
+            # Quiet for a while: make sure the connection is still alive,
+            # since a dropped one would otherwise just look quiet.
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+        conn.poll()
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            changes_received += 1
+            _dispatch_change(_decode_change(notify.payload))
+
+
+def _run_listener():
+    global listener_reconnects, _listening
+    gap = False
+    while True:
+        conn = None
+        try:
+            conn = get_connection()
+            conn.set_session(autocommit=True)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {CHANGE_CHANNEL};")
+            if gap:
+                # Listening again; whatever changed in between went unannounced.
+                listener_reconnects += 1
+                _dispatch_change(FLUSH_EVENT)
+                gap = False
+            _listening = True
+            _listen(conn)
+        except Exception:
+            log.warning("change feed listener disconnected; retrying in %ss",
+                        CHANGE_FEED_RECONNECT, exc_info=True)
+        finally:
+            _listening = False
+            if conn is not None and not conn.closed:
+                conn.close()
+        gap = True
+        time.sleep(CHANGE_FEED_RECONNECT)
+
+
+def change_feed_live():
+    """Whether this process hears about every committed write.
+
+    False while its listener is started but not connected, so changes made
+    elsewhere may go unannounced. A process that never started one (a
+    single development server) relies on its own invalidations and counts
+    as live.
+    """
+    return _listener_pid != os.getpid() or _listening
+
+
+def start_change_listener():
+    """Start this process's listener thread (once per process, after fork)."""
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid != os.getpid():
+            _listener_pid = os.getpid()
+            threading.Thread(target=_run_listener, name="change-feed", daemon=True).start()
@@ -0,0 +1,133 @@
+"""Fail if any route query has lost its index-backed plan.
+
+Runs EXPLAIN on every statement in queries.py (plus a spread of search
+filter / sort combinations) and reports each plan that still contains a
+Seq Scan on one of the large tables. The check runs with
+``enable_seqscan = off``: on a small development database the planner
+would otherwise pick sequential scans anyway, so what this verifies is
+that a usable index path *exists* for every predicate.
+
+Usage:
+    python explain_check.py          # exit status 1 when a query regresses
+"""
+import datetime
+import re
+import sys
+
+import queries
+from db import pooled_connection
+
+# Tables that grow with usage; PROPERTY_CATEGORY is a tiny lookup table.
+LARGE_TABLES = {
+    "USER", "address", "agent", "renter", "property",
+    "property_details", "card_details", "booking", "reward",
+    "reward_balance", "reward_ledger", "property_rollup", "property_daily_rollup",
+    "booking_stay",
+}
+# Monthly partitions (booking_p2025_01) count as their parent table.
+PARTITION_SUFFIX = re.compile(r"_p\d{4}_\d{2}$")
+
+# The booking lists' default window (app.bookings_since, 12 months).
+RECENT = datetime.date(datetime.date.today().year - 1, datetime.date.today().month, 1)
+
+_NO_FILTERS = dict.fromkeys(queries.SEARCH_FILTERS, "")
+
+
+def _search(**filters):
+    return dict(_NO_FILTERS, **filters)
+
+
+def route_queries():
+    """Yield (label, sql, params) for every statement the routes issue."""
+    yield "login_renter", queries.RENTER_LOGIN, ("someone@example.com",)
+    yield "login_agent", queries.AGENT_LOGIN, ("someone@example.com",)
+    yield "agent_dashboard", queries.AGENT_PROPERTIES, (1,)
+    yield "agent_delete_property", queries.DELETE_AGENT_PROPERTY, (1, 1)
+    yield "agent_bookings", queries.AGENT_BOOKINGS, (1, RECENT)
+    yield "agent_bookings (history)", queries.AGENT_BOOKINGS, (1, datetime.date.min)
+    yield "agent_analytics", queries.AGENT_ROLLUP_PROPERTIES, (1,)
+    yield "agent_analytics (weeks)", queries.AGENT_ROLLUP_WEEKS, (1, "2025-01-06", "2025-04-28")
+    yield "my_cards", queries.RENTER_CARDS, (1,)
+    yield "delete_card (in use)", queries.CARD_IN_USE, (1, 1)
+    yield "delete_card", queries.DELETE_RENTER_CARD, (1, 1)
+    yield "book_property", queries.PROPERTY_FOR_BOOKING, (1,)
+    yield "book_property (cards)", queries.RENTER_CARD_CHOICES, (1,)
+    yield "my_bookings", queries.RENTER_BOOKINGS, (RECENT, 1, RECENT)
+    yield "my_bookings (history)", queries.RENTER_BOOKINGS, (datetime.date.min, 1, datetime.date.min)
+    yield "my_bookings (balance)", queries.RENTER_REWARD_BALANCE, (1,)
+    yield "my_bookings (history)", queries.RENTER_REWARD_HISTORY, (1, queries.REWARD_HISTORY_START, 20)
+    yield "cancel_booking (reward)", queries.DELETE_BOOKING_REWARD, (1, 1, 1)
+    yield "cancel_booking", queries.DELETE_RENTER_BOOKING, (1, 1, 1)
+
+    cases = [
+        ("city", _search(city="Chicago")),
+        ("price range", _search(min_price="1000", max_price="2500")),
+        ("rooms", _search(rooms="2")),
+        ("category", _search(category="APARTMENT")),
+        ("city+rooms", _search(city="Chicago", rooms="2")),
+        ("available", _search(available_from="2025-06-01", available_to="2025-06-08")),
+        ("available+city", _search(city="Chicago", available_from="2025-06-01",
+                                   available_to="2025-06-08")),
+    ]
+    keyword_cases = [
+        ("keywords", _search(q="backyard")),
+        ("keywords+city", _search(q='"near campus" -basement', city="Chicago")),
+    ]
+    for sort_by in queries.SEARCH_SORT_KEYS:
+        # Relevance ranking needs keywords; every other order is checked
+        # with and without them.
+        sort_cases = keyword_cases if sort_by == "relevance" else cases + keyword_cases
+        for label, filters in sort_cases:
+            sql, params = queries.build_search_query(filters, sort_by, limit=21)
+            yield f"search {label} by {sort_by}", sql, params
+            sql, params = queries.build_search_query(
+                filters, sort_by, after=("1000", 1), limit=21
+            )
+            yield f"search {label} by {sort_by} (next page)", sql, params
+    # Facet counts cover every match, so they are only checked where a
+    # filter narrows the scan; an unfiltered search counts all listings.
+    for label, filters in cases + keyword_cases:
+        sql, params = queries.build_search_query(filters, "price", limit=21, facets=True)
+        yield f"search {label} with facets", sql, params
+    for sort_by in ("price", "rooms", "city"):
+        yield f"search page rows by {sort_by} (snapshot)", queries.build_search_rows_query(sort_by), ([1, 2, 3],)
+    # Sorting every listing by city has to read them all whatever the
+    # indexes, so only the index-ordered sorts are checked unfiltered.
+    for sort_by in ("price", "rooms"):
+        sql, params = queries.build_search_query(_search(), sort_by, limit=21)
+        yield f"search unfiltered by {sort_by}", sql, params
+
+
+def seq_scans(plan):
+    """Return the large tables a JSON plan node tree reads sequentially."""
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        table = PARTITION_SUFFIX.sub("", plan.get("Relation Name", ""))
+        if table in LARGE_TABLES:
+            found.append(table)
+    for child in plan.get("Plans", ()):
+        found.extend(seq_scans(child))
+    return found
+
+
+def check(out=sys.stdout):
+    failures = 0
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SET LOCAL enable_seqscan = off;")
+            for label, sql, params in route_queries():
+                cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                plan = cur.fetchone()[0][0]["Plan"]
+                tables = seq_scans(plan)
+                if tables:
+                    failures += 1
+                    print(f"FAIL {label}: Seq Scan on {', '.join(sorted(set(tables)))}", file=out)
+                else:
+                    print(f"ok   {label}", file=out)
+        # EXPLAIN without ANALYZE never executes, but leave no trace anyway.
+        conn.rollback()
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if check() else 0)
@@ -0,0 +1,48 @@
+# Gunicorn picks this file up automatically from the working directory.
+# Each worker builds its own connection pool lazily after the fork (see
+# db.get_pool); here we warm the per-worker caches, start the change-feed
+# listener that keeps them fresh, close the pool cleanly on exit and keep
+# the per-worker metrics snapshots (METRICS_DIR) in sync.
+import os
+
+import admission
+import db
+import metrics
+import refdata
+
+# The admission gate (admission.py) only works with threaded workers. A
+# sync worker serves one request at a time, so the gate never sees a
+# second request to queue, prioritise or shed, and the backlog waits in
+# the listen socket instead. Each worker therefore runs the gthread class
+# with more threads than ADMISSION_SLOTS: the surplus threads are the ones
+# that wait in the gate's queue. --worker-class / --threads on the command
+# line still override these.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS",
+                             str(admission.ADMISSION_SLOTS + admission.ADMISSION_QUEUE or 4)))
+
+
+def on_starting(server):
+    metrics.clear_dir()
+    if admission.ADMISSION_SLOTS and (server.cfg.worker_class_str == "sync"
+                                      or server.cfg.threads <= admission.ADMISSION_SLOTS):
+        server.log.warning(
+            "admission control needs a threaded worker with more than ADMISSION_SLOTS=%d "
+            "threads (running %s with %d); requests will queue outside the gate",
+            admission.ADMISSION_SLOTS, server.cfg.worker_class_str, server.cfg.threads)
+
+
+def post_worker_init(worker):
+    # Runs after the app is imported in the worker, so every table the app
+    # registered is loaded before the first request.
+    try:
+        refdata.preload()
+    except Exception:
+        # Tables load lazily on first use if the database is not up yet.
+        worker.log.exception("reference data preload failed")
+    db.start_change_listener()
+
+
+def worker_exit(server, worker):
+    db.close_pool()
+    metrics.flush()
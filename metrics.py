@@ -0,0 +1,373 @@
+"""Request and database metrics in the Prometheus text exposition format.
+
+Every statement run through db.py is timed and attributed to the Flask
+endpoint handling the current request (see db.add_hook). Per request we
+record the number of statements, time spent in the database, time spent
+waiting for a pooled connection, rows returned and the remaining time,
+which is mostly template rendering. ``/metrics`` serves all of it.
+
+Each gunicorn worker counts on its own. When METRICS_DIR is set, a worker
+writes a snapshot to METRICS_DIR/worker-<pid>.json at most every
+METRICS_FLUSH_INTERVAL seconds and when it exits, and ``/metrics`` sums the
+snapshots of all workers, so a scrape gives the same totals whichever
+worker answers it. Snapshots of exited workers are kept so counters never
+go backwards; gunicorn.conf.py empties the directory when the server starts.
+
+``/metrics`` is not public: it answers agents that are logged in and,
+when METRICS_TOKEN is set, requests carrying ``Authorization: Bearer
+<METRICS_TOKEN>`` (a Prometheus scrape job's bearer token); anyone else
+gets a 404.
+"""
+import bisect
+import contextvars
+import glob
+import hmac
+import json
+import os
+import threading
+import time
+
+from flask import Response, abort, request, session
+
+import cache
+import db
+
+METRICS_DIR = os.environ.get("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "1"))
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+# Statements run outside any request (startup preloads, CLI scripts).
+NO_ENDPOINT = "(none)"
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+_metrics = []
+# Reentrant: a streamed response dropped without being closed records its
+# request from the generator's finalizer, which the garbage collector can
+# run on whichever thread is inside a metric at that moment.
+_lock = threading.RLock()
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}   # label values tuple -> float
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with _lock:
+            # A copy, in case such a finalizer adds a key mid-iteration.
+            values = self.values.copy()
+        return [[list(k), v] for k, v in values.items()]
+
+
+class Histogram(Counter):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames, buckets=SECONDS_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with _lock:
+            # Per-bucket (non-cumulative) counts, the +Inf bucket, then the sum.
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with _lock:
+            values = self.values.copy()
+            return [[list(k), list(v)] for k, v in values.items()]
+
+
+REQUESTS = Counter(
+    "werent_http_requests_total", "Requests handled.", ("endpoint", "method", "status"))
+REQUEST_SECONDS = Histogram(
+    "werent_http_request_duration_seconds", "Wall time per request, streaming included.",
+    ("endpoint",))
+REQUEST_QUERIES = Histogram(
+    "werent_db_queries_per_request", "SQL statements issued per request.",
+    ("endpoint", "method"), COUNT_BUCKETS)
+REQUEST_DB_SECONDS = Histogram(
+    "werent_request_db_seconds", "Time per request spent executing SQL.", ("endpoint",))
+REQUEST_RENDER_SECONDS = Histogram(
+    "werent_request_render_seconds",
+    "Time per request outside the database and the pool (mostly template rendering).",
+    ("endpoint",))
+REQUEST_POOL_WAIT = Histogram(
+    "werent_db_pool_wait_seconds", "Time per request spent waiting for a pooled connection.",
+    ("endpoint",))
+REQUEST_ROWS = Histogram(
+    "werent_db_rows_per_request", "Rows returned or affected per request.",
+    ("endpoint",), ROW_BUCKETS)
+QUERY_SECONDS = Histogram(
+    "werent_db_query_duration_seconds", "Duration of individual SQL statements.", ("endpoint",))
+QUERIES = Counter(
+    "werent_db_queries_total", "SQL statements executed.", ("endpoint",))
+
+
+# ===========================================================
+# PER-REQUEST ACCOUNTING
+# ===========================================================
+class RequestStats:
+    __slots__ = ("endpoint", "method", "start", "status", "streamed",
+                 "queries", "db_seconds", "rows", "pool_wait")
+
+    def __init__(self, endpoint, method):
+        self.endpoint = endpoint
+        self.method = method
+        self.streamed = False
+        self.start = time.perf_counter()
+        self.status = 500
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+        self.pool_wait = 0.0
+
+
+_current = contextvars.ContextVar("metrics_request", default=None)
+
+
+def _on_query(sql, params, seconds, rows):
+    stats = _current.get()
+    endpoint = stats.endpoint if stats is not None else NO_ENDPOINT
+    QUERY_SECONDS.observe(seconds, endpoint=endpoint)
+    QUERIES.inc(endpoint=endpoint)
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += seconds
+        stats.rows += rows
+
+
+def _on_checkout(seconds):
+    stats = _current.get()
+    if stats is not None:
+        stats.pool_wait += seconds
+
+
+def begin_request():
+    _current.set(RequestStats(request.endpoint or NO_ENDPOINT, request.method))
+
+
+def _finish_after_stream(body, stats):
+    # The request is torn down before a streamed body is sent, so the rows
+    # rendered while streaming are attributed (and recorded) from here.
+    _current.set(stats)
+    try:
+        yield from body
+    finally:
+        _current.set(None)
+        _record(stats)
+
+
+def record_status(response):
+    stats = _current.get()
+    if stats is not None:
+        stats.status = response.status_code
+        if response.is_streamed:
+            stats.streamed = True
+            response.response = _finish_after_stream(response.response, stats)
+    return response
+
+
+def end_request(exc):
+    stats = _current.get()
+    if stats is None:
+        return
+    _current.set(None)
+    if not stats.streamed:
+        _record(stats)
+
+
+def _record(stats):
+    endpoint = stats.endpoint
+    total = time.perf_counter() - stats.start
+    REQUESTS.inc(endpoint=endpoint, method=stats.method, status=stats.status)
+    REQUEST_SECONDS.observe(total, endpoint=endpoint)
+    REQUEST_QUERIES.observe(stats.queries, endpoint=endpoint, method=stats.method)
+    REQUEST_DB_SECONDS.observe(stats.db_seconds, endpoint=endpoint)
+    REQUEST_POOL_WAIT.observe(stats.pool_wait, endpoint=endpoint)
+    REQUEST_RENDER_SECONDS.observe(
+        max(total - stats.db_seconds - stats.pool_wait, 0.0), endpoint=endpoint)
+    REQUEST_ROWS.observe(stats.rows, endpoint=endpoint)
+    maybe_flush()
+
+
+# ===========================================================
+# SNAPSHOTS AND CROSS-WORKER AGGREGATION
+# ===========================================================
+_CACHE_COUNTERS = ("hits", "shared_hits", "misses", "invalidations", "evictions", "bypassed")
+_PREPARED_COUNTERS = ("executions", "prepares")
+_last_flush = 0.0
+_flush_lock = threading.Lock()
+
+
+def snapshot():
+    """This worker's metrics as a JSON-serializable dict."""
+    data = {}
+    for metric in _metrics:
+        data[metric.name] = {
+            "type": metric.kind,
+            "help": metric.help,
+            "labels": list(metric.labelnames),
+            "buckets": list(getattr(metric, "buckets", ())),
+            "samples": metric.samples(),
+        }
+    # Result caches keep their own counters (see cache.stats()).
+    for field in _CACHE_COUNTERS:
+        data[f"werent_cache_{field}_total"] = {
+            "type": "counter",
+            "help": f"Result cache {field.replace('_', ' ')}.",
+            "labels": ["cache"],
+            "buckets": [],
+            "samples": [[[name], s[field]] for name, s in cache.stats().items()],
+        }
+    # Prepared statements count their own executions (see db.prepared_stats()).
+    statements = db.prepared_stats()["statements"]
+    for field in _PREPARED_COUNTERS:
+        data[f"werent_prepared_{field}_total"] = {
+            "type": "counter",
+            "help": f"Prepared statement {field}.",
+            "labels": ["statement"],
+            "buckets": [],
+            "samples": [[[name], s[field]] for name, s in statements.items()],
+        }
+    return data
+
+
+def _path(pid):
+    return os.path.join(METRICS_DIR, f"worker-{pid}.json")
+
+
+def flush():
+    """Write this worker's snapshot to METRICS_DIR (atomically)."""
+    global _last_flush
+    if not METRICS_DIR:
+        return
+    with _flush_lock:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = _path(os.getpid())
+        with open(path + ".tmp", "w") as f:
+            json.dump(snapshot(), f)
+        os.replace(path + ".tmp", path)
+        _last_flush = time.monotonic()
+
+
+def maybe_flush():
+    if METRICS_DIR and time.monotonic() - _last_flush >= METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+def clear_dir():
+    """Forget the snapshots of a previous server run."""
+    if METRICS_DIR:
+        for path in glob.glob(os.path.join(METRICS_DIR, "worker-*.json")):
+            os.remove(path)
+
+
+def _merge(into, data):
+    for name, metric in data.items():
+        target = into.setdefault(name, dict(metric, samples={}))
+        for labels, value in metric["samples"]:
+            key = tuple(labels)
+            current = target["samples"].get(key)
+            if current is None:
+                target["samples"][key] = value
+            elif isinstance(value, list):
+                target["samples"][key] = [a + b for a, b in zip(current, value)]
+            else:
+                target["samples"][key] = current + value
+
+
+def collect():
+    """Metrics of every worker (or just this one without METRICS_DIR)."""
+    merged = {}
+    if not METRICS_DIR:
+        _merge(merged, snapshot())
+        return merged
+    flush()
+    for path in glob.glob(os.path.join(METRICS_DIR, "worker-*.json")):
+        try:
+            with open(path) as f:
+                _merge(merged, json.load(f))
+        except (OSError, ValueError):
+            continue  # removed or replaced mid-read
+    return merged
+
+
+# ===========================================================
+# TEXT EXPOSITION
+# ===========================================================
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs += [f'{n}="{v}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(merged):
+    lines = []
+    for name in sorted(merged):
+        metric = merged[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        names = metric["labels"]
+        for key in sorted(metric["samples"]):
+            value = metric["samples"][key]
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_labels(names, key)} {_number(value)}")
+                continue
+            cumulative = 0
+            bounds = [_number(b) for b in metric["buckets"]] + ["+Inf"]
+            for bound, count in zip(bounds, value[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(names, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(names, key)} {_number(value[-1])}")
+            lines.append(f"{name}_count{_labels(names, key)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def authorized():
+    """Whether the request may read internal stats (see module docstring)."""
+    if session.get("role") == "agent":
+        return True
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    return bool(METRICS_TOKEN) and scheme.lower() == "bearer" and hmac.compare_digest(
+        token.strip().encode(), METRICS_TOKEN.encode())
+
+
+def metrics_view():
+    if not authorized():
+        abort(404)
+    return Response(render(collect()), mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app):
+    db.add_hook("query", _on_query)
+    db.add_hook("checkout", _on_checkout)
+    app.before_request(begin_request)
+    app.after_request(record_status)
+    app.teardown_request(end_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
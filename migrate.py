@@ -0,0 +1,111 @@
+"""Versioned schema migrations.
+
+Migrations are the numbered files in migrations/ (``0001_name.sql``,
+``0002_name.sql``, ...). Each one is applied at most once, inside its own
+transaction together with its row in SCHEMA_MIGRATIONS, so a failed file
+leaves nothing behind and a re-run picks up where it stopped.
+
+Usage:
+    python migrate.py            # apply all pending migrations
+    python migrate.py status     # list applied / pending migrations
+"""
+import os
+import re
+import sys
+
+from db import pooled_connection
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATION_FILE = re.compile(r"^(\d{4})_([\w-]+)\.sql$")
+# Arbitrary constant: concurrent runners (e.g. several workers booting at
+# once) queue on this advisory lock instead of racing each other.
+MIGRATION_LOCK_ID = 425_0001
+
+
+def discover():
+    """Return [(version, name, path)] for every migration file, in order."""
+    found = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            found.append((int(match.group(1)), match.group(2),
+                          os.path.join(MIGRATIONS_DIR, filename)))
+    return found
+
+
+def _ensure_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS SCHEMA_MIGRATIONS (
+            version    INT PRIMARY KEY,
+            name       VARCHAR(200) NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+
+
+def applied_versions(cur):
+    _ensure_table(cur)
+    cur.execute("SELECT version FROM SCHEMA_MIGRATIONS;")
+    return {row[0] for row in cur.fetchall()}
+
+
+def migrate(out=sys.stdout):
+    """Apply every pending migration; return the list of versions applied."""
+    done = []
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_ID,))
+            try:
+                already = applied_versions(cur)
+                conn.commit()
+                for version, name, path in discover():
+                    if version in already:
+                        continue
+                    with open(path) as f:
+                        sql = f.read()
+                    try:
+                        cur.execute(sql)
+                        cur.execute(
+                            "INSERT INTO SCHEMA_MIGRATIONS (version, name) VALUES (%s, %s);",
+                            (version, name),
+                        )
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        print(f"FAILED {version:04d}_{name}", file=out)
+                        raise
+                    print(f"applied {version:04d}_{name}", file=out)
+                    done.append(version)
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_ID,))
+                conn.commit()
+    return done
+
+
+def status(out=sys.stdout):
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            already = applied_versions(cur)
+        conn.commit()
+    for version, name, _ in discover():
+        state = "applied" if version in already else "pending"
+        print(f"{state:8} {version:04d}_{name}", file=out)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    command = argv[0] if argv else "up"
+    if command == "up":
+        applied = migrate()
+        if not applied:
+            print("database is up to date")
+    elif command == "status":
+        status()
+    else:
+        print(__doc__)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
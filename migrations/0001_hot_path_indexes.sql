@@ -0,0 +1,52 @@
+-- =====================================================================
+-- 0001: indexes for the access paths used by app.py
+-- schema.sql only declares primary keys and UNIQUE constraints; every
+-- other filter/join column below was a sequential scan.
+-- =====================================================================
+
+-- agent_dashboard, agent_bookings: PROPERTY by agent
+CREATE INDEX IF NOT EXISTS property_agent_idx
+    ON PROPERTY (agent_id, prop_id);
+
+-- my_bookings: BOOKING by renter, newest first
+CREATE INDEX IF NOT EXISTS booking_renter_idx
+    ON BOOKING (renter_id, booking_id DESC);
+
+-- agent_bookings: BOOKING by property (reached via PROPERTY.agent_id)
+CREATE INDEX IF NOT EXISTS booking_prop_idx
+    ON BOOKING (prop_id, booking_id DESC);
+
+-- delete_card: "is this card used by any booking?"
+CREATE INDEX IF NOT EXISTS booking_card_idx
+    ON BOOKING (card_id);
+
+-- my_bookings LEFT JOIN REWARD, cancel_booking DELETE: covering, so the
+-- join reads points straight from the index
+CREATE INDEX IF NOT EXISTS reward_booking_idx
+    ON REWARD (booking_id) INCLUDE (points);
+
+-- my_cards, book_property: CARD_DETAILS by renter
+CREATE INDEX IF NOT EXISTS card_details_renter_idx
+    ON CARD_DETAILS (renter_id, card_id);
+
+-- search: LOWER(a.city) = LOWER(%s)
+CREATE INDEX IF NOT EXISTS address_city_lower_idx
+    ON ADDRESS (LOWER(city));
+
+-- search: price range filter and the keyset sort on price
+-- (expression must match queries.SEARCH_SORT_KEYS["price"])
+CREATE INDEX IF NOT EXISTS property_price_sort_idx
+    ON PROPERTY ((COALESCE(price, 99999999.99)), prop_id);
+CREATE INDEX IF NOT EXISTS property_price_idx
+    ON PROPERTY (price);
+
+-- search: rooms filter and the keyset sort on rooms
+-- (expression must match queries.SEARCH_SORT_KEYS["rooms"])
+CREATE INDEX IF NOT EXISTS property_details_rooms_idx
+    ON PROPERTY_DETAILS (rooms);
+CREATE INDEX IF NOT EXISTS property_details_rooms_sort_idx
+    ON PROPERTY_DETAILS ((COALESCE(rooms, 2147483647)), prop_id);
+
+-- search: category filter (PROPERTY_CATEGORY -> PROPERTY_DETAILS)
+CREATE INDEX IF NOT EXISTS property_details_category_idx
+    ON PROPERTY_DETAILS (property_category_id);
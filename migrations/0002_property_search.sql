@@ -0,0 +1,18 @@
+-- =====================================================================
+-- 0002: full-text search over property descriptions
+-- A generated tsvector column is kept up to date by Postgres itself on
+-- every INSERT/UPDATE of PROPERTY_DETAILS, and the GIN index makes
+-- "search_vector @@ query" an index lookup instead of a LIKE scan.
+-- business_type is weighted above the free-text description.
+-- =====================================================================
+
+ALTER TABLE PROPERTY_DETAILS
+    ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', COALESCE(business_type, '')), 'A') ||
+        setweight(to_tsvector('english', COALESCE(Description_, '')), 'B')
+    ) STORED;
+
+-- search: ?q= keyword matches
+CREATE INDEX IF NOT EXISTS property_details_search_idx
+    ON PROPERTY_DETAILS USING GIN (search_vector);
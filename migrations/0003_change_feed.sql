@@ -0,0 +1,103 @@
+-- =====================================================================
+-- 0003: change feed for cache invalidation
+-- Every INSERT / UPDATE / DELETE / TRUNCATE on the tables the app caches
+-- from publishes one NOTIFY on channel werent_changes per statement (not
+-- per row, so bulk loads stay cheap), e.g.
+--     {"t": "booking", "op": "I", "booking_id": [812], "renter_id": [40], "prop_id": [7]}
+-- listing the distinct values of the key columns given as trigger
+-- arguments. Listings also carry the lower-cased cities they are in.
+-- When a statement touches more than 50 distinct values of a column the
+-- lists are dropped and "all": true tells listeners to flush everything
+-- derived from the table. Notifications are sent on commit only, and
+-- db.py's listener thread fans them out to the registered callbacks.
+-- =====================================================================
+
+CREATE OR REPLACE FUNCTION notify_change() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    changed text := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT * FROM new_rows'
+        WHEN 'DELETE' THEN 'SELECT * FROM old_rows'
+        ELSE 'SELECT * FROM new_rows UNION ALL SELECT * FROM old_rows'
+    END;
+    payload jsonb := jsonb_build_object('t', lower(TG_TABLE_NAME), 'op', left(TG_OP, 1));
+    max_keys CONSTANT int := 50;
+    n bigint;
+    col text;
+    keys jsonb;
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        PERFORM pg_notify('werent_changes', (payload || '{"all": true}')::text);
+        RETURN NULL;
+    END IF;
+
+    EXECUTE format('SELECT count(*) FROM (%s) c', changed) INTO n;
+    IF n = 0 THEN
+        RETURN NULL;
+    END IF;
+
+    FOREACH col IN ARRAY TG_ARGV LOOP
+        EXECUTE format(
+            'SELECT CASE WHEN count(DISTINCT %1$I) <= %3$s THEN jsonb_agg(DISTINCT %1$I) END FROM (%2$s) c',
+            col, changed, max_keys) INTO keys;
+        IF keys IS NULL THEN
+            payload := payload || '{"all": true}';
+            EXIT;
+        END IF;
+        payload := payload || jsonb_build_object(col, keys);
+    END LOOP;
+
+    IF NOT payload ? 'all' AND TG_TABLE_NAME IN ('property', 'property_details') THEN
+        -- A deleted listing keeps its ADDRESS row; a cascaded
+        -- PROPERTY_DETAILS delete is covered by the PROPERTY event.
+        EXECUTE format(
+            'SELECT CASE WHEN count(DISTINCT lower(a.city)) <= %2$s
+                         THEN COALESCE(jsonb_agg(DISTINCT lower(a.city)) FILTER (WHERE a.city IS NOT NULL), ''[]'') END
+             FROM (%1$s) c
+             JOIN ADDRESS a ON a.address_id = %3$s',
+            changed, max_keys,
+            CASE TG_TABLE_NAME WHEN 'property' THEN 'c.address_id'
+                 ELSE '(SELECT p.address_id FROM PROPERTY p WHERE p.prop_id = c.prop_id)' END)
+            INTO keys;
+        payload := payload || CASE WHEN keys IS NULL THEN '{"all": true}'::jsonb
+                                   ELSE jsonb_build_object('cities', keys) END;
+    END IF;
+
+    PERFORM pg_notify('werent_changes', payload::text);
+    RETURN NULL;
+END;
+$$;
+
+-- Transition tables need one trigger per event.
+DO $$
+DECLARE
+    target record;
+    event text;
+    referencing text;
+BEGIN
+    FOR target IN
+        SELECT * FROM (VALUES
+            ('property',         '''prop_id'', ''agent_id'''),
+            ('property_details', '''prop_id'''),
+            ('booking',          '''booking_id'', ''renter_id'', ''prop_id'''),
+            ('reward',           '''booking_id'', ''renter_id'''),
+            ('card_details',     '''card_id'', ''renter_id''')
+        ) AS t(tbl, args)
+    LOOP
+        FOREACH event IN ARRAY ARRAY['insert', 'update', 'delete', 'truncate'] LOOP
+            referencing := CASE event
+                WHEN 'insert' THEN 'REFERENCING NEW TABLE AS new_rows'
+                WHEN 'update' THEN 'REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows'
+                WHEN 'delete' THEN 'REFERENCING OLD TABLE AS old_rows'
+                ELSE ''
+            END;
+            EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I',
+                           target.tbl || '_notify_' || event, target.tbl);
+            EXECUTE format('CREATE TRIGGER %I AFTER %s ON %I %s
+                                FOR EACH STATEMENT EXECUTE FUNCTION notify_change(%s)',
+                           target.tbl || '_notify_' || event, upper(event), target.tbl,
+                           referencing, target.args);
+        END LOOP;
+    END LOOP;
+END;
+$$;
@@ -0,0 +1,34 @@
+-- =====================================================================
+-- 0004: bookings as date ranges that can never overlap
+-- Every booking gets a stay [check-in, check-out). The exclusion
+-- constraint makes Postgres reject a booking whose stay overlaps another
+-- one for the same property, even when two renters book at the same
+-- moment, and its GiST index answers /search's "available from/to"
+-- NOT EXISTS probe per listing without reading other bookings.
+-- Existing bookings become one-night stays on their booking_date. Where a
+-- property was already booked twice for the same date, only the first
+-- booking gets a stay; the night is blocked either way.
+-- =====================================================================
+
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+
+ALTER TABLE BOOKING ADD COLUMN IF NOT EXISTS stay daterange;
+
+UPDATE BOOKING b
+SET stay = daterange(b.booking_date, b.booking_date + 1)
+WHERE b.stay IS NULL
+  AND b.booking_id = (SELECT min(first.booking_id)
+                      FROM BOOKING first
+                      WHERE first.prop_id = b.prop_id
+                        AND first.booking_date = b.booking_date);
+
+ALTER TABLE BOOKING DROP CONSTRAINT IF EXISTS booking_stay_no_overlap;
+ALTER TABLE BOOKING ADD CONSTRAINT booking_stay_no_overlap
+    EXCLUDE USING gist (prop_id WITH =, stay WITH &&);
+
+ALTER TABLE BOOKING DROP CONSTRAINT IF EXISTS booking_stay_not_empty;
+ALTER TABLE BOOKING ADD CONSTRAINT booking_stay_not_empty
+    CHECK (NOT isempty(stay) AND lower(stay) = booking_date);
+
+-- search: ?available_from= (listings must be free from that day on)
+CREATE INDEX IF NOT EXISTS property_availability_idx ON PROPERTY (date_of_availability);
@@ -0,0 +1,107 @@
+-- =====================================================================
+-- 0005: reward ledger and per-renter running balance
+-- REWARD stays the source of truth (one row per booking). Every change to
+-- it now also appends REWARD_LEDGER entries (+points when a booking
+-- earns them, -points when it is cancelled) and moves the renter's
+-- REWARD_BALANCE by the same amount, in the same transaction. Reading a
+-- balance is a primary-key lookup instead of a SUM over all bookings,
+-- and the ledger keeps the history with the balance after every entry.
+-- The trigger is per statement, so a bulk COPY into REWARD updates each
+-- renter's balance once. Balance rows are locked in renter order, which
+-- keeps concurrent bookings from deadlocking. rewards.py reconciles the
+-- balances against REWARD.
+-- =====================================================================
+
+CREATE TABLE IF NOT EXISTS REWARD_BALANCE (
+    renter_id  INT PRIMARY KEY REFERENCES RENTER(renter_id) ON DELETE CASCADE,
+    points     BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS REWARD_LEDGER (
+    entry_id      BIGSERIAL PRIMARY KEY,
+    renter_id     INT NOT NULL REFERENCES RENTER(renter_id) ON DELETE CASCADE,
+    booking_id    INT,            -- no FK: cancelled bookings keep their history
+    reward_id     INT,
+    delta         INT NOT NULL,
+    balance_after BIGINT NOT NULL,
+    reason        VARCHAR(20) NOT NULL,   -- booking | cancellation | adjustment
+    created_at    TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- my_bookings: a renter's history, newest first, paged by entry_id
+CREATE INDEX IF NOT EXISTS reward_ledger_renter_idx
+    ON REWARD_LEDGER (renter_id, entry_id DESC);
+
+CREATE OR REPLACE FUNCTION reward_ledger_apply() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    earned  CONSTANT text := 'SELECT renter_id, booking_id, reward_id, COALESCE(points, 0) AS delta, ''booking'' AS reason FROM new_rows';
+    revoked CONSTANT text := 'SELECT renter_id, booking_id, reward_id, -COALESCE(points, 0) AS delta, ''cancellation'' AS reason FROM old_rows';
+    changed text := CASE TG_OP
+        WHEN 'INSERT' THEN earned
+        WHEN 'DELETE' THEN revoked
+        ELSE earned || ' UNION ALL ' || revoked
+    END;
+BEGIN
+    -- Rows of renters deleted by this very statement (ON DELETE CASCADE)
+    -- have no balance left to maintain.
+    EXECUTE format($sql$
+        WITH changes AS (
+            SELECT c.* FROM (%s) c
+            WHERE c.delta <> 0
+              AND EXISTS (SELECT 1 FROM RENTER r WHERE r.renter_id = c.renter_id)
+        ), totals AS (
+            INSERT INTO REWARD_BALANCE AS rb (renter_id, points)
+            SELECT renter_id, sum(delta) FROM changes
+            GROUP BY renter_id
+            ORDER BY renter_id
+            ON CONFLICT (renter_id) DO UPDATE
+                SET points = rb.points + EXCLUDED.points, updated_at = now()
+            RETURNING rb.renter_id, rb.points
+        )
+        INSERT INTO REWARD_LEDGER (renter_id, booking_id, reward_id, delta, balance_after, reason)
+        SELECT c.renter_id, c.booking_id, c.reward_id, c.delta,
+               t.points - COALESCE(sum(c.delta) OVER (
+                   PARTITION BY c.renter_id ORDER BY c.reward_id, c.delta
+                   ROWS BETWEEN 1 FOLLOWING AND UNBOUNDED FOLLOWING), 0),
+               c.reason
+        FROM changes c
+        JOIN totals t ON t.renter_id = c.renter_id
+        ORDER BY c.renter_id, c.reward_id, c.delta
+    $sql$, changed);
+
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS reward_ledger_insert ON REWARD;
+CREATE TRIGGER reward_ledger_insert AFTER INSERT ON REWARD
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION reward_ledger_apply();
+
+DROP TRIGGER IF EXISTS reward_ledger_update ON REWARD;
+CREATE TRIGGER reward_ledger_update AFTER UPDATE ON REWARD
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION reward_ledger_apply();
+
+DROP TRIGGER IF EXISTS reward_ledger_delete ON REWARD;
+CREATE TRIGGER reward_ledger_delete AFTER DELETE ON REWARD
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION reward_ledger_apply();
+
+-- Opening state: the existing rewards, replayed in reward_id order.
+INSERT INTO REWARD_BALANCE (renter_id, points)
+SELECT renter_id, sum(COALESCE(points, 0))
+FROM REWARD
+GROUP BY renter_id
+ON CONFLICT (renter_id) DO NOTHING;
+
+INSERT INTO REWARD_LEDGER (renter_id, booking_id, reward_id, delta, balance_after, reason, created_at)
+SELECT rw.renter_id, rw.booking_id, rw.reward_id, COALESCE(rw.points, 0),
+       sum(COALESCE(rw.points, 0)) OVER (PARTITION BY rw.renter_id ORDER BY rw.reward_id),
+       'booking', b.booking_date
+FROM REWARD rw
+JOIN BOOKING b ON b.booking_id = rw.booking_id
+WHERE NOT EXISTS (SELECT 1 FROM REWARD_LEDGER)
+ORDER BY rw.renter_id, rw.reward_id;
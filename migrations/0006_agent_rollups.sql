@@ -0,0 +1,182 @@
+-- =====================================================================
+-- 0006: booking rollups for the agent analytics page
+-- PROPERTY_ROLLUP holds each listing's lifetime totals (bookings, nights
+-- booked, revenue at the current price) and PROPERTY_DAILY_ROLLUP the
+-- check-ins, booked nights and revenue per listing and day. Both carry
+-- agent_id, so /agent_analytics reads a bounded set of rollup rows
+-- instead of aggregating the agent's whole booking history.
+-- Statement-level triggers keep them current: a booking or cancellation
+-- adds or subtracts its contribution in the same transaction (rows are
+-- locked in (prop_id, day) order), a price change re-prices the listing's
+-- rows, and deleting a listing drops its rows by cascade. rollups.py
+-- checks the rollups against BOOKING and repairs drift batch by batch.
+-- =====================================================================
+
+CREATE TABLE IF NOT EXISTS PROPERTY_ROLLUP (
+    prop_id  INT PRIMARY KEY REFERENCES PROPERTY(prop_id) ON DELETE CASCADE,
+    agent_id INT NOT NULL,
+    city     VARCHAR(100),
+    bookings INT NOT NULL DEFAULT 0,
+    nights   INT NOT NULL DEFAULT 0,
+    revenue  NUMERIC(14,2) NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS PROPERTY_DAILY_ROLLUP (
+    prop_id   INT NOT NULL REFERENCES PROPERTY(prop_id) ON DELETE CASCADE,
+    day       DATE NOT NULL,
+    agent_id  INT NOT NULL,
+    check_ins INT NOT NULL DEFAULT 0,
+    nights    INT NOT NULL DEFAULT 0,
+    revenue   NUMERIC(14,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (prop_id, day)
+);
+
+-- agent_analytics: the agent's listings, and their days in a date window
+CREATE INDEX IF NOT EXISTS property_rollup_agent_idx ON PROPERTY_ROLLUP (agent_id);
+CREATE INDEX IF NOT EXISTS property_daily_rollup_agent_idx
+    ON PROPERTY_DAILY_ROLLUP (agent_id, day);
+
+-- What one booking contributes per day: a check-in (and its revenue) on
+-- booking_date and one booked night for every night of the stay. sign is
+-- -1 to take a cancelled booking back out. Shared by the trigger, the
+-- backfill below and rollups.py, so all three count the same way.
+CREATE OR REPLACE FUNCTION booking_rollup_days(booking_date date, stay daterange,
+                                               price numeric, sign int)
+RETURNS TABLE (day date, check_ins int, nights int, revenue numeric)
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT booking_date, sign, 0, sign * COALESCE(price, 0)
+    UNION ALL
+    SELECT lower(stay) + n, 0, sign, 0
+    FROM generate_series(0, upper(stay) - lower(stay) - 1) AS n
+$$;
+
+CREATE OR REPLACE FUNCTION rollup_booking_change() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    added   CONSTANT text := 'SELECT prop_id, booking_date, stay, 1 AS sign FROM new_rows';
+    removed CONSTANT text := 'SELECT prop_id, booking_date, stay, -1 AS sign FROM old_rows';
+    changed text := CASE TG_OP
+        WHEN 'INSERT' THEN added
+        WHEN 'DELETE' THEN removed
+        ELSE added || ' UNION ALL ' || removed
+    END;
+BEGIN
+    -- Bookings of a listing deleted by this statement (ON DELETE CASCADE)
+    -- drop out with the PROPERTY join; its rollup rows cascade away.
+    EXECUTE format($sql$
+        WITH changes AS (
+            SELECT c.*, p.agent_id, p.price, a.city
+            FROM (%s) c
+            JOIN PROPERTY p ON p.prop_id = c.prop_id
+            JOIN ADDRESS a ON a.address_id = p.address_id
+        ), totals AS (
+            INSERT INTO PROPERTY_ROLLUP AS r (prop_id, agent_id, city, bookings, nights, revenue)
+            SELECT prop_id, min(agent_id), min(city), sum(sign),
+                   sum(sign * COALESCE(upper(stay) - lower(stay), 0)),
+                   sum(sign * COALESCE(price, 0))
+            FROM changes
+            GROUP BY prop_id
+            ORDER BY prop_id
+            ON CONFLICT (prop_id) DO UPDATE
+                SET bookings = r.bookings + EXCLUDED.bookings,
+                    nights = r.nights + EXCLUDED.nights,
+                    revenue = r.revenue + EXCLUDED.revenue
+        )
+        INSERT INTO PROPERTY_DAILY_ROLLUP AS r (prop_id, day, agent_id, check_ins, nights, revenue)
+        SELECT c.prop_id, d.day, min(c.agent_id), sum(d.check_ins), sum(d.nights), sum(d.revenue)
+        FROM changes c, booking_rollup_days(c.booking_date, c.stay, c.price, c.sign) d
+        GROUP BY c.prop_id, d.day
+        ORDER BY c.prop_id, d.day
+        ON CONFLICT (prop_id, day) DO UPDATE
+            SET check_ins = r.check_ins + EXCLUDED.check_ins,
+                nights = r.nights + EXCLUDED.nights,
+                revenue = r.revenue + EXCLUDED.revenue
+    $sql$, changed);
+
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION rollup_property_insert() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO PROPERTY_ROLLUP (prop_id, agent_id, city)
+    SELECT n.prop_id, n.agent_id, a.city
+    FROM new_rows n
+    JOIN ADDRESS a ON a.address_id = n.address_id
+    ON CONFLICT (prop_id) DO NOTHING;
+    RETURN NULL;
+END;
+$$;
+
+-- Revenue is counted at the listing's current price, so a price change
+-- re-prices its rows (bookings x price), and a listing moved to another
+-- agent takes its rows along.
+CREATE OR REPLACE FUNCTION rollup_property_update() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    WITH moved AS (
+        SELECT n.prop_id, n.agent_id, n.price, a.city
+        FROM new_rows n
+        JOIN old_rows o ON o.prop_id = n.prop_id
+        JOIN ADDRESS a ON a.address_id = n.address_id
+        WHERE (n.agent_id, n.price, n.address_id) IS DISTINCT FROM (o.agent_id, o.price, o.address_id)
+    ), totals AS (
+        UPDATE PROPERTY_ROLLUP r
+        SET agent_id = m.agent_id, city = m.city, revenue = r.bookings * COALESCE(m.price, 0)
+        FROM moved m
+        WHERE r.prop_id = m.prop_id
+    )
+    UPDATE PROPERTY_DAILY_ROLLUP r
+    SET agent_id = m.agent_id, revenue = r.check_ins * COALESCE(m.price, 0)
+    FROM moved m
+    WHERE r.prop_id = m.prop_id;
+
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS booking_rollup_insert ON BOOKING;
+CREATE TRIGGER booking_rollup_insert AFTER INSERT ON BOOKING
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION rollup_booking_change();
+
+DROP TRIGGER IF EXISTS booking_rollup_update ON BOOKING;
+CREATE TRIGGER booking_rollup_update AFTER UPDATE ON BOOKING
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION rollup_booking_change();
+
+DROP TRIGGER IF EXISTS booking_rollup_delete ON BOOKING;
+CREATE TRIGGER booking_rollup_delete AFTER DELETE ON BOOKING
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION rollup_booking_change();
+
+DROP TRIGGER IF EXISTS property_rollup_insert ON PROPERTY;
+CREATE TRIGGER property_rollup_insert AFTER INSERT ON PROPERTY
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION rollup_property_insert();
+
+DROP TRIGGER IF EXISTS property_rollup_update ON PROPERTY;
+CREATE TRIGGER property_rollup_update AFTER UPDATE ON PROPERTY
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION rollup_property_update();
+
+-- Backfill from the bookings already there.
+INSERT INTO PROPERTY_ROLLUP (prop_id, agent_id, city, bookings, nights, revenue)
+SELECT p.prop_id, p.agent_id, a.city,
+       count(b.booking_id),
+       COALESCE(sum(upper(b.stay) - lower(b.stay)), 0),
+       count(b.booking_id) * COALESCE(p.price, 0)
+FROM PROPERTY p
+JOIN ADDRESS a ON a.address_id = p.address_id
+LEFT JOIN BOOKING b ON b.prop_id = p.prop_id
+GROUP BY p.prop_id, a.city
+ON CONFLICT (prop_id) DO NOTHING;
+
+INSERT INTO PROPERTY_DAILY_ROLLUP (prop_id, day, agent_id, check_ins, nights, revenue)
+SELECT b.prop_id, d.day, min(p.agent_id), sum(d.check_ins), sum(d.nights), sum(d.revenue)
+FROM BOOKING b
+JOIN PROPERTY p ON p.prop_id = b.prop_id,
+     booking_rollup_days(b.booking_date, b.stay, p.price, 1) d
+GROUP BY b.prop_id, d.day
+ON CONFLICT (prop_id, day) DO NOTHING;
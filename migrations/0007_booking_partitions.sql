@@ -0,0 +1,207 @@
+-- =====================================================================
+-- 0007: BOOKING and REWARD partitioned by month of booking_date
+-- Both tables are rebuilt as range-partitioned tables with one partition
+-- per calendar month (booking_p2025_01, reward_p2025_01, ...), so queries
+-- bounded by booking_date read only the months they need, and autovacuum
+-- and index maintenance work on one month at a time instead of the whole
+-- history. create_booking_partitions() adds months; partitions.py keeps
+-- PARTITION_MONTHS_AHEAD of them ready and moves old ones to the cold
+-- archive.
+--
+-- A key on a partitioned table must contain the partition key, so the
+-- primary keys become (booking_id, booking_date) / (reward_id,
+-- booking_date), and REWARD carries its booking's booking_date to keep
+-- its foreign key. For the same reason booking_stay_no_overlap cannot
+-- stay on BOOKING: it moves to BOOKING_STAY, one unpartitioned row per
+-- booking (id, date, property, stay) kept in step by a trigger. It also
+-- maps a booking_id to its partition for cancellations.
+--
+-- Archived months leave their contribution behind: REWARD_ARCHIVE_TOTAL
+-- holds each renter's archived points and BOOKING_ARCHIVE_DAY each
+-- listing's archived check-ins and nights per day, so rewards.py and
+-- rollups.py still reconcile against the complete history, and
+-- CARD_ARCHIVE_USE counts each card's archived bookings, so a card that
+-- paid for them still cannot be deleted.
+--
+-- The migration copies every booking and reward once; on a large
+-- database run it in a maintenance window.
+-- =====================================================================
+
+-- The old tables go away at the end; their sequences live on.
+ALTER TABLE BOOKING RENAME TO booking_unpartitioned;
+ALTER TABLE REWARD RENAME TO reward_unpartitioned;
+ALTER SEQUENCE booking_booking_id_seq OWNED BY NONE;
+ALTER SEQUENCE reward_reward_id_seq OWNED BY NONE;
+-- Free the index names for the new tables.
+ALTER TABLE reward_unpartitioned DROP CONSTRAINT reward_pkey;
+ALTER TABLE booking_unpartitioned DROP CONSTRAINT booking_pkey CASCADE;
+ALTER TABLE booking_unpartitioned DROP CONSTRAINT IF EXISTS booking_stay_no_overlap;
+DROP INDEX IF EXISTS booking_renter_idx, booking_prop_idx, booking_card_idx, reward_booking_idx;
+
+CREATE TABLE BOOKING (
+    booking_id   INT NOT NULL DEFAULT nextval('booking_booking_id_seq'),
+    prop_id      INT NOT NULL REFERENCES PROPERTY(prop_id) ON DELETE CASCADE,
+    renter_id    INT NOT NULL REFERENCES RENTER(renter_id) ON DELETE CASCADE,
+    card_id      INT NOT NULL REFERENCES CARD_DETAILS(card_id) ON DELETE CASCADE,
+    booking_date DATE NOT NULL,
+    stay         daterange,
+    PRIMARY KEY (booking_id, booking_date),
+    CONSTRAINT booking_stay_not_empty CHECK (NOT isempty(stay) AND lower(stay) = booking_date)
+) PARTITION BY RANGE (booking_date);
+
+CREATE TABLE REWARD (
+    reward_id    INT NOT NULL DEFAULT nextval('reward_reward_id_seq'),
+    booking_id   INT NOT NULL,
+    booking_date DATE NOT NULL,
+    renter_id    INT NOT NULL REFERENCES RENTER(renter_id) ON DELETE CASCADE,
+    points       INT,
+    PRIMARY KEY (reward_id, booking_date),
+    FOREIGN KEY (booking_id, booking_date)
+        REFERENCES BOOKING (booking_id, booking_date) ON DELETE CASCADE
+) PARTITION BY RANGE (booking_date);
+
+ALTER SEQUENCE booking_booking_id_seq OWNED BY BOOKING.booking_id;
+ALTER SEQUENCE reward_reward_id_seq OWNED BY REWARD.reward_id;
+
+-- Same access paths as 0001, created on every partition.
+CREATE INDEX booking_renter_idx ON BOOKING (renter_id, booking_id DESC);
+CREATE INDEX booking_prop_idx ON BOOKING (prop_id, booking_id DESC);
+CREATE INDEX booking_card_idx ON BOOKING (card_id);
+CREATE INDEX reward_booking_idx ON REWARD (booking_id) INCLUDE (points);
+
+-- One BOOKING and one REWARD partition per month from first_month to
+-- last_month; months that already have one are skipped. Returns how many
+-- partitions were created.
+CREATE OR REPLACE FUNCTION create_booking_partitions(first_month date, last_month date)
+RETURNS int
+LANGUAGE plpgsql AS $$
+DECLARE
+    month date := date_trunc('month', first_month);
+    parent text;
+    created int := 0;
+BEGIN
+    WHILE month <= last_month LOOP
+        FOREACH parent IN ARRAY ARRAY['booking', 'reward'] LOOP
+            IF to_regclass(parent || '_p' || to_char(month, 'YYYY_MM')) IS NULL THEN
+                EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                               parent || '_p' || to_char(month, 'YYYY_MM'), parent,
+                               month, (month + interval '1 month')::date);
+                created := created + 1;
+            END IF;
+        END LOOP;
+        month := (month + interval '1 month')::date;
+    END LOOP;
+    RETURN created;
+END;
+$$;
+
+SELECT create_booking_partitions(COALESCE(min(booking_date), current_date),
+                                 GREATEST(max(booking_date), (current_date + interval '12 months')::date))
+FROM booking_unpartitioned;
+
+INSERT INTO BOOKING (booking_id, prop_id, renter_id, card_id, booking_date, stay)
+SELECT booking_id, prop_id, renter_id, card_id, booking_date, stay
+FROM booking_unpartitioned;
+
+INSERT INTO REWARD (reward_id, booking_id, booking_date, renter_id, points)
+SELECT rw.reward_id, rw.booking_id, b.booking_date, rw.renter_id, rw.points
+FROM reward_unpartitioned rw
+JOIN booking_unpartitioned b ON b.booking_id = rw.booking_id;
+
+DROP TABLE reward_unpartitioned, booking_unpartitioned CASCADE;
+
+-- ---------------------------------------------------------------------
+-- BOOKING_STAY: the overlap exclusion, unpartitioned
+-- ---------------------------------------------------------------------
+CREATE TABLE IF NOT EXISTS BOOKING_STAY (
+    booking_id   INT PRIMARY KEY,
+    booking_date DATE NOT NULL,
+    prop_id      INT NOT NULL REFERENCES PROPERTY(prop_id) ON DELETE CASCADE,
+    stay         daterange
+);
+
+INSERT INTO BOOKING_STAY (booking_id, booking_date, prop_id, stay)
+SELECT booking_id, booking_date, prop_id, stay FROM BOOKING;
+
+-- Rejects overlapping stays of a listing, and answers /search's
+-- "available from/to" probe (see 0004).
+ALTER TABLE BOOKING_STAY ADD CONSTRAINT booking_stay_no_overlap
+    EXCLUDE USING gist (prop_id WITH =, stay WITH &&);
+
+CREATE OR REPLACE FUNCTION booking_stay_sync() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM BOOKING_STAY s USING old_rows o WHERE s.booking_id = o.booking_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        -- An overlap fails the booking's own statement with
+        -- booking_stay_no_overlap, exactly as before.
+        INSERT INTO BOOKING_STAY (booking_id, booking_date, prop_id, stay)
+        SELECT booking_id, booking_date, prop_id, stay FROM new_rows
+        ORDER BY prop_id, booking_id;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+-- ---------------------------------------------------------------------
+-- What archived months leave behind (written by partitions.py)
+-- ---------------------------------------------------------------------
+CREATE TABLE IF NOT EXISTS REWARD_ARCHIVE_TOTAL (
+    renter_id INT PRIMARY KEY REFERENCES RENTER(renter_id) ON DELETE CASCADE,
+    points    BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS BOOKING_ARCHIVE_DAY (
+    prop_id   INT NOT NULL REFERENCES PROPERTY(prop_id) ON DELETE CASCADE,
+    day       DATE NOT NULL,
+    check_ins INT NOT NULL DEFAULT 0,
+    nights    INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (prop_id, day)
+);
+
+CREATE TABLE IF NOT EXISTS CARD_ARCHIVE_USE (
+    card_id  INT PRIMARY KEY REFERENCES CARD_DETAILS(card_id) ON DELETE CASCADE,
+    bookings BIGINT NOT NULL DEFAULT 0
+);
+
+-- ---------------------------------------------------------------------
+-- Triggers: the old tables' triggers (0003, 0005, 0006) went with them.
+-- Statement-level triggers with transition tables on the partitioned
+-- parent see the rows of every partition.
+-- ---------------------------------------------------------------------
+DO $$
+DECLARE
+    target record;
+    event text;
+    referencing text;
+BEGIN
+    FOR target IN
+        SELECT * FROM (VALUES
+            ('booking', 'notify', 'notify_change(''booking_id'', ''renter_id'', ''prop_id'')'),
+            ('reward',  'notify', 'notify_change(''booking_id'', ''renter_id'')'),
+            ('reward',  'ledger', 'reward_ledger_apply()'),
+            ('booking', 'rollup', 'rollup_booking_change()'),
+            ('booking', 'stay',   'booking_stay_sync()')
+        ) AS t(tbl, kind, func)
+    LOOP
+        FOREACH event IN ARRAY ARRAY['insert', 'update', 'delete', 'truncate'] LOOP
+            -- Only the change feed has anything to say about a TRUNCATE.
+            CONTINUE WHEN event = 'truncate' AND target.kind <> 'notify';
+            referencing := CASE event
+                WHEN 'insert' THEN 'REFERENCING NEW TABLE AS new_rows'
+                WHEN 'update' THEN 'REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows'
+                WHEN 'delete' THEN 'REFERENCING OLD TABLE AS old_rows'
+                ELSE ''
+            END;
+            EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I',
+                           target.tbl || '_' || target.kind || '_' || event, target.tbl);
+            EXECUTE format('CREATE TRIGGER %I AFTER %s ON %I %s
+                                FOR EACH STATEMENT EXECUTE FUNCTION %s',
+                           target.tbl || '_' || target.kind || '_' || event, upper(event),
+                           target.tbl, referencing, target.func);
+        END LOOP;
+    END LOOP;
+END;
+$$;
@@ -0,0 +1,36 @@
+-- =====================================================================
+-- 0008: a per-session switch for bulk loads
+-- The reward balance (0005) and analytics rollup (0006) insert triggers
+-- would fire for every COPY chunk of a bulk load, and parallel loaders
+-- would queue on the same balance and rollup rows. They now skip
+-- statements run with
+--
+--     SET werent.bulk_load = on;
+--
+-- in the loading session only; every other session keeps them. The
+-- loader then brings balances and rollups up to date in one pass
+-- (rewards.py --fix, rollups.py refresh), as datagen.py does. Unlike
+-- ALTER TABLE ... DISABLE TRIGGER, this takes no lock and cannot leave
+-- the triggers off for the application.
+-- =====================================================================
+
+DO $$
+DECLARE
+    target record;
+BEGIN
+    FOR target IN
+        SELECT * FROM (VALUES
+            ('reward',  'reward_ledger_insert',  'reward_ledger_apply()'),
+            ('booking', 'booking_rollup_insert', 'rollup_booking_change()')
+        ) AS t(tbl, name, func)
+    LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', target.name, target.tbl);
+        EXECUTE format('CREATE TRIGGER %I AFTER INSERT ON %I
+                            REFERENCING NEW TABLE AS new_rows
+                            FOR EACH STATEMENT
+                            WHEN (COALESCE(current_setting(''werent.bulk_load'', true), '''') <> ''on'')
+                            EXECUTE FUNCTION %s',
+                       target.name, target.tbl, target.func);
+    END LOOP;
+END;
+$$;
@@ -0,0 +1,437 @@
+"""Create, freeze and archive the monthly BOOKING / REWARD partitions.
+
+migrations/0007 partitions BOOKING and REWARD by month of booking_date.
+This job keeps them in shape; run it daily (e.g. from cron):
+
+``maintain`` creates the partitions for the next PARTITION_MONTHS_AHEAD
+months, so bookings can always be made that far ahead (a check-in in a
+month without a partition is refused). It also VACUUM FREEZEs the months
+that have ended, which are written to rarely if ever after that, so later
+vacuums skip their pages. Finally it ANALYZEs the partitioned parents,
+which autovacuum never does.
+
+``archive`` moves every month that ended more than ARCHIVE_AFTER_MONTHS
+ago to the cold store in ARCHIVE_DIR. Per month, in one transaction: the
+two partitions are locked against writes, exported with COPY to
+gzip-compressed files, their reward points, booking days and card use are
+added to REWARD_ARCHIVE_TOTAL / BOOKING_ARCHIVE_DAY / CARD_ARCHIVE_USE (so
+balances and rollups still reconcile and the cards stay in use), their
+stays leave BOOKING_STAY, and they are detached and dropped. Before the
+commit the month is listed in ARCHIVE_DIR/manifest.json as pending, and
+after it confirmed; a month a crashed run left pending is settled by the
+next one from whether its partitions still exist. Detaching needs a brief
+exclusive lock on the parent tables; if it cannot get one within
+ARCHIVE_LOCK_TIMEOUT the month is left for the next run.
+
+``search`` reads archived bookings back on demand, as do /my_bookings and
+/agent_bookings (?history=archive) through archived_bookings(), so the web
+workers need read access to ARCHIVE_DIR. Each BOOKING file has an index of
+its renter, listing and booking ids next to it, and only the months whose
+index matches are decompressed. The files are plain
+COPY text, so a month can also be loaded back into a table with
+``COPY ... FROM PROGRAM 'gzip -dc <file>'``.
+
+Usage:
+    python partitions.py                        # list partitions and archived months
+    python partitions.py maintain
+    python partitions.py archive
+    python partitions.py search --renter 40     # or --prop / --booking
+"""
+import argparse
+import datetime
+import functools
+import gzip
+import json
+import os
+import sys
+import time
+
+from db import get_connection
+
+PARTITION_MONTHS_AHEAD = int(os.environ.get("PARTITION_MONTHS_AHEAD", "12"))
+ARCHIVE_AFTER_MONTHS = int(os.environ.get("ARCHIVE_AFTER_MONTHS", "24"))
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+ARCHIVE_LOCK_TIMEOUT = os.environ.get("ARCHIVE_LOCK_TIMEOUT", "2s")
+
+# Columns exported per table, in file order.
+ARCHIVE_COLUMNS = {
+    "booking": ["booking_id", "prop_id", "renter_id", "card_id", "booking_date", "stay"],
+    "reward": ["reward_id", "booking_id", "booking_date", "renter_id", "points"],
+}
+
+PARTITIONS = """
+    SELECT c.relname, p.relname, pg_get_expr(c.relpartbound, c.oid),
+           c.reltuples::bigint, pg_total_relation_size(c.oid)
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    JOIN pg_class p ON p.oid = i.inhparent
+    WHERE p.relname IN ('booking', 'reward')
+    ORDER BY c.relname;
+"""
+
+ARCHIVE_STEPS = [
+    """
+    INSERT INTO REWARD_ARCHIVE_TOTAL AS t (renter_id, points)
+    SELECT renter_id, sum(COALESCE(points, 0)) FROM {reward}
+    GROUP BY renter_id
+    ORDER BY renter_id
+    ON CONFLICT (renter_id) DO UPDATE SET points = t.points + EXCLUDED.points;
+    """,
+    """
+    INSERT INTO BOOKING_ARCHIVE_DAY AS t (prop_id, day, check_ins, nights)
+    SELECT b.prop_id, d.day, sum(d.check_ins), sum(d.nights)
+    FROM {booking} b, booking_rollup_days(b.booking_date, b.stay, 0, 1) d
+    GROUP BY b.prop_id, d.day
+    ORDER BY b.prop_id, d.day
+    ON CONFLICT (prop_id, day) DO UPDATE
+        SET check_ins = t.check_ins + EXCLUDED.check_ins,
+            nights = t.nights + EXCLUDED.nights;
+    """,
+    """
+    INSERT INTO CARD_ARCHIVE_USE AS t (card_id, bookings)
+    SELECT card_id, count(*) FROM {booking}
+    GROUP BY card_id
+    ORDER BY card_id
+    ON CONFLICT (card_id) DO UPDATE SET bookings = t.bookings + EXCLUDED.bookings;
+    """,
+    "DELETE FROM BOOKING_STAY s USING {booking} b WHERE s.booking_id = b.booking_id;",
+    # A detached REWARD partition keeps its foreign key to BOOKING, which
+    # would refuse to let the BOOKING partition go; drop it first.
+    "ALTER TABLE REWARD DETACH PARTITION {reward};",
+    "DROP TABLE {reward};",
+    "ALTER TABLE BOOKING DETACH PARTITION {booking};",
+    "DROP TABLE {booking};",
+]
+
+
+def month_start(day, months=0):
+    """First day of the month ``months`` after (or before) ``day``'s."""
+    index = day.year * 12 + day.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_p{month:%Y_%m}"
+
+
+def attached_months(cur):
+    """Months that have a BOOKING partition, oldest first."""
+    cur.execute(PARTITIONS)
+    return sorted(
+        datetime.datetime.strptime(name[-7:], "%Y_%m").date()
+        for name, parent, _, _, _ in cur.fetchall() if parent == "booking"
+    )
+
+
+def maintain(out=sys.stdout, today=None):
+    """Create upcoming partitions, freeze ended months, analyze the parents."""
+    started = time.monotonic()
+    today = today or datetime.date.today()
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT create_booking_partitions(%s, %s);",
+                        (month_start(today), month_start(today, PARTITION_MONTHS_AHEAD)))
+            created = cur.fetchone()[0]
+            conn.commit()
+            print(f"{created} partitions created", file=out)
+
+            # VACUUM cannot run inside a transaction.
+            conn.autocommit = True
+            # The two months before this one: last month just ended, and the
+            # one before catches a missed run. Frozen pages are skipped, so
+            # freezing a month again costs little.
+            months = set(attached_months(cur))
+            for month in (month_start(today, -2), month_start(today, -1)):
+                if month in months:
+                    for table in ARCHIVE_COLUMNS:
+                        cur.execute(f"VACUUM (FREEZE, ANALYZE) {partition_name(table, month)};")
+                    print(f"froze {month:%Y-%m}", file=out)
+            cur.execute("ANALYZE BOOKING, REWARD;")
+    finally:
+        conn.close()
+    print(f"maintained in {time.monotonic() - started:.1f}s", file=out)
+    return created
+
+
+def _manifest_path():
+    return os.path.join(ARCHIVE_DIR, "manifest.json")
+
+
+def read_manifest():
+    try:
+        with open(_manifest_path()) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"partitions": []}
+
+
+def _write_manifest(manifest):
+    path = _manifest_path()
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def _export(cur, table, name):
+    """COPY one partition to ARCHIVE_DIR/<name>.tsv.gz; return its row count."""
+    cur.execute(f"SELECT count(*) FROM {name};")
+    rows = cur.fetchone()[0]
+    path = os.path.join(ARCHIVE_DIR, name + ".tsv.gz")
+    with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+        cur.copy_expert(f"COPY {name} ({', '.join(ARCHIVE_COLUMNS[table])}) TO STDOUT", f)
+    os.replace(path + ".tmp", path)
+    return rows
+
+
+def _write_index(cur, name):
+    """Write the ids in one BOOKING partition to ARCHIVE_DIR/<name>.idx.json.
+
+    archived_bookings() opens only the months whose index has the renter,
+    listing or booking asked for.
+    """
+    cur.execute(f"""
+        SELECT COALESCE(array_agg(DISTINCT renter_id), '{{}}'),
+               COALESCE(array_agg(DISTINCT prop_id), '{{}}'),
+               min(booking_id), max(booking_id)
+        FROM {name};
+    """)
+    renters, props, first, last = cur.fetchone()
+    index = {"renter_id": renters, "prop_id": props, "booking_id": [first, last]}
+    path = os.path.join(ARCHIVE_DIR, name + ".idx.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+    os.replace(path + ".tmp", path)
+    return name + ".idx.json"
+
+
+def archive_month(conn, month):
+    """Export one month and detach it, uncommitted; return its manifest entries.
+
+    The entries are marked pending: the caller lists them in the manifest
+    before it commits and confirms them after.
+    """
+    names = {table: partition_name(table, month) for table in ARCHIVE_COLUMNS}
+    entries = []
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL lock_timeout = %s;", (ARCHIVE_LOCK_TIMEOUT,))
+        # Writes to the month wait; reads carry on until the detach.
+        cur.execute(f"LOCK TABLE {names['booking']}, {names['reward']} IN SHARE MODE;")
+        for table, name in names.items():
+            entries.append({
+                "name": name,
+                "table": table.upper(),
+                "from": month.isoformat(),
+                "to": month_start(month, 1).isoformat(),
+                "rows": _export(cur, table, name),
+                "file": name + ".tsv.gz",
+                "columns": ARCHIVE_COLUMNS[table],
+                "archived_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "pending": True,
+            })
+            if table == "booking":
+                entries[-1]["index"] = _write_index(cur, name)
+        for sql in ARCHIVE_STEPS:
+            cur.execute(sql.format(**names))
+    return entries
+
+
+def settle_pending(cur, manifest):
+    """Resolve entries a run left pending; return how many months it settled.
+
+    A run that stopped between listing a month and confirming it leaves
+    its entries pending, and whether its commit happened is not known.
+    The month's partitions tell: if they are gone the month was archived
+    and its entries are confirmed, otherwise they are removed and the
+    month is archived again.
+    """
+    pending = [e for e in manifest["partitions"] if e.get("pending")]
+    if not pending:
+        return 0
+    cur.execute("SELECT name FROM unnest(%s::text[]) AS name WHERE to_regclass(name) IS NOT NULL;",
+                ([e["name"] for e in pending],))
+    attached = {name for name, in cur.fetchall()}
+    manifest["partitions"] = [e for e in manifest["partitions"] if e["name"] not in attached]
+    for entry in pending:
+        entry.pop("pending")
+    _write_manifest(manifest)
+    return len({e["from"] for e in pending})
+
+
+def archive(out=sys.stdout, today=None):
+    """Archive every month older than ARCHIVE_AFTER_MONTHS; return how many."""
+    started = time.monotonic()
+    horizon = month_start(today or datetime.date.today(), -ARCHIVE_AFTER_MONTHS)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    manifest = read_manifest()
+    archived = 0
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            if settle_pending(cur, manifest):
+                print("settled the months an earlier run left pending", file=out)
+            months = [m for m in attached_months(cur) if m < horizon]
+        conn.commit()
+        for month in months:
+            try:
+                entries = archive_month(conn, month)
+            except Exception as exc:
+                # Later months wait too, so the archive stays contiguous.
+                conn.rollback()
+                print(f"{month:%Y-%m}: not archived ({str(exc).strip()})", file=out)
+                break
+            # Listed before the commit, so a month that is gone from the
+            # database is always in the manifest; see settle_pending().
+            manifest["partitions"].extend(entries)
+            _write_manifest(manifest)
+            try:
+                conn.commit()
+            except Exception as exc:
+                print(f"{month:%Y-%m}: left pending, settled by the next run "
+                      f"({str(exc).strip()})", file=out)
+                break
+            for entry in entries:
+                entry.pop("pending")
+            _write_manifest(manifest)
+            archived += 1
+            rows = ", ".join(f"{e['rows']:,} {e['table']}" for e in entries)
+            print(f"{month:%Y-%m}: archived {rows}", file=out)
+    finally:
+        conn.close()
+    print(f"{archived} months archived in {time.monotonic() - started:.1f}s", file=out)
+    return archived
+
+
+def _read_rows(entry):
+    with gzip.open(os.path.join(ARCHIVE_DIR, entry["file"]), "rt", encoding="utf-8") as f:
+        for line in f:
+            values = [None if v == "\\N" else v for v in line.rstrip("\n").split("\t")]
+            yield dict(zip(entry["columns"], values))
+
+
+def _archived(entries):
+    """The confirmed entries; a pending month may still be in the database."""
+    return [e for e in entries if not e.get("pending")]
+
+
+def archived_through(manifest=None):
+    """First day after the archived months, or None if nothing is archived.
+
+    Months are archived oldest first, so every booking dated before this
+    day is in the cold store rather than in BOOKING.
+    """
+    entries = _archived((manifest or read_manifest())["partitions"])
+    return max((datetime.date.fromisoformat(e["to"]) for e in entries), default=None)
+
+
+@functools.lru_cache(maxsize=1024)
+def _read_index(filename, archived_at):
+    """One month's index as sets of text ids; files never change once
+    written, and a month archived again gets a new archived_at."""
+    with open(os.path.join(ARCHIVE_DIR, filename)) as f:
+        index = json.load(f)
+    first, last = index.pop("booking_id")
+    return {key: {str(v) for v in ids} for key, ids in index.items()}, first, last
+
+
+def _may_match(entry, wanted):
+    """False when the month's index rules out every wanted row."""
+    if "index" not in entry:
+        return True
+    ids, first, last = _read_index(entry["index"], entry["archived_at"])
+    for key, values in wanted.items():
+        if key == "booking_id":
+            if first is None or not any(first <= int(v) <= last for v in values):
+                return False
+        elif ids[key].isdisjoint(values):
+            return False
+    return True
+
+
+def archived_bookings(renter=None, props=None, booking=None):
+    """Yield the archived bookings matching every given filter, newest first.
+
+    Each is a dict of ARCHIVE_COLUMNS["booking"] (as text) plus its
+    "points". ``props`` is a collection of prop_ids.
+    """
+    wanted = {key: {str(v) for v in values} for key, values in
+              (("renter_id", None if renter is None else [renter]), ("prop_id", props),
+               ("booking_id", None if booking is None else [booking]))
+              if values is not None}
+    entries = _archived(read_manifest()["partitions"])
+    bookings = sorted((e for e in entries if e["table"] == "BOOKING"),
+                      key=lambda e: e["from"], reverse=True)
+    for entry in bookings:
+        if not _may_match(entry, wanted):
+            continue
+        rows = [row for row in _read_rows(entry)
+                if all(row[key] in values for key, values in wanted.items())]
+        if not rows:
+            continue
+        ids = {row["booking_id"] for row in rows}
+        points = {}
+        for reward in entries:
+            if reward["table"] == "REWARD" and reward["from"] == entry["from"]:
+                points = {r["booking_id"]: r["points"] for r in _read_rows(reward)
+                          if r["booking_id"] in ids}
+        rows.sort(key=lambda row: int(row["booking_id"]), reverse=True)
+        for row in rows:
+            row["points"] = points.get(row["booking_id"])
+            yield row
+
+
+def search(renter=None, prop=None, booking=None, out=sys.stdout):
+    """Print the archived bookings matching every given id, with their points."""
+    columns = ARCHIVE_COLUMNS["booking"] + ["points"]
+    found = 0
+    print("\t".join(columns), file=out)
+    for row in archived_bookings(renter, None if prop is None else [prop], booking):
+        print("\t".join("" if row[c] is None else row[c] for c in columns), file=out)
+        found += 1
+    print(f"{found:,} archived bookings", file=out)
+    return found
+
+
+def status(out=sys.stdout):
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(PARTITIONS)
+            for name, parent, bound, rows, size in cur.fetchall():
+                print(f"{name:20} {bound:60} ~{max(rows, 0):>11,} rows {size / 2**20:9.1f} MiB",
+                      file=out)
+        conn.rollback()
+    finally:
+        conn.close()
+    entries = read_manifest()["partitions"]
+    for entry in entries:
+        state = "pending " if entry.get("pending") else "archived"
+        print(f"{entry['name']:20} {state} {entry['archived_at'][:10]} "
+              f"{entry['rows']:>11,} rows  {entry['file']}", file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", nargs="?", default="status",
+                        choices=["status", "maintain", "archive", "search"])
+    parser.add_argument("--renter", type=int)
+    parser.add_argument("--prop", type=int)
+    parser.add_argument("--booking", type=int)
+    args = parser.parse_args(argv)
+    if args.command == "maintain":
+        maintain()
+    elif args.command == "archive":
+        archive()
+    elif args.command == "search":
+        if args.renter is None and args.prop is None and args.booking is None:
+            parser.error("search needs --renter, --prop or --booking")
+        search(args.renter, args.prop, args.booking)
+    else:
+        status()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""Opt-in per-request profiling.
+
+Disabled unless PROFILE_TOKEN is set. A request carrying that token in an
+``X-Profile`` header or a ``_profile`` query parameter runs under cProfile,
+including the streamed part of the body, and the profile is written to
+PROFILE_DIR as ``<time>-<endpoint>-<pid>.prof`` (open it with pstats or
+snakeviz) plus a ``.txt`` summary of the most expensive calls. The file name
+is returned in the ``X-Profile-File`` response header.
+
+One profile runs at a time per process: cProfile hooks the interpreter, so
+requests profiled concurrently by threaded workers would mix their stats
+(and Python 3.12 refuses a second profiler outright). A profiled request
+that arrives while another is running is served unprofiled, with an
+``X-Profile-Skipped`` response header saying so.
+"""
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import threading
+import time
+
+from flask import g, request
+
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_TOP = 40
+
+# Held from start_profile until the profile is saved.
+_running = threading.Lock()
+
+
+def requested():
+    token = request.headers.get("X-Profile") or request.args.get("_profile")
+    return bool(PROFILE_TOKEN and token and hmac.compare_digest(token, PROFILE_TOKEN))
+
+
+def start_profile():
+    if requested():
+        if not _running.acquire(blocking=False):
+            g.profile_skipped = True
+            return
+        g.profiler = cProfile.Profile()
+        g.profile_name = "%s-%s-%d" % (
+            time.strftime("%Y%m%dT%H%M%S"), request.endpoint or "none", os.getpid())
+        g.profiler.enable()
+
+
+def _save(profiler, name):
+    try:
+        _write(profiler, name)
+    finally:
+        _running.release()
+
+
+def _write(profiler, name):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, name)
+    profiler.dump_stats(path + ".prof")
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(PROFILE_TOP)
+    with open(path + ".txt", "w") as f:
+        f.write(summary.getvalue())
+
+
+def _profile_stream(body, profiler, name):
+    profiler.enable()
+    try:
+        yield from body
+    finally:
+        profiler.disable()
+        _save(profiler, name)
+
+
+def stop_profile(response):
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        if g.pop("profile_skipped", False):
+            response.headers["X-Profile-Skipped"] = "another profile is running"
+        return response
+    profiler.disable()
+    name = g.pop("profile_name")
+    if response.is_streamed:
+        # Most of a streamed page is rendered after this hook returns.
+        response.response = _profile_stream(response.response, profiler, name)
+    else:
+        _save(profiler, name)
+    response.headers["X-Profile-File"] = name + ".prof"
+    return response
+
+
+def release_profile(exc):
+    """Let the next profile run if this request ended without stop_profile."""
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        _running.release()
+
+
+def init_app(app):
+    if PROFILE_TOKEN:
+        app.before_request(start_profile)
+        app.after_request(stop_profile)
+        app.teardown_request(release_profile)
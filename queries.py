@@ -0,0 +1,422 @@
+# ===========================================================
+# SQL FOR THE ROUTES IN app.py
+# ===========================================================
+# Every statement that filters rows (SELECT / DELETE) lives here under a
+# name, so the same text is used by the routes and by explain_check.py,
+# which verifies each one still has an index-backed plan.
+
+RENTER_LOGIN = """
+    SELECT r.renter_id, u.first_name
+    FROM RENTER r
+    JOIN "USER" u ON r.user_id = u.user_id
+    WHERE u.email = %s;
+"""
+
+AGENT_LOGIN = """
+    SELECT a.agent_id, u.first_name
+    FROM AGENT a
+    JOIN "USER" u ON a.user_id = u.user_id
+    WHERE u.email = %s;
+"""
+
+AGENT_PROPERTIES = """
+    SELECT p.prop_id, a.line_1, a.city, a.state_,
+           p.price, pc.category_name, pd.rooms
+    FROM PROPERTY p
+    JOIN ADDRESS a ON p.address_id = a.address_id
+    JOIN PROPERTY_DETAILS pd ON p.prop_id = pd.prop_id
+    JOIN PROPERTY_CATEGORY pc ON pd.property_category_id = pc.property_category_id
+    WHERE p.agent_id = %s
+    ORDER BY p.prop_id;
+"""
+
+DELETE_AGENT_PROPERTY = """
+    DELETE FROM PROPERTY p
+    USING ADDRESS a
+    WHERE p.prop_id = %s AND p.agent_id = %s AND a.address_id = p.address_id
+    RETURNING a.city;
+"""
+
+# The booking lists take the earliest booking_date to show (app.py: the
+# recent window, or date.min in history mode); BOOKING partitions of
+# earlier months are pruned from the plan.
+AGENT_BOOKINGS = """
+    SELECT b.booking_id, b.booking_date,
+           p.prop_id, a.line_1, a.city, p.price,
+           u.email AS renter_email
+    FROM BOOKING b
+    JOIN PROPERTY p ON b.prop_id = p.prop_id
+    JOIN ADDRESS a ON p.address_id = a.address_id
+    JOIN RENTER r ON b.renter_id = r.renter_id
+    JOIN "USER" u ON r.user_id = u.user_id
+    WHERE p.agent_id = %s AND b.booking_date >= %s
+    ORDER BY b.booking_id DESC;
+"""
+
+# agent_analytics reads only the rollups of migrations/0006, never BOOKING.
+AGENT_ROLLUP_PROPERTIES = """
+    SELECT prop_id, city, bookings, nights, revenue
+    FROM PROPERTY_ROLLUP
+    WHERE agent_id = %s
+    ORDER BY revenue DESC, prop_id;
+"""
+
+AGENT_ROLLUP_WEEKS = """
+    SELECT date_trunc('week', day)::date AS week,
+           sum(check_ins), sum(nights), sum(revenue)
+    FROM PROPERTY_DAILY_ROLLUP
+    WHERE agent_id = %s AND day >= %s AND day < %s
+    GROUP BY week
+    ORDER BY week;
+"""
+
+CATEGORIES = """
+    SELECT property_category_id, category_name
+    FROM PROPERTY_CATEGORY
+    ORDER BY category_name;
+"""
+
+RENTER_CARDS = """
+    SELECT c.card_id, c.card_no, c.name_on_card,
+           a.line_1, a.city, a.state_
+    FROM CARD_DETAILS c
+    JOIN ADDRESS a ON c.billing_address_id = a.address_id
+    WHERE c.renter_id = %s
+    ORDER BY c.card_id;
+"""
+
+# A card stays in use after its bookings are archived (CARD_ARCHIVE_USE).
+CARD_IN_USE = """
+    SELECT 1 FROM BOOKING WHERE card_id = %s
+    UNION ALL
+    SELECT 1 FROM CARD_ARCHIVE_USE WHERE card_id = %s AND bookings > 0
+    LIMIT 1;
+"""
+
+DELETE_RENTER_CARD = "DELETE FROM CARD_DETAILS WHERE card_id = %s AND renter_id = %s;"
+
+PROPERTY_FOR_BOOKING = """
+    SELECT p.prop_id, a.line_1, a.city, a.state_,
+           p.price, pd.rooms, pc.category_name
+    FROM PROPERTY p
+    JOIN ADDRESS a ON p.address_id = a.address_id
+    JOIN PROPERTY_DETAILS pd ON p.prop_id = pd.prop_id
+    JOIN PROPERTY_CATEGORY pc ON pd.property_category_id = pc.property_category_id
+    WHERE p.prop_id = %s;
+"""
+
+RENTER_CARD_CHOICES = """
+    SELECT card_id, card_no, name_on_card
+    FROM CARD_DETAILS
+    WHERE renter_id = %s
+    ORDER BY card_id;
+"""
+
+RENTER_BOOKINGS = """
+    SELECT b.booking_id, b.booking_date,
+           p.prop_id, a.line_1, a.city, p.price,
+           COALESCE(rw.points, 0)
+    FROM BOOKING b
+    JOIN PROPERTY p ON b.prop_id = p.prop_id
+    JOIN ADDRESS a ON p.address_id = a.address_id
+    LEFT JOIN REWARD rw ON b.booking_id = rw.booking_id
+                       AND b.booking_date = rw.booking_date AND rw.booking_date >= %s
+    WHERE b.renter_id = %s AND b.booking_date >= %s
+    ORDER BY b.booking_id DESC;
+"""
+
+# Archived bookings come from the cold store (partitions.archived_bookings);
+# these fill in what the live tables still know about them.
+PROPERTY_SUMMARIES = """
+    SELECT p.prop_id, a.line_1, a.city, p.price
+    FROM PROPERTY p
+    JOIN ADDRESS a ON p.address_id = a.address_id
+    WHERE p.prop_id = ANY(%s);
+"""
+
+RENTER_EMAILS = """
+    SELECT r.renter_id, u.email
+    FROM RENTER r
+    JOIN "USER" u ON r.user_id = u.user_id
+    WHERE r.renter_id = ANY(%s);
+"""
+
+# BOOKING_STAY maps a booking_id to its booking_date, i.e. its partition;
+# the scalar subquery runs first, so only that partition is touched.
+DELETE_BOOKING_REWARD = """
+    DELETE FROM REWARD
+    WHERE booking_id = %s AND renter_id = %s
+      AND booking_date = (SELECT booking_date FROM BOOKING_STAY WHERE booking_id = %s);
+"""
+
+# REWARD_BALANCE / REWARD_LEDGER are maintained by migrations/0005's
+# trigger on REWARD; the routes only read them.
+RENTER_REWARD_BALANCE = "SELECT points FROM REWARD_BALANCE WHERE renter_id = %s;"
+
+# Newest first, one page at a time: pass the last entry_id shown to get the
+# next (older) page; REWARD_HISTORY_START for the first one.
+REWARD_HISTORY_START = 2**63 - 1
+
+RENTER_REWARD_HISTORY = """
+    SELECT entry_id, created_at, booking_id, delta, balance_after, reason
+    FROM REWARD_LEDGER
+    WHERE renter_id = %s AND entry_id < %s
+    ORDER BY entry_id DESC
+    LIMIT %s;
+"""
+
+DELETE_RENTER_BOOKING = """
+    DELETE FROM BOOKING
+    WHERE booking_id = %s AND renter_id = %s
+      AND booking_date = (SELECT booking_date FROM BOOKING_STAY WHERE booking_id = %s);
+"""
+
+# Run on nearly every request: app.py registers these with db.prepare() so
+# each pooled connection parses and plans them once. Streamed statements
+# (db.iter_rows) are not listed, since a server-side cursor cannot be
+# declared over EXECUTE.
+PREPARED = {
+    "renter_login": RENTER_LOGIN,
+    "agent_login": AGENT_LOGIN,
+    "agent_properties": AGENT_PROPERTIES,
+    "agent_rollup_properties": AGENT_ROLLUP_PROPERTIES,
+    "agent_rollup_weeks": AGENT_ROLLUP_WEEKS,
+    "property_for_booking": PROPERTY_FOR_BOOKING,
+    "renter_card_choices": RENTER_CARD_CHOICES,
+    "renter_reward_balance": RENTER_REWARD_BALANCE,
+    "renter_reward_history": RENTER_REWARD_HISTORY,
+}
+
+
+# ===========================================================
+# SEARCH
+# ===========================================================
+# Each sort option maps to a NULL-free sort expression. p.prop_id is always
+# appended as a tie-breaker, so every row has a unique, stable position and
+# pages can be fetched by seeking past a (sort value, prop_id) cursor
+# instead of OFFSET-scanning. NULL prices/rooms still sort last.
+# migrations/0001 indexes the price and rooms expressions verbatim.
+SEARCH_SORT_KEYS = {
+    "price": "COALESCE(p.price, 99999999.99)",
+    "rooms": "COALESCE(pd.rooms, 2147483647)",
+    "city": "COALESCE(a.city, '')",
+    # Best match first; only valid with a keyword query (see below).
+    "relevance": "-ts_rank_cd(pd.search_vector, query)",
+}
+
+SEARCH_FILTERS = ("q", "city", "min_price", "max_price", "category", "rooms",
+                  "available_from", "available_to")
+
+# ts_headline marks matches with private-use characters rather than tags:
+# the snippet is HTML-escaped like every other cell and the markers are
+# turned into <mark> afterwards, so description text can never inject HTML.
+HIGHLIGHT_START = "\ue000"
+HIGHLIGHT_STOP = "\ue001"
+HEADLINE_OPTIONS = (
+    f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, "
+    "MaxFragments=2, MaxWords=18, MinWords=6, FragmentDelimiter=\" … \""
+)
+
+
+# Price ranges offered as a facet: width_bucket() over these edges gives
+# bucket 0 (< 1000) up to bucket 4 (>= 5000).
+PRICE_BUCKET_EDGES = (1000, 2000, 3000, 5000)
+# The city facet lists only the most common cities among the matches.
+FACET_CITY_LIMIT = 10
+
+_SEARCH_JOINS = """
+        FROM PROPERTY p
+        JOIN ADDRESS a ON p.address_id = a.address_id
+        JOIN PROPERTY_DETAILS pd ON p.prop_id = pd.prop_id
+        JOIN PROPERTY_CATEGORY pc ON pd.property_category_id = pc.property_category_id"""
+
+
+def _search_filters(filters):
+    """(query join, its params, WHERE conditions, their params) for the filters.
+
+    A keyword query ``q`` (web-search syntax: words, "phrases", -exclusions,
+    OR) is parsed once in a CROSS JOIN and matched through the GIN index on
+    PROPERTY_DETAILS.search_vector.
+    """
+    query_join = ""
+    join_params = []
+    conditions = []
+    params = []
+
+    if filters.get("q"):
+        query_join = "CROSS JOIN websearch_to_tsquery('english', %s) AS query"
+        join_params.append(filters["q"])
+        conditions.append("pd.search_vector @@ query")
+    if filters["city"]:
+        conditions.append("LOWER(a.city) = LOWER(%s)")
+        params.append(filters["city"])
+    if filters["min_price"]:
+        conditions.append("p.price >= %s")
+        params.append(filters["min_price"])
+    if filters["max_price"]:
+        conditions.append("p.price <= %s")
+        params.append(filters["max_price"])
+    if filters["category"]:
+        conditions.append("pc.category_name = %s")
+        params.append(filters["category"])
+    if filters["rooms"]:
+        conditions.append("pd.rooms = %s")
+        params.append(filters["rooms"])
+    if filters.get("available_from"):
+        # Free for the whole stay [available_from, available_to): listed as
+        # available by then, and no booking overlaps it. The NOT EXISTS
+        # probe is an anti-join on the booking_stay_no_overlap GiST index
+        # of BOOKING_STAY (migrations/0007).
+        conditions.append("(p.date_of_availability IS NULL OR p.date_of_availability <= %s)")
+        conditions.append(
+            "NOT EXISTS (SELECT 1 FROM BOOKING_STAY s"
+            " WHERE s.prop_id = p.prop_id AND s.stay && daterange(%s, %s))"
+        )
+        params.extend([filters["available_from"], filters["available_from"], filters["available_to"]])
+    return query_join, join_params, conditions, params
+
+
+def _where(conditions):
+    return "WHERE " + " AND ".join(conditions) if conditions else ""
+
+
+def _facet_counts(filters):
+    """CTE counting every match per category, room count, price bucket and city.
+
+    One scan with GROUPING SETS; the result is a single JSON array of
+    [facet, value, count] triples.
+    """
+    query_join, join_params, conditions, params = _search_filters(filters)
+    edges = ", ".join(str(edge) for edge in PRICE_BUCKET_EDGES)
+    bucket = f"width_bucket(p.price, ARRAY[{edges}]::numeric[])"
+    sql = f"""
+        facet_counts AS (
+            SELECT COALESCE(json_agg(json_build_array(facet, value, n)
+                                     ORDER BY facet, n DESC, value), '[]') AS counts
+            FROM (
+                SELECT facet, value, n,
+                       row_number() OVER (PARTITION BY facet ORDER BY n DESC, value) AS rank
+                FROM (
+                    SELECT CASE WHEN GROUPING(pc.category_name) = 0 THEN 'category'
+                                WHEN GROUPING(pd.rooms) = 0 THEN 'rooms'
+                                WHEN GROUPING({bucket}) = 0 THEN 'price'
+                                ELSE 'city' END AS facet,
+                           COALESCE(pc.category_name, pd.rooms::text, ({bucket})::text, a.city) AS value,
+                           count(*) AS n
+                    {_SEARCH_JOINS}
+                    {query_join}
+                    {_where(conditions)}
+                    GROUP BY GROUPING SETS ((pc.category_name), (pd.rooms), ({bucket}), (a.city))
+                ) grouped
+                WHERE value IS NOT NULL
+            ) ranked
+            WHERE facet <> 'city' OR rank <= {FACET_CITY_LIMIT}
+        )"""
+    return sql, join_params + params
+
+
+def build_search_query(filters, sort_by, after=None, before=None, limit=None, facets=False):
+    """Return (sql, params) for the search results.
+
+    ``after`` / ``before`` are decoded cursors; ``before`` walks backwards
+    (descending order) and the caller reverses the rows. ``limit=None``
+    returns every remaining match, which is what the streaming mode uses.
+    With keywords every row carries a highlighted snippet; without them the
+    snippet is NULL.
+
+    ``facets=True`` computes the facet counts of all matches (ignoring the
+    cursor) in the same statement: each row then starts with an extra
+    column that is NULL except on exactly one row, which holds the counts,
+    and when nothing matches a single row of NULLs carries them.
+    """
+    query_join, join_params, conditions, params = _search_filters(filters)
+
+    snippet = "NULL::text"
+    if filters.get("q"):
+        # Evaluated after the LIMIT, so only for the rows actually shown.
+        snippet = (
+            "ts_headline('english', concat_ws(' · ', pd.description_, pd.business_type), "
+            f"query, '{HEADLINE_OPTIONS}')"
+        )
+
+    sort_key = SEARCH_SORT_KEYS[sort_by]
+    direction = "ASC"
+    if after is not None:
+        conditions.append(f"({sort_key}, p.prop_id) > (%s, %s)")
+        params.extend(after)
+    elif before is not None:
+        conditions.append(f"({sort_key}, p.prop_id) < (%s, %s)")
+        params.extend(before)
+        direction = "DESC"
+
+    limit_clause = ""
+    if limit is not None:
+        limit_clause = "LIMIT %s"
+        params.append(limit)
+
+    page_sql = f"""
+        SELECT p.prop_id, a.line_1, a.city, a.state_,
+               p.price, pd.rooms, pc.category_name,
+               {snippet} AS snippet,
+               {sort_key} AS sort_key
+        {_SEARCH_JOINS}
+        {query_join}
+        {_where(conditions)}
+        ORDER BY {sort_key} {direction}, p.prop_id {direction}
+        {limit_clause}"""
+    page_params = join_params + params
+    if not facets:
+        return page_sql + ";", tuple(page_params)
+
+    facet_sql, facet_params = _facet_counts(filters)
+    sql = f"""
+        WITH {facet_sql}
+        SELECT CASE WHEN row_number() OVER () = 1 THEN f.counts END AS facets, page.*
+        FROM facet_counts f
+        LEFT JOIN ({page_sql}
+        ) page ON true
+        ORDER BY page.sort_key {direction}, page.prop_id {direction};
+    """
+    return sql, tuple(facet_params + page_params)
+
+
+# ===========================================================
+# LISTING SNAPSHOT (snapshot.py)
+# ===========================================================
+# One row per searchable listing, in prop_id order, with the city replaced
+# by its rank in the database's collation order so the snapshot sorts
+# cities exactly as "ORDER BY COALESCE(a.city, '')" does. Read in the same
+# REPEATABLE READ transaction as SNAPSHOT_CITIES.
+SNAPSHOT_LISTINGS = """
+    SELECT p.prop_id, p.price, pd.rooms, pd.property_category_id,
+           dense_rank() OVER (ORDER BY COALESCE(a.city, '')) - 1 AS city_rank,
+           p.sq_ft, p.date_of_availability - DATE '1970-01-01',
+           p.utilities, p.parking
+    FROM PROPERTY p
+    JOIN ADDRESS a ON p.address_id = a.address_id
+    JOIN PROPERTY_DETAILS pd ON p.prop_id = pd.prop_id
+    ORDER BY p.prop_id;
+"""
+
+SNAPSHOT_CITIES = """
+    SELECT DISTINCT COALESCE(a.city, '')
+    FROM PROPERTY p
+    JOIN ADDRESS a ON p.address_id = a.address_id
+    JOIN PROPERTY_DETAILS pd ON p.prop_id = pd.prop_id
+    ORDER BY 1;
+"""
+
+
+def build_search_rows_query(sort_by):
+    """Return sql fetching the search display columns for a list of prop ids.
+
+    Used for pages whose ids were picked from the listing snapshot; the
+    columns match build_search_query so the same template renders them.
+    """
+    return f"""
+        SELECT p.prop_id, a.line_1, a.city, a.state_,
+               p.price, pd.rooms, pc.category_name,
+               NULL::text AS snippet,
+               {SEARCH_SORT_KEYS[sort_by]} AS sort_key
+        {_SEARCH_JOINS}
+        WHERE p.prop_id = ANY(%s);"""
@@ -0,0 +1,105 @@
+"""Per-worker cache of small, near-static lookup tables.
+
+A ``ReferenceTable`` loads ``(id, name)`` rows once, keeps name->id and
+id->name maps plus memoized ``<option>`` markup, and reloads itself after
+``max_age`` seconds (or when ``refresh()`` is called). Every reload bumps
+``version``, which keys the memoized markup, so readers never mix data from
+two loads. Tables are registered with ``register()`` and preloaded in each
+worker at startup by ``preload()``.
+"""
+import html
+import threading
+import time
+
+from db import run_query
+
+_tables = {}
+
+
+class ReferenceTable:
+
+    def __init__(self, name, sql, max_age=300):
+        self.name = name
+        self.sql = sql
+        self.max_age = max_age
+        self.version = 0
+        self._rows = ()
+        self._by_name = {}
+        self._by_id = {}
+        self._options = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        rows = tuple((row[0], row[1]) for row in run_query(self.sql, fetch=True))
+        with self._lock:
+            self._rows = rows
+            self._by_id = dict(rows)
+            self._by_name = {label: key for key, label in rows}
+            self._options = {}
+            self._loaded_at = time.monotonic()
+            self.version += 1
+
+    def _ensure_loaded(self):
+        loaded_at = self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > self.max_age:
+            self.refresh()
+
+    def rows(self):
+        self._ensure_loaded()
+        return self._rows
+
+    def names(self):
+        return [label for _, label in self.rows()]
+
+    def id_for(self, name):
+        self._ensure_loaded()
+        return self._by_name.get(name)
+
+    def name_for(self, key):
+        self._ensure_loaded()
+        return self._by_id.get(key)
+
+    def options_html(self, selected="", blank=None):
+        """``<option>`` list of the names, memoized per (version, selection)."""
+        self._ensure_loaded()
+        # Only real names get their own entry; anything a client sends that
+        # is not one selects nothing, so the memo stays bounded by the table.
+        if selected not in self._by_name:
+            selected = ""
+        memo_key = (self.version, selected, blank)
+        cached = self._options.get(memo_key)
+        if cached is not None:
+            return cached
+        parts = []
+        if blank is not None:
+            parts.append(f'<option value="">{html.escape(blank)}</option>')
+        for _, label in self._rows:
+            value = html.escape(label)
+            mark = " selected" if label == selected else ""
+            parts.append(f'<option value="{value}"{mark}>{value}</option>')
+        markup = "".join(parts)
+        self._options[memo_key] = markup
+        return markup
+
+
+def register(name, sql, max_age=300):
+    table = ReferenceTable(name, sql, max_age)
+    _tables[name] = table
+    return table
+
+
+def get(name):
+    return _tables[name]
+
+
+def preload():
+    """Load every registered table (called in each worker after fork)."""
+    for table in _tables.values():
+        table.refresh()
+
+
+def refresh(name=None):
+    for table_name, table in _tables.items():
+        if name is None or table_name == name:
+            table.refresh()
@@ -0,0 +1,114 @@
+"""Reconcile reward balances with the REWARD rows they are derived from.
+
+REWARD_BALANCE and REWARD_LEDGER are maintained incrementally by the
+trigger in migrations/0005. This job recomputes every renter's points from
+REWARD, plus the points of archived months (REWARD_ARCHIVE_TOTAL, see
+partitions.py), in one set-based pass (hash aggregates, no per-renter
+queries) and reports each renter whose stored balance, or the sum of their
+ledger entries, disagrees with it.
+
+With ``--fix`` the differences are corrected in a single statement: the
+balance is moved, and an ``adjustment`` entry is appended to the ledger,
+by the amount found missing. The correction is applied relative to the
+current row, so bookings committed while the job runs are not lost.
+
+Usage:
+    python rewards.py            # exit status 1 when a balance is off
+    python rewards.py --fix      # correct the balances and ledgers
+"""
+import sys
+import time
+
+from db import pooled_connection
+
+# Per renter: points according to REWARD and the archive, the stored
+# balance and the sum of the ledger, for every renter present in any of them.
+_TOTALS = """
+    expected AS (
+        SELECT renter_id, sum(points) AS points
+        FROM (SELECT renter_id, COALESCE(points, 0) AS points FROM REWARD
+              UNION ALL
+              SELECT renter_id, points FROM REWARD_ARCHIVE_TOTAL) earned
+        GROUP BY renter_id
+    ), ledger AS (
+        SELECT renter_id, sum(delta) AS points
+        FROM REWARD_LEDGER GROUP BY renter_id
+    ), totals AS (
+        SELECT COALESCE(e.renter_id, b.renter_id, l.renter_id) AS renter_id,
+               COALESCE(e.points, 0) AS expected,
+               COALESCE(b.points, 0) AS balance,
+               COALESCE(l.points, 0) AS ledger
+        FROM expected e
+        FULL JOIN REWARD_BALANCE b ON b.renter_id = e.renter_id
+        FULL JOIN ledger l ON l.renter_id = COALESCE(e.renter_id, b.renter_id)
+    ), drift AS (
+        SELECT * FROM totals
+        WHERE balance <> expected OR ledger <> expected
+    )
+"""
+
+CHECK = f"""
+    WITH {_TOTALS}
+    SELECT (SELECT count(*) FROM totals), renter_id, expected, balance, ledger
+    FROM (SELECT 1) one
+    LEFT JOIN drift ON true
+    ORDER BY renter_id;
+"""
+
+FIX = f"""
+    WITH {_TOTALS}, moved AS (
+        INSERT INTO REWARD_BALANCE AS rb (renter_id, points)
+        SELECT d.renter_id, d.expected - d.balance
+        FROM drift d
+        WHERE EXISTS (SELECT 1 FROM RENTER r WHERE r.renter_id = d.renter_id)
+        ORDER BY d.renter_id
+        ON CONFLICT (renter_id) DO UPDATE
+            SET points = rb.points + EXCLUDED.points, updated_at = now()
+        RETURNING rb.renter_id, rb.points
+    )
+    INSERT INTO REWARD_LEDGER (renter_id, delta, balance_after, reason)
+    SELECT d.renter_id, d.expected - d.ledger, m.points, 'adjustment'
+    FROM drift d
+    JOIN moved m ON m.renter_id = d.renter_id
+    ORDER BY d.renter_id;
+"""
+
+SHOW_AT_MOST = 20
+
+
+def reconcile(fix=False, out=sys.stdout):
+    """Check every balance; return the number of renters that were off."""
+    started = time.monotonic()
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(CHECK)
+            rows = cur.fetchall()
+            checked = rows[0][0]
+            drift = [row[1:] for row in rows if row[1] is not None]
+            if fix and drift:
+                cur.execute(FIX)
+        conn.commit()
+
+    for renter_id, expected, balance, ledger in drift[:SHOW_AT_MOST]:
+        print(f"renter {renter_id}: REWARD {expected}, balance {balance}, ledger {ledger}",
+              file=out)
+    if len(drift) > SHOW_AT_MOST:
+        print(f"... and {len(drift) - SHOW_AT_MOST} more", file=out)
+    action = "fixed" if fix and drift else "off"
+    print(f"checked {checked:,} renters in {time.monotonic() - started:.1f}s, "
+          f"{len(drift):,} {action}", file=out)
+    return len(drift)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv not in ([], ["--fix"]):
+        print(__doc__)
+        return 2
+    fix = argv == ["--fix"]
+    off = reconcile(fix=fix)
+    return 1 if off and not fix else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,203 @@
+"""Check and repair the agent analytics rollups.
+
+PROPERTY_ROLLUP and PROPERTY_DAILY_ROLLUP are maintained incrementally by
+the triggers in migrations/0006. This job recomputes them from BOOKING and
+the days of archived months (BOOKING_ARCHIVE_DAY, see partitions.py), a
+range of listings at a time, and compares the result with what the
+triggers stored. Each batch is a short transaction of its own, so the job
+can run next to live traffic without holding locks for long.
+
+``refresh`` corrects every difference it finds. Counts are corrected
+relative to the current row (``+ expected - stored``), so a booking
+committed while a batch runs is not lost; days left with nothing on them
+are deleted.
+
+Usage:
+    python rollups.py              # report drift; exit status 1 if any
+    python rollups.py refresh      # repair the rollups in place
+"""
+import sys
+import time
+
+from db import pooled_connection
+
+BATCH = 5000   # listings per transaction
+
+# Every statement below takes the listing range as %(lo)s <= prop_id < %(hi)s
+# and defines a "drift" CTE of rows to add to the stored ones.
+_PROPERTY_DRIFT = """
+    counted AS (
+        SELECT prop_id, count(*) AS bookings, sum(upper(stay) - lower(stay)) AS nights
+        FROM BOOKING
+        WHERE prop_id >= %(lo)s AND prop_id < %(hi)s
+        GROUP BY prop_id
+        UNION ALL
+        SELECT prop_id, sum(check_ins), sum(nights)
+        FROM BOOKING_ARCHIVE_DAY
+        WHERE prop_id >= %(lo)s AND prop_id < %(hi)s
+        GROUP BY prop_id
+    ), expected AS (
+        SELECT p.prop_id, p.agent_id, a.city,
+               COALESCE(sum(c.bookings), 0) AS bookings,
+               COALESCE(sum(c.nights), 0) AS nights,
+               COALESCE(sum(c.bookings), 0) * COALESCE(p.price, 0) AS revenue
+        FROM PROPERTY p
+        JOIN ADDRESS a ON a.address_id = p.address_id
+        LEFT JOIN counted c ON c.prop_id = p.prop_id
+        WHERE p.prop_id >= %(lo)s AND p.prop_id < %(hi)s
+        GROUP BY p.prop_id, a.city
+    ), stored AS (
+        SELECT * FROM PROPERTY_ROLLUP
+        WHERE prop_id >= %(lo)s AND prop_id < %(hi)s
+    ), drift AS (
+        SELECT COALESCE(e.prop_id, s.prop_id) AS prop_id,
+               COALESCE(e.agent_id, s.agent_id) AS agent_id,
+               COALESCE(e.city, s.city) AS city,
+               COALESCE(e.bookings, 0) - COALESCE(s.bookings, 0) AS bookings,
+               COALESCE(e.nights, 0) - COALESCE(s.nights, 0) AS nights,
+               COALESCE(e.revenue, 0) - COALESCE(s.revenue, 0) AS revenue
+        FROM expected e
+        FULL JOIN stored s ON s.prop_id = e.prop_id
+        WHERE (e.agent_id, e.city, e.bookings, e.nights, e.revenue)
+              IS DISTINCT FROM (s.agent_id, s.city, s.bookings, s.nights, s.revenue)
+    )
+"""
+
+_DAILY_DRIFT = """
+    counted AS (
+        SELECT b.prop_id, d.day, d.check_ins, d.nights
+        FROM BOOKING b,
+             booking_rollup_days(b.booking_date, b.stay, 0, 1) d
+        WHERE b.prop_id >= %(lo)s AND b.prop_id < %(hi)s
+        UNION ALL
+        SELECT prop_id, day, check_ins, nights
+        FROM BOOKING_ARCHIVE_DAY
+        WHERE prop_id >= %(lo)s AND prop_id < %(hi)s
+    ), expected AS (
+        SELECT c.prop_id, c.day, min(p.agent_id) AS agent_id,
+               sum(c.check_ins) AS check_ins, sum(c.nights) AS nights,
+               sum(c.check_ins) * COALESCE(min(p.price), 0) AS revenue
+        FROM counted c
+        JOIN PROPERTY p ON p.prop_id = c.prop_id
+        GROUP BY c.prop_id, c.day
+    ), stored AS (
+        SELECT * FROM PROPERTY_DAILY_ROLLUP
+        WHERE prop_id >= %(lo)s AND prop_id < %(hi)s
+    ), drift AS (
+        SELECT COALESCE(e.prop_id, s.prop_id) AS prop_id,
+               COALESCE(e.day, s.day) AS day,
+               COALESCE(e.agent_id, s.agent_id) AS agent_id,
+               COALESCE(e.check_ins, 0) - COALESCE(s.check_ins, 0) AS check_ins,
+               COALESCE(e.nights, 0) - COALESCE(s.nights, 0) AS nights,
+               COALESCE(e.revenue, 0) - COALESCE(s.revenue, 0) AS revenue
+        FROM expected e
+        FULL JOIN stored s ON s.prop_id = e.prop_id AND s.day = e.day
+        WHERE (e.agent_id, e.check_ins, e.nights, e.revenue)
+              IS DISTINCT FROM (s.agent_id, s.check_ins, s.nights, s.revenue)
+          AND (e.prop_id IS NOT NULL OR s.check_ins <> 0 OR s.nights <> 0 OR s.revenue <> 0)
+    )
+"""
+
+CHECKS = [
+    ("PROPERTY_ROLLUP", f"WITH {_PROPERTY_DRIFT} SELECT prop_id FROM drift ORDER BY prop_id;"),
+    ("PROPERTY_DAILY_ROLLUP", f"WITH {_DAILY_DRIFT} SELECT prop_id FROM drift ORDER BY prop_id, day;"),
+]
+
+REPAIRS = [
+    f"""
+    WITH {_PROPERTY_DRIFT}, fixed AS (
+        INSERT INTO PROPERTY_ROLLUP AS r (prop_id, agent_id, city, bookings, nights, revenue)
+        SELECT * FROM drift
+        WHERE EXISTS (SELECT 1 FROM PROPERTY p WHERE p.prop_id = drift.prop_id)
+        ORDER BY prop_id
+        ON CONFLICT (prop_id) DO UPDATE
+            SET agent_id = EXCLUDED.agent_id, city = EXCLUDED.city,
+                bookings = r.bookings + EXCLUDED.bookings,
+                nights = r.nights + EXCLUDED.nights,
+                revenue = r.revenue + EXCLUDED.revenue
+        RETURNING 1
+    )
+    SELECT count(*) FROM fixed;
+    """,
+    f"""
+    WITH {_DAILY_DRIFT}, fixed AS (
+        INSERT INTO PROPERTY_DAILY_ROLLUP AS r (prop_id, day, agent_id, check_ins, nights, revenue)
+        SELECT * FROM drift
+        WHERE EXISTS (SELECT 1 FROM PROPERTY p WHERE p.prop_id = drift.prop_id)
+        ORDER BY prop_id, day
+        ON CONFLICT (prop_id, day) DO UPDATE
+            SET agent_id = EXCLUDED.agent_id,
+                check_ins = r.check_ins + EXCLUDED.check_ins,
+                nights = r.nights + EXCLUDED.nights,
+                revenue = r.revenue + EXCLUDED.revenue
+        RETURNING 1
+    )
+    SELECT count(*) FROM fixed;
+    """,
+    """
+    DELETE FROM PROPERTY_DAILY_ROLLUP
+    WHERE prop_id >= %(lo)s AND prop_id < %(hi)s
+      AND check_ins = 0 AND nights = 0 AND revenue = 0;
+    """,
+]
+
+
+def _batches(cur, size):
+    cur.execute("SELECT COALESCE(MAX(prop_id), 0) FROM PROPERTY;")
+    top = cur.fetchone()[0]
+    for lo in range(0, top + 1, size):
+        yield {"lo": lo, "hi": lo + size}
+
+
+def check(out=sys.stdout, batch=BATCH):
+    """Report rows that differ from the bookings; return how many there are."""
+    started = time.monotonic()
+    off = dict.fromkeys((table for table, _ in CHECKS), 0)
+    listings = set()
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            for bounds in _batches(cur, batch):
+                for table, sql in CHECKS:
+                    cur.execute(sql, bounds)
+                    rows = cur.fetchall()
+                    off[table] += len(rows)
+                    listings.update(prop_id for prop_id, in rows)
+                conn.commit()
+    for table, count in off.items():
+        print(f"{table}: {count:,} rows off", file=out)
+    if listings:
+        shown = ", ".join(str(prop_id) for prop_id in sorted(listings)[:20])
+        print(f"listings affected: {shown}{' ...' if len(listings) > 20 else ''}", file=out)
+    print(f"checked in {time.monotonic() - started:.1f}s", file=out)
+    return sum(off.values())
+
+
+def refresh(out=sys.stdout, batch=BATCH):
+    """Repair every batch of listings; return the number of rows corrected."""
+    started = time.monotonic()
+    fixed = 0
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            for bounds in _batches(cur, batch):
+                for sql in REPAIRS:
+                    cur.execute(sql, bounds)
+                    fixed += cur.fetchone()[0] if cur.description else cur.rowcount
+                conn.commit()
+    print(f"{fixed:,} rollup rows corrected in {time.monotonic() - started:.1f}s", file=out)
+    return fixed
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    command = argv[0] if argv else "check"
+    if command == "check":
+        return 1 if check() else 0
+    if command == "refresh":
+        refresh()
+        return 0
+    print(__doc__)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""Slow-query log with captured EXPLAIN plans.
+
+Statements slower than SLOW_QUERY_MS (reported through db.add_hook) are
+handed to a background thread, which appends one JSON line per statement to
+SLOW_QUERY_LOG: the SQL, its parameters, duration, row count, the Flask
+endpoint and, when the rate limit allows, the query plan.
+
+Plans are captured on a dedicated connection, never a pooled one, so the
+capture cannot starve requests. SELECTs are re-run under
+``EXPLAIN (ANALYZE, BUFFERS)`` in a read-only transaction that is rolled
+back; writes only get a plain ``EXPLAIN`` because ANALYZE would execute
+them. At most SLOW_QUERY_EXPLAINS_PER_MIN plans are captured per worker,
+the same statement is explained at most once per
+SLOW_QUERY_EXPLAIN_INTERVAL seconds, and when the queue is full further
+slow statements are dropped and counted instead of blocking the request.
+
+String parameters can hold emails and card numbers, so they are logged as
+``<str len=N>`` unless SLOW_QUERY_LOG_PARAMS=1.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+from flask import has_request_context, request
+
+import db
+
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "500"))  # 0 disables
+SLOW_QUERY_LOG = os.environ.get("SLOW_QUERY_LOG", "slow_queries.jsonl")
+SLOW_QUERY_LOG_PARAMS = os.environ.get("SLOW_QUERY_LOG_PARAMS") == "1"
+SLOW_QUERY_EXPLAINS_PER_MIN = float(os.environ.get("SLOW_QUERY_EXPLAINS_PER_MIN", "6"))
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.environ.get("SLOW_QUERY_EXPLAIN_INTERVAL", "300"))
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS = int(os.environ.get("SLOW_QUERY_EXPLAIN_TIMEOUT_MS", "5000"))
+
+QUEUE_SIZE = 100
+
+log = logging.getLogger(__name__)
+
+_queue = queue.Queue(QUEUE_SIZE)
+_worker_pid = None
+_start_lock = threading.Lock()
+dropped = 0
+
+
+class RateLimiter:
+    """Token bucket: ``per_minute`` tokens, refilled continuously."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def allow(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def _loggable(value):
+    if isinstance(value, str) and not SLOW_QUERY_LOG_PARAMS:
+        return f"<str len={len(value)}>"
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+def _on_query(sql, params, seconds, rows):
+    global dropped
+    if not SLOW_QUERY_MS or seconds * 1000 < SLOW_QUERY_MS:
+        return
+    endpoint = request.endpoint if has_request_context() else None
+    _ensure_worker()
+    try:
+        _queue.put_nowait((time.time(), endpoint, sql, params, seconds, rows))
+    except queue.Full:
+        dropped += 1
+
+
+def _ensure_worker():
+    # One thread per process; a forked gunicorn worker starts its own.
+    global _worker_pid
+    if _worker_pid == os.getpid():
+        return
+    with _start_lock:
+        if _worker_pid != os.getpid():
+            _worker_pid = os.getpid()
+            threading.Thread(target=_run, name="slow-query-log", daemon=True).start()
+
+
+# ===========================================================
+# BACKGROUND CAPTURE
+# ===========================================================
+class _Explainer:
+    def __init__(self):
+        self.conn = None
+        self.limiter = RateLimiter(SLOW_QUERY_EXPLAINS_PER_MIN)
+        self.last_explained = {}   # sql -> monotonic time
+
+    def _connection(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = db.get_connection()
+        return self.conn
+
+    def should_explain(self, sql):
+        now = time.monotonic()
+        last = self.last_explained.get(sql)
+        if last is not None and now - last < SLOW_QUERY_EXPLAIN_INTERVAL:
+            return False
+        if not self.limiter.allow():
+            return False
+        self.last_explained[sql] = now
+        return True
+
+    def explain(self, sql, params):
+        analyze = sql.lstrip().upper().startswith("SELECT")
+        options = "ANALYZE, BUFFERS, FORMAT JSON" if analyze else "FORMAT JSON"
+        conn = self._connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET TRANSACTION READ ONLY;")
+                cur.execute("SET LOCAL statement_timeout = %s;", (SLOW_QUERY_EXPLAIN_TIMEOUT_MS,))
+                cur.execute(f"EXPLAIN ({options}) {sql}", params)
+                return cur.fetchone()[0]
+        finally:
+            conn.rollback()
+
+
+def _run():
+    explainer = _Explainer()
+    while True:
+        item = _queue.get()
+        try:
+            _capture(explainer, *item)
+        except Exception:
+            log.exception("slow-query capture failed")
+
+
+def _capture(explainer, logged_at, endpoint, sql, params, seconds, rows):
+    entry = {
+        "time": datetime.fromtimestamp(logged_at, timezone.utc).isoformat(),
+        "endpoint": endpoint,
+        "ms": round(seconds * 1000, 1),
+        "rows": rows,
+        "sql": " ".join(sql.split()),
+        "params": [_loggable(p) for p in params or ()],
+    }
+    if explainer.should_explain(sql):
+        try:
+            entry["plan"] = explainer.explain(sql, params)
+        except psycopg2.Error as exc:
+            entry["plan_error"] = str(exc).strip()
+    with open(SLOW_QUERY_LOG, "a") as f:
+        f.write(json.dumps(entry, default=str) + "\n")
+
+
+def init_app(app):
+    if SLOW_QUERY_MS:
+        db.add_hook("query", _on_query)
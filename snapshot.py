@@ -0,0 +1,413 @@
+"""Columnar, memory-mapped snapshot of the searchable listing attributes.
+
+Price, rooms, category, city, square footage, availability date, utilities
+and parking of every listing are small and read-mostly, so a background
+builder copies them out of the PROPERTY / ADDRESS / PROPERTY_DETAILS join
+into one NumPy array per column under SNAPSHOT_DIR. Workers open the
+arrays with ``mmap_mode="r"``: the pages live once in the OS page cache
+and every gunicorn worker on the host reads them without copying.
+search() then filters with vectorized masks and walks precomputed sort
+orders (argsorts done at build time), and the database only serves the
+display columns of the rows on the page.
+
+Each build is published as a new generation: the columns are written to
+a temporary directory, renamed to ``gen-<N>`` and then the ``CURRENT``
+file is atomically replaced to point at it. A reader keeps the snapshot
+it started with, so a refresh never mixes two generations, and it picks
+up the new one within SNAPSHOT_CHECK_INTERVAL seconds. The builder thread
+runs in every worker but only one holds the build lock at a time; it
+rebuilds when the snapshot is older than SNAPSHOT_MAX_AGE seconds or has
+been marked stale by a listing change (mark_stale()).
+
+Disabled unless SNAPSHOT_DIR is set and numpy is installed. Keyword and
+availability searches (bookings are not in the snapshot), and anything
+else the snapshot cannot answer, go to SQL.
+``python snapshot.py`` builds a generation on demand.
+"""
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+import db
+import queries
+
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "")
+SNAPSHOT_MAX_AGE = float(os.environ.get("SNAPSHOT_MAX_AGE", "300"))
+SNAPSHOT_CHECK_INTERVAL = float(os.environ.get("SNAPSHOT_CHECK_INTERVAL", "1"))
+
+KEEP_GENERATIONS = 2   # the previous one stays for readers still switching
+FETCH_SIZE = 10000
+
+# Stored columns and their dtypes. NULLs become NaN (price), -1 (rooms,
+# utilities, parking) or NO_DATE (days since 1970-01-01).
+COLUMNS = {
+    "prop_id": "int32",
+    "price": "float64",
+    "rooms": "int32",
+    "category": "int16",
+    "city": "int32",        # rank in the database collation order of cities
+    "sq_ft": "int32",
+    "available": "int32",
+    "utilities": "int8",
+    "parking": "int8",
+}
+NO_DATE = -2 ** 31
+# The NULL replacements of queries.SEARCH_SORT_KEYS, so that the snapshot
+# orders rows and compares cursors exactly like the SQL search.
+NULL_PRICE_KEY = 99999999.99
+NULL_ROOMS_KEY = 2147483647
+SORTS = ("price", "rooms", "city")
+
+log = logging.getLogger(__name__)
+
+
+def enabled():
+    return bool(SNAPSHOT_DIR) and np is not None
+
+
+def _path(*parts):
+    return os.path.join(SNAPSHOT_DIR, *parts)
+
+
+def _read_current():
+    try:
+        with open(_path("CURRENT")) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+# ===========================================================
+# BUILD
+# ===========================================================
+def _fetch(conn):
+    """Column arrays plus city and category lookups, from one consistent read."""
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(queries.SNAPSHOT_CITIES)
+            cities = [row[0] for row in cur.fetchall()]
+            cur.execute(queries.CATEGORIES)
+            categories = {name: key for key, name in cur.fetchall()}
+        chunks = []
+        with conn.cursor(name="listing_snapshot") as cur:
+            cur.itersize = FETCH_SIZE
+            cur.execute(queries.SNAPSHOT_LISTINGS)
+            while True:
+                rows = cur.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                chunks.append(_chunk_columns(rows))
+    finally:
+        conn.rollback()
+    columns = {
+        name: np.concatenate([c[name] for c in chunks]) if chunks else np.empty(0, dtype)
+        for name, dtype in COLUMNS.items()
+    }
+    return columns, cities, categories
+
+
+def _chunk_columns(rows):
+    prop_id, price, rooms, category, city, sq_ft, available, utilities, parking = zip(*rows)
+
+    def flag(values):
+        return np.array([-1 if v is None else int(v) for v in values], "int8")
+
+    return {
+        "prop_id": np.array(prop_id, "int32"),
+        "price": np.array([np.nan if v is None else float(v) for v in price], "float64"),
+        "rooms": np.array([-1 if v is None else v for v in rooms], "int32"),
+        "category": np.array(category, "int16"),
+        "city": np.array(city, "int32"),
+        "sq_ft": np.array(sq_ft, "int32"),
+        "available": np.array([NO_DATE if v is None else v for v in available], "int32"),
+        "utilities": flag(utilities),
+        "parking": flag(parking),
+    }
+
+
+def _derived(columns):
+    """Sort keys and their precomputed (key, prop_id) orders."""
+    keys = {
+        "price": np.where(np.isnan(columns["price"]), NULL_PRICE_KEY, columns["price"]),
+        "rooms": np.where(columns["rooms"] < 0, NULL_ROOMS_KEY, columns["rooms"]).astype("int32"),
+        "city": columns["city"],
+    }
+    derived = {}
+    for sort_by, key in keys.items():
+        derived["key_" + sort_by] = key
+        # Rows are in prop_id order, so a stable sort breaks ties by prop_id.
+        derived["order_" + sort_by] = np.argsort(key, kind="stable").astype("int32")
+    return derived
+
+
+def _publish(arrays, meta, started):
+    generation = (_read_current() or 0) + 1
+    tmp = _path(f".tmp-{generation}-{os.getpid()}")
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp, name + ".npy"), array)
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(dict(meta, generation=generation), f)
+    os.rename(tmp, _path(f"gen-{generation}"))
+
+    current = _path(f".CURRENT-{os.getpid()}")
+    with open(current, "w") as f:
+        f.write(str(generation))
+    # Dated by the start of the build: a change marked stale while the
+    # build ran may be missing from it and triggers another one.
+    os.utime(current, (started, started))
+    os.replace(current, _path("CURRENT"))
+    _prune(generation)
+    return generation
+
+
+def _prune(generation):
+    # Removed generations stay readable for workers that still map them.
+    for name in os.listdir(SNAPSHOT_DIR):
+        if name.startswith("gen-") and int(name[4:]) <= generation - KEEP_GENERATIONS:
+            shutil.rmtree(_path(name), ignore_errors=True)
+
+
+@contextmanager
+def _build_lock(blocking=True):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    with open(_path("build.lock"), "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+
+def _build():
+    started = time.time()
+    conn = db.get_connection()
+    try:
+        columns, cities, categories = _fetch(conn)
+    finally:
+        conn.close()
+    arrays = dict(columns, **_derived(columns))
+    meta = {"built_at": started, "rows": len(columns["prop_id"]),
+            "cities": cities, "categories": categories}
+    generation = _publish(arrays, meta, started)
+    log.info("listing snapshot generation %d: %d rows in %.2fs",
+             generation, meta["rows"], time.time() - started)
+    return generation
+
+
+def build():
+    """Build and publish a new generation now; returns its number."""
+    with _build_lock():
+        return _build()
+
+
+def mark_stale():
+    """Ask for a rebuild, e.g. after a listing was added or deleted."""
+    if enabled():
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        with open(_path("stale"), "a"):
+            pass
+        os.utime(_path("stale"))
+
+
+def _due():
+    try:
+        published = os.stat(_path("CURRENT")).st_mtime
+    except OSError:
+        return True
+    try:
+        stale = os.stat(_path("stale")).st_mtime
+    except OSError:
+        stale = 0
+    return stale > published or time.time() - published > SNAPSHOT_MAX_AGE
+
+
+def _run():
+    while True:
+        time.sleep(SNAPSHOT_CHECK_INTERVAL)
+        try:
+            if _due():
+                with _build_lock(blocking=False) as acquired:
+                    if acquired and _due():
+                        _build()
+        except Exception:
+            log.exception("listing snapshot build failed")
+            time.sleep(min(SNAPSHOT_MAX_AGE, 30))
+
+
+_builder_pid = None
+_start_lock = threading.Lock()
+
+
+def _ensure_builder():
+    # One thread per process; a forked gunicorn worker starts its own.
+    global _builder_pid
+    if _builder_pid == os.getpid():
+        return
+    with _start_lock:
+        if _builder_pid != os.getpid():
+            _builder_pid = os.getpid()
+            threading.Thread(target=_run, name="listing-snapshot", daemon=True).start()
+
+
+# ===========================================================
+# READ
+# ===========================================================
+class Snapshot:
+    """One published generation, memory-mapped read-only."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.generation = meta["generation"]
+        self.built_at = meta["built_at"]
+        self.cities = meta["cities"]
+        self.categories = meta["categories"]
+        self.category_names = {key: name for name, key in self.categories.items()}
+        self.columns = {}
+        for name in list(COLUMNS) + [p + s for s in SORTS for p in ("key_", "order_")]:
+            self.columns[name] = np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+        self.city_rank = {city: rank for rank, city in enumerate(self.cities)}
+        self.city_codes = {}
+        for rank, city in enumerate(self.cities):
+            self.city_codes.setdefault(city.lower(), []).append(rank)
+
+    def __len__(self):
+        return len(self.columns["prop_id"])
+
+    def _mask(self, filters):
+        """Boolean mask of the matching rows, or None if SQL has to decide."""
+        c = self.columns
+        mask = np.ones(len(self), bool)
+        try:
+            if filters["city"]:
+                mask &= np.isin(c["city"], self.city_codes.get(filters["city"].lower(), []))
+            if filters["min_price"]:
+                mask &= c["price"] >= float(filters["min_price"])
+            if filters["max_price"]:
+                mask &= c["price"] <= float(filters["max_price"])
+            if filters["rooms"]:
+                mask &= c["rooms"] == int(filters["rooms"])
+        except ValueError:
+            return None   # malformed number: let the SQL path report it
+        if filters["category"]:
+            mask &= c["category"] == self.categories.get(filters["category"], -1)
+        return mask
+
+    def _cursor_key(self, sort_by, value):
+        try:
+            if sort_by == "price":
+                return float(value)
+            if sort_by == "rooms":
+                return int(value)
+        except ValueError:
+            return None
+        return self.city_rank.get(value)
+
+    def facet_counts(self, mask):
+        """The [facet, value, count] triples queries.build_search_query returns."""
+        c = self.columns
+        counts = []
+        categories = np.bincount(c["category"][mask])
+        for key in np.flatnonzero(categories):
+            counts.append(["category", self.category_names.get(int(key), str(key)), int(categories[key])])
+        price = c["price"][mask]
+        # Same buckets as width_bucket(price, PRICE_BUCKET_EDGES).
+        buckets = np.bincount(
+            np.searchsorted(queries.PRICE_BUCKET_EDGES, price[~np.isnan(price)], side="right"),
+            minlength=len(queries.PRICE_BUCKET_EDGES) + 1,
+        )
+        counts.extend(["price", str(b), int(n)] for b, n in enumerate(buckets) if n)
+        rooms, n = np.unique(c["rooms"][mask], return_counts=True)
+        counts.extend(["rooms", str(r), int(k)] for r, k in zip(rooms, n) if r >= 0)
+        cities = np.bincount(c["city"][mask], minlength=len(self.cities))
+        top = sorted((-int(n), self.cities[rank]) for rank, n in enumerate(cities) if n and self.cities[rank])
+        counts.extend(["city", city, -n] for n, city in top[:queries.FACET_CITY_LIMIT])
+        counts.sort(key=lambda item: (item[0], -item[2], item[1]))
+        return counts
+
+    def search(self, filters, sort_by, after=None, before=None, limit=None, facets=False):
+        """Return (page prop ids, facet counts or None), like build_search_query.
+
+        Returns None when the snapshot cannot answer: keyword or
+        availability queries, malformed filters, or a cursor on a city this
+        generation lacks.
+        """
+        if filters.get("q") or filters.get("available_from") or sort_by not in SORTS:
+            return None
+        mask = self._mask(filters)
+        if mask is None:
+            return None
+        counts = self.facet_counts(mask) if facets else None
+
+        key = self.columns["key_" + sort_by]
+        prop_id = self.columns["prop_id"]
+        cursor = after if after is not None else before
+        if cursor is not None:
+            value = self._cursor_key(sort_by, cursor[0])
+            if value is None:
+                return None
+            if after is not None:
+                mask &= (key > value) | ((key == value) & (prop_id > cursor[1]))
+            else:
+                mask &= (key < value) | ((key == value) & (prop_id < cursor[1]))
+        order = self.columns["order_" + sort_by]
+        positions = order[mask[order]]
+        if before is not None:
+            positions = positions[::-1]
+        if limit is not None:
+            positions = positions[:limit]
+        return prop_id[positions].tolist(), counts
+
+
+_current = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def current():
+    """The newest published Snapshot, or None (disabled or not built yet)."""
+    global _current, _checked_at
+    if not enabled():
+        return None
+    _ensure_builder()
+    now = time.monotonic()
+    if now - _checked_at >= SNAPSHOT_CHECK_INTERVAL:
+        with _lock:
+            if now - _checked_at >= SNAPSHOT_CHECK_INTERVAL:
+                _checked_at = now
+                generation = _read_current()
+                if generation is not None and (_current is None or _current.generation != generation):
+                    try:
+                        _current = Snapshot(_path(f"gen-{generation}"))
+                    except (OSError, ValueError, KeyError):
+                        log.warning("could not load listing snapshot generation %s", generation)
+    return _current
+
+
+def stats():
+    snap = _current
+    if snap is None:
+        return {"enabled": enabled(), "generation": None}
+    return {"enabled": True, "generation": snap.generation, "rows": len(snap),
+            "age_seconds": round(time.time() - snap.built_at, 1)}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if not enabled():
+        raise SystemExit("set SNAPSHOT_DIR and install numpy to build the listing snapshot")
+    build()
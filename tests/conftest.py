@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The application modules live at the repository root.
+sys.path.insert(0, ROOT)
+
+# A scratch database for the tests that run real SQL; they are skipped
+# without one. Its public schema is dropped and rebuilt for every test.
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """TEST_DATABASE_URL with schema.sql and every migration applied.
+
+    DATABASE_URL points at it for the duration of the test, so
+    db.get_connection() and the pool connect there.
+    """
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    import psycopg2
+
+    import db
+    import migrate
+
+    conn = psycopg2.connect(TEST_DATABASE_URL)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+            with open(os.path.join(ROOT, "schema.sql")) as f:
+                cur.execute(f.read())
+            for _, _, path in migrate.discover():
+                with open(path) as f:
+                    cur.execute(f.read())
+        conn.commit()
+    finally:
+        conn.close()
+    monkeypatch.setenv("DATABASE_URL", TEST_DATABASE_URL)
+    yield TEST_DATABASE_URL
+    db.close_pool()
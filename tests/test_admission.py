@@ -0,0 +1,203 @@
+"""admission.Gate: slot accounting, priorities, shedding, and release in teardown."""
+import threading
+import time
+
+import psycopg2
+import pytest
+from flask import Flask, Response, stream_with_context
+
+import admission
+import db
+from admission import CLASSES, Gate, RouteClass
+
+LOGIN, WRITE, LOOKUP, SEARCH = (CLASSES[name] for name in ("login", "write", "lookup", "search"))
+
+
+def waiter(gate, route_class):
+    """Start acquire() on a thread; join() it and read .result for its answer."""
+    thread = threading.Thread(target=lambda: setattr(thread, "result", gate.acquire(route_class)))
+    thread.result = "pending"
+    thread.start()
+    deadline = time.monotonic() + 2
+    while thread.is_alive() and gate.stats()["waiting"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    return thread
+
+
+def wait_until_queued(gate, count):
+    deadline = time.monotonic() + 2
+    while gate.stats()["waiting"] < count and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert gate.stats()["waiting"] == count
+
+
+# ===========================================================
+# GATE
+# ===========================================================
+def test_slots_are_counted_and_returned():
+    gate = Gate(slots=2, queue_size=0, max_wait=0)
+    assert gate.acquire(LOOKUP) is None
+    assert gate.acquire(WRITE) is None
+    assert gate.stats()["active"] == {"login": 0, "write": 1, "lookup": 1, "search": 0}
+    assert gate.acquire(LOGIN) == "queue_full"
+    gate.release(WRITE)
+    assert gate.acquire(LOGIN) is None
+    gate.release(LOGIN)
+    gate.release(LOOKUP)
+    assert gate.active == 0
+    assert gate.stats() == {"slots": 2, "active": dict.fromkeys(CLASSES, 0), "waiting": 0}
+
+
+def test_class_limit_caps_search_but_not_the_others():
+    search = RouteClass("search", SEARCH.priority, 1, None)
+    gate = Gate(slots=3, queue_size=0, max_wait=0)
+    assert gate.acquire(search) is None
+    assert gate.acquire(search) == "queue_full"
+    assert gate.acquire(LOOKUP) is None
+    assert gate.acquire(LOOKUP) is None
+    assert gate.active == 3
+
+
+def test_waiter_times_out():
+    gate = Gate(slots=1, queue_size=1, max_wait=0.05)
+    gate.acquire(LOOKUP)
+    assert gate.acquire(LOOKUP) == "wait_timeout"
+    assert gate.stats()["waiting"] == 0
+    assert gate.active == 1
+
+
+def test_released_slot_goes_to_the_highest_class_waiting():
+    gate = Gate(slots=1, queue_size=3, max_wait=2)
+    gate.acquire(LOOKUP)
+    search = waiter(gate, SEARCH)
+    lookup = waiter(gate, LOOKUP)
+    login = waiter(gate, LOGIN)
+    wait_until_queued(gate, 3)
+
+    gate.release(LOOKUP)
+    login.join(1)
+    assert login.result is None
+    assert search.is_alive() and lookup.is_alive()
+
+    gate.release(LOGIN)
+    lookup.join(1)
+    assert lookup.result is None
+    gate.release(LOOKUP)
+    search.join(1)
+    assert search.result is None
+    gate.release(SEARCH)
+    assert gate.active == 0
+
+
+def test_full_queue_pushes_out_a_lower_class_waiter():
+    gate = Gate(slots=1, queue_size=1, max_wait=2)
+    gate.acquire(WRITE)
+    search = waiter(gate, SEARCH)
+    wait_until_queued(gate, 1)
+
+    # Same or lower class than everyone queued: turned away at once.
+    assert gate.acquire(SEARCH) == "queue_full"
+    login = waiter(gate, LOGIN)
+    search.join(1)
+    assert search.result == "queue_full"
+    wait_until_queued(gate, 1)
+
+    gate.release(WRITE)
+    login.join(1)
+    assert login.result is None
+    gate.release(LOGIN)
+    assert gate.active == 0 and gate.stats()["waiting"] == 0
+
+
+# ===========================================================
+# FLASK INTEGRATION
+# ===========================================================
+@pytest.fixture
+def gate(monkeypatch):
+    gate = Gate(slots=1, queue_size=0, max_wait=0)
+    monkeypatch.setattr(admission, "_gate", gate)
+    monkeypatch.setattr(admission, "ADMISSION_SLOTS", 1)
+    return gate
+
+
+@pytest.fixture
+def client(gate):
+    app = Flask(__name__)
+    admission.init_app(app)
+    seen = {}
+
+    @app.route("/page")
+    def page():
+        seen["active"] = gate.active
+        return "ok"
+
+    @app.route("/broken")
+    def broken():
+        raise RuntimeError("boom")
+
+    @app.route("/cancelled")
+    def cancelled():
+        raise psycopg2.errors.QueryCanceled("canceling statement due to statement timeout")
+
+    @app.route("/pool")
+    def pool():
+        raise db.PoolTimeout("no connection")
+
+    @app.route("/stream")
+    def stream():
+        def rows():
+            yield "first"
+            seen["active_while_streaming"] = gate.active
+            yield "second"
+        return Response(stream_with_context(rows()))
+
+    app.seen = seen
+    return app.test_client()
+
+
+def test_request_holds_a_slot_until_teardown(client, gate):
+    assert client.get("/page").data == b"ok"
+    assert client.application.seen["active"] == 1
+    assert gate.active == 0
+
+
+def test_slot_is_released_when_the_view_fails(client, gate):
+    client.application.config["PROPAGATE_EXCEPTIONS"] = False
+    with client.get("/broken") as response:
+        assert response.status_code == 500
+    assert gate.active == 0
+
+
+def test_slot_is_held_while_a_streamed_body_is_sent(client, gate):
+    response = client.get("/stream", buffered=False)
+    assert b"".join(response.response) == b"firstsecond"
+    response.close()
+    assert client.application.seen["active_while_streaming"] == 1
+    assert gate.active == 0
+
+
+def test_no_free_slot_means_503_with_retry_after(client, gate):
+    gate.acquire(LOGIN)
+    response = client.get("/page")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(admission.ADMISSION_RETRY_AFTER)
+    assert response.headers["Cache-Control"] == "no-store"
+    assert response.data == admission.UNAVAILABLE_PAGE
+    gate.release(LOGIN)
+    assert gate.active == 0
+
+
+@pytest.mark.parametrize("path", ["/cancelled", "/pool"])
+def test_database_overload_is_answered_with_503(client, gate, path):
+    response = client.get(path)
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+    assert gate.active == 0
+
+
+def test_route_classes():
+    assert admission.route_class("login_renter", "POST") is LOGIN
+    assert admission.route_class("book_property", "POST") is WRITE
+    assert admission.route_class("search", "GET") is SEARCH
+    assert admission.route_class("my_bookings", "GET") is LOOKUP
+    assert admission.route_class("static", "GET") is None
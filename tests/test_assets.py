@@ -0,0 +1,38 @@
+"""/assets serves the fingerprinted files under static/ and nothing else."""
+import hashlib
+
+import pytest
+
+import app
+import assets
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def test_serves_a_fingerprinted_asset(client):
+    response = client.get(assets.asset_url("css/app.css"))
+    assert response.status_code == 200
+    assert "immutable" in response.headers["Cache-Control"]
+
+
+def test_stale_fingerprint_is_not_found(client):
+    assert client.get("/assets/css/app.000000000000.css").status_code == 404
+
+
+@pytest.mark.parametrize("path", [
+    "/assets/../app.{digest}.py",
+    "/assets/%2e%2e/app.{digest}.py",
+    "/assets/css/../../app.{digest}.py",
+    "/assets/css/%2e%2e/%2e%2e/app.{digest}.py",
+    "/assets/css/..%2f..%2fapp.{digest}.py",
+])
+def test_names_outside_static_are_not_found(client, path):
+    # The right fingerprint of app.py, so only the name check can refuse it.
+    with open(app.__file__, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    response = client.get(path.format(digest=digest))
+    assert response.status_code == 404
+    assert b"import" not in response.data
@@ -0,0 +1,38 @@
+"""cache.TaggedCache tiers and db.change_feed_live()."""
+import os
+
+import cache
+import db
+
+
+def test_local_tier_is_bypassed_while_invalidations_are_not_broadcast():
+    live = [True]
+    search = cache.TaggedCache("test-live", live=lambda: live[0])
+    search.set("page", "rows", search.tag_versions(["city:*"]))
+    assert search.get("page") == "rows"
+
+    live[0] = False
+    assert search.get("page") is cache.MISS
+    search.set("other", "rows", search.tag_versions(["city:*"]))
+    live[0] = True
+    assert search.get("other") is cache.MISS
+    assert search.stats()["bypassed"] == 1
+
+
+def test_shared_tier_keeps_serving_without_the_feed(tmp_path):
+    search = cache.TaggedCache("test-shared", shared_path=str(tmp_path / "cache.db"),
+                               live=lambda: False)
+    search.set("page", "rows", search.tag_versions(["city:*"]))
+    assert search.get("page") == "rows"
+    search.invalidate(["city:*"])
+    assert search.get("page") is cache.MISS
+
+
+def test_change_feed_is_live_only_while_a_started_listener_listens(monkeypatch):
+    monkeypatch.setattr(db, "_listener_pid", None)
+    assert db.change_feed_live()
+    monkeypatch.setattr(db, "_listener_pid", os.getpid())
+    monkeypatch.setattr(db, "_listening", False)
+    assert not db.change_feed_live()
+    monkeypatch.setattr(db, "_listening", True)
+    assert db.change_feed_live()
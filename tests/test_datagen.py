@@ -0,0 +1,55 @@
+"""datagen.py and the werent.bulk_load switch (needs TEST_DATABASE_URL)."""
+import io
+
+import datagen
+import rewards
+import rollups
+from db import get_connection
+
+
+def ledger_rows(cur):
+    cur.execute("SELECT count(*) FROM REWARD_LEDGER;")
+    return cur.fetchone()[0]
+
+
+def test_only_the_loading_session_skips_the_triggers(database):
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            before = ledger_rows(cur)
+            cur.execute("SET werent.bulk_load = on;")
+            cur.execute("INSERT INTO REWARD (booking_id, booking_date, renter_id, points) "
+                        "VALUES (4, '2025-11-04', 5, 10);")
+            assert ledger_rows(cur) == before
+            cur.execute("RESET werent.bulk_load;")
+            cur.execute("INSERT INTO REWARD (booking_id, booking_date, renter_id, points) "
+                        "VALUES (4, '2025-11-04', 5, 10);")
+            assert ledger_rows(cur) == before + 1
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+def test_load_leaves_balances_and_rollups_reconciled(database):
+    out = io.StringIO()
+    datagen.run(datagen.parse_args([
+        "--agents", "3", "--renters", "20", "--properties", "10", "--bookings", "200",
+        "--years", "1", "--workers", "2",
+    ]), out=out)
+    assert "bookings:" in out.getvalue()
+    assert rewards.reconcile(out=out) == 0
+    assert rollups.check(out=out) == 0
+
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM BOOKING;")
+            assert cur.fetchone()[0] == 208
+            cur.execute("SELECT count(*) FROM BOOKING_STAY;")
+            assert cur.fetchone()[0] == 208
+            # Nothing was switched off for anyone else.
+            cur.execute("SELECT DISTINCT tgenabled FROM pg_trigger "
+                        "WHERE tgrelid IN ('booking'::regclass, 'reward'::regclass);")
+            assert cur.fetchall() == [("O",)]
+    finally:
+        conn.close()
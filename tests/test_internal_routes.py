@@ -0,0 +1,49 @@
+"""/metrics and /cache_stats are for agents and the scrape token only."""
+import pytest
+
+import app
+import metrics
+
+PATHS = ["/metrics", "/cache_stats"]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "s3cret")
+    return app.app.test_client()
+
+
+@pytest.mark.parametrize("path", PATHS)
+def test_hidden_from_the_public(client, path):
+    assert client.get(path).status_code == 404
+
+
+@pytest.mark.parametrize("path", PATHS)
+def test_hidden_from_renters(client, path):
+    with client.session_transaction() as session:
+        session.update(role="renter", renter_id=1)
+    assert client.get(path).status_code == 404
+
+
+@pytest.mark.parametrize("path", PATHS)
+def test_open_to_agents(client, path):
+    with client.session_transaction() as session:
+        session.update(role="agent", agent_id=1)
+    assert client.get(path).status_code == 200
+
+
+@pytest.mark.parametrize("path", PATHS)
+@pytest.mark.parametrize("header, status", [
+    ("Bearer s3cret", 200),
+    ("bearer s3cret", 200),
+    ("Bearer wrong", 404),
+    ("s3cret", 404),
+    ("Basic s3cret", 404),
+])
+def test_bearer_token(client, path, header, status):
+    assert client.get(path, headers={"Authorization": header}).status_code == status
+
+
+def test_no_token_configured_means_no_token_access(client, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "")
+    assert client.get("/metrics", headers={"Authorization": "Bearer "}).status_code == 404
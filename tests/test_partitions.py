@@ -0,0 +1,125 @@
+"""partitions.archive against a real database (needs TEST_DATABASE_URL).
+
+schema.sql's sample bookings and rewards are all dated November 2025,
+so archiving with a "today" 24 months later moves exactly that month.
+"""
+import datetime
+import io
+import json
+
+import pytest
+
+import partitions
+
+MONTH = datetime.date(2025, 11, 1)
+LATER = datetime.date(2027, 12, 15)
+
+
+@pytest.fixture
+def archive_dir(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(partitions, "ARCHIVE_DIR", str(tmp_path))
+    monkeypatch.setattr(partitions, "ARCHIVE_AFTER_MONTHS", 24)
+    return tmp_path
+
+
+def query(sql, params=()):
+    conn = partitions.get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            return cur.fetchall()
+    finally:
+        conn.close()
+
+
+def test_archive_moves_the_month_out(archive_dir):
+    out = io.StringIO()
+    assert partitions.archive(out=out, today=LATER) == 1, out.getvalue()
+
+    assert query("SELECT to_regclass('booking_p2025_11'), to_regclass('reward_p2025_11');") \
+        == [(None, None)]
+    assert query("SELECT count(*) FROM BOOKING;") == [(0,)]
+    assert query("SELECT count(*) FROM BOOKING_STAY;") == [(0,)]
+    assert query("SELECT points FROM REWARD_ARCHIVE_TOTAL WHERE renter_id = 4;") == [(7400,)]
+    assert query("SELECT sum(bookings) FROM CARD_ARCHIVE_USE;") == [(8,)]
+    assert query("SELECT sum(check_ins), sum(nights) FROM BOOKING_ARCHIVE_DAY;") == [(8, 8)]
+
+    manifest = json.loads((archive_dir / "manifest.json").read_text())
+    assert {(e["name"], e["rows"]) for e in manifest["partitions"]} == {
+        ("booking_p2025_11", 8), ("reward_p2025_11", 7)}
+    assert partitions.archived_through() == datetime.date(2025, 12, 1)
+    found = [(row["booking_id"], row["points"]) for row in partitions.archived_bookings(renter=4)]
+    assert found == [("7", "4200"), ("2", "3200")]
+
+    # Nothing left that is old enough.
+    assert partitions.archive(out=out, today=LATER) == 0
+
+
+def test_month_stays_when_the_detach_cannot_lock(archive_dir, monkeypatch):
+    monkeypatch.setattr(partitions, "ARCHIVE_LOCK_TIMEOUT", "50ms")
+    blocker = partitions.get_connection()
+    try:
+        with blocker.cursor() as cur:
+            cur.execute("LOCK TABLE BOOKING IN ACCESS SHARE MODE;")
+            out = io.StringIO()
+            assert partitions.archive(out=out, today=LATER) == 0
+        assert "2025-11: not archived" in out.getvalue()
+    finally:
+        blocker.close()
+    assert query("SELECT count(*) FROM BOOKING;") == [(8,)]
+    assert query("SELECT count(*) FROM REWARD;") == [(7,)]
+    assert partitions.read_manifest() == {"partitions": []}
+
+
+def stop_before_confirming(commit):
+    """Do what archive() does for MONTH, then stop before confirming it."""
+    conn = partitions.get_connection()
+    try:
+        entries = partitions.archive_month(conn, MONTH)
+        partitions._write_manifest({"partitions": entries})
+        if commit:
+            conn.commit()
+    finally:
+        conn.close()
+
+
+def test_pending_month_that_committed_is_confirmed(archive_dir):
+    stop_before_confirming(commit=True)
+    # Pending entries are not read until they are settled.
+    assert partitions.archived_through() is None
+    assert list(partitions.archived_bookings(renter=4)) == []
+
+    out = io.StringIO()
+    assert partitions.archive(out=out, today=LATER) == 0
+    assert "settled" in out.getvalue()
+    entries = partitions.read_manifest()["partitions"]
+    assert len(entries) == 2 and not any(e.get("pending") for e in entries)
+    assert partitions.archived_through() == datetime.date(2025, 12, 1)
+
+
+def test_pending_month_that_rolled_back_is_archived_again(archive_dir):
+    stop_before_confirming(commit=False)
+    assert query("SELECT count(*) FROM BOOKING;") == [(8,)]
+
+    assert partitions.archive(out=io.StringIO(), today=LATER) == 1
+    entries = partitions.read_manifest()["partitions"]
+    assert sorted(e["name"] for e in entries) == ["booking_p2025_11", "reward_p2025_11"]
+    assert not any(e.get("pending") for e in entries)
+    assert query("SELECT count(*) FROM BOOKING;") == [(0,)]
+
+
+def test_lookup_opens_only_the_months_its_index_matches(archive_dir, monkeypatch):
+    assert partitions.archive(out=io.StringIO(), today=LATER) == 1
+    opened = []
+    read_rows = partitions._read_rows
+    monkeypatch.setattr(partitions, "_read_rows",
+                        lambda entry: opened.append(entry["name"]) or read_rows(entry))
+
+    assert list(partitions.archived_bookings(renter=3)) == []
+    assert list(partitions.archived_bookings(props=[6, 9])) == []
+    assert list(partitions.archived_bookings(booking=9)) == []
+    assert opened == []
+
+    assert [row["booking_id"] for row in partitions.archived_bookings(props=[2, 6])] == ["3"]
+    assert [row["points"] for row in partitions.archived_bookings(booking=4)] == [None]
+    assert opened == ["booking_p2025_11", "reward_p2025_11"] * 2
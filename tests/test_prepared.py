@@ -0,0 +1,48 @@
+"""Prepared statements whose session lost them (needs TEST_DATABASE_URL)."""
+from decimal import Decimal
+
+import db
+
+PRICE = "SELECT price FROM PROPERTY WHERE prop_id = %s;"
+
+
+def forget_statements():
+    """What DISCARD ALL or a pooler's server reset does to the session."""
+    with db.pooled_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DEALLOCATE ALL;")
+        conn.commit()
+
+
+def prepares(sql):
+    db.run_query(db.prepare(sql), (1,), fetch=True)
+    return db.prepared_stats()["statements"][db._registry[sql].name]["prepares"]
+
+
+def test_statement_is_prepared_again_outside_a_unit_of_work(database):
+    sql = PRICE + " -- plain"
+    first = prepares(sql)
+    forget_statements()
+    assert prepares(sql) == first + 1
+    assert prepares(sql) == first + 1
+
+
+def test_statement_is_prepared_again_inside_a_transaction(database):
+    sql = PRICE + " -- unit of work"
+    first = prepares(sql)
+    forget_statements()
+
+    db.begin(statement_timeout=5000)
+    try:
+        # Something done earlier in the transaction must survive the retry.
+        db.run_query("UPDATE PROPERTY SET price = 1234.50 WHERE prop_id = 1;")
+        assert [tuple(r) for r in db.run_query(db.prepare(sql), (1,), fetch=True)] \
+            == [(Decimal("1234.50"),)]
+        db.commit()
+    finally:
+        db.end()
+    name = db._registry[sql].name
+    assert db.prepared_stats()["statements"][name]["prepares"] == first + 1
+    assert db.run_query("SELECT price FROM PROPERTY WHERE prop_id = 1;", fetch=True)[0][0] \
+        == Decimal("1234.50")
+
@@ -0,0 +1,47 @@
+"""profiler.py runs one profile at a time per process."""
+import pytest
+from flask import Flask, stream_with_context
+
+import profiler
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiler, "PROFILE_TOKEN", "s3cret")
+    monkeypatch.setattr(profiler, "PROFILE_DIR", str(tmp_path))
+    test_app = Flask(__name__)
+    test_app.add_url_rule("/page", "page", lambda: "page")
+    test_app.add_url_rule("/stream", "stream", lambda: test_app.response_class(
+        stream_with_context(iter(["a", "b"]))))
+    profiler.init_app(test_app)
+    return test_app.test_client()
+
+
+def test_profile_is_written_and_the_next_one_may_run(client, tmp_path):
+    response = client.get("/page", headers={"X-Profile": "s3cret"})
+    assert (tmp_path / response.headers["X-Profile-File"]).exists()
+    assert not profiler._running.locked()
+
+
+def test_request_is_served_unprofiled_while_another_profile_runs(client, tmp_path):
+    assert profiler._running.acquire(blocking=False)
+    try:
+        response = client.get("/page", headers={"X-Profile": "s3cret"})
+    finally:
+        profiler._running.release()
+    assert response.data == b"page"
+    assert "X-Profile-File" not in response.headers
+    assert response.headers["X-Profile-Skipped"] == "another profile is running"
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_streamed_profile_runs_until_the_body_is_sent(client):
+    response = client.get("/stream", headers={"X-Profile": "s3cret"}, buffered=False)
+    assert profiler._running.locked()
+    assert response.get_data() == b"ab"
+    response.close()
+    assert not profiler._running.locked()
+
+
+def test_unprofiled_requests_are_not_marked(client):
+    assert "X-Profile-Skipped" not in client.get("/page").headers
@@ -0,0 +1,52 @@
+"""The keyset cursor in /search page links (app.encode_cursor / decode_cursor)."""
+import base64
+import json
+import re
+from decimal import Decimal
+
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("sort_value, prop_id", [
+    (Decimal("1999.99"), 40),
+    (Decimal("99999999.99"), 1),        # NULL price
+    (2147483647, 7),                    # NULL rooms
+    ("", 3),                            # NULL city
+    ("São Paulo", 12),
+    ("O'Hare & <Sons>", 2**31 - 1),
+])
+def test_round_trip(sort_value, prop_id):
+    token = app.encode_cursor(sort_value, prop_id)
+    # Safe in a query string as is: no padding, no "+" or "/".
+    assert re.fullmatch(r"[A-Za-z0-9_-]+", token)
+    assert app.decode_cursor(token) == (str(sort_value), prop_id)
+
+
+def _token(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+
+@pytest.mark.parametrize("token", [
+    "",
+    "!!!",
+    "not-base64-json",
+    base64.urlsafe_b64encode(b"\xff\xfe").decode(),
+    _token(5),
+    _token(["1000"]),
+    _token(["1000", 4, 5]),
+    _token(["1000", "four"]),
+    _token({"value": "1000", "id": 4}),
+])
+def test_malformed_cursor_is_rejected(token):
+    with pytest.raises(ValueError):
+        app.decode_cursor(token)
+
+
+def test_search_answers_400_for_a_bad_cursor():
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session.update(role="renter", renter_id=1)
+    response = client.get("/search?after=!!!")
+    assert response.status_code == 400
@@ -0,0 +1,266 @@
+"""The two /search paths must agree.
+
+The listing snapshot (snapshot.Snapshot) answers plain filter searches
+with NumPy; everything else runs the statement queries.build_search_query
+builds. Both must pick the same rows in the same order, page the same way
+across cursors, and count the same facets. No database is needed: the
+statements are checked by evaluating their WHERE conditions, parameters
+and ORDER BY over the same small dataset the snapshot is built from.
+"""
+import bisect
+import random
+import re
+from collections import Counter
+from decimal import Decimal
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import queries  # noqa: E402
+import snapshot  # noqa: E402
+
+CATEGORIES = {"Apartment": 1, "Condo": 2, "House": 3}
+CITIES = ["Austin", "Boston", "Chicago", "Denver", "El Paso", "Fresno",
+          "Houston", "Irvine", "Jackson", "Knoxville", "Lincoln", "Miami"]
+PRICES = [None, "950.00", "1000.00", "1999.99", "2500.00", "5000.00"]
+
+
+def _listings():
+    """(prop_id, price, rooms, category, city) rows with NULLs and many ties."""
+    rng = random.Random(17)
+    rows = []
+    for prop_id in range(1, 121):
+        price = rng.choice(PRICES + [str(rng.randrange(500, 7000))])
+        rows.append((
+            prop_id,
+            None if price is None else Decimal(price),
+            rng.choice([None, 1, 2, 2, 3, 10]),
+            rng.choice(list(CATEGORIES)),
+            rng.choice(CITIES + [None]),
+        ))
+    return rows
+
+
+LISTINGS = _listings()
+# The columns the search statements refer to, per listing.
+ROWS = [{"p.prop_id": prop_id, "p.price": price, "pd.rooms": rooms,
+         "pc.category_name": category, "a.city": city}
+        for prop_id, price, rooms, category, city in LISTINGS]
+
+FILTER_CASES = [
+    {},
+    {"city": "boston"},
+    {"min_price": "1000", "max_price": "2500"},
+    {"min_price": "1999.99"},
+    {"category": "House", "rooms": "2"},
+    {"city": "miami", "category": "Condo"},
+    {"category": "Castle"},
+]
+
+
+def search_filters(**values):
+    filters = dict.fromkeys(queries.SEARCH_FILTERS, "")
+    filters.update(values)
+    return filters
+
+
+@pytest.fixture
+def snap(tmp_path, monkeypatch):
+    """A Snapshot of LISTINGS, built and published by snapshot.py itself."""
+    monkeypatch.setattr(snapshot, "SNAPSHOT_DIR", str(tmp_path))
+    # As SNAPSHOT_CITIES / SNAPSHOT_LISTINGS read them.
+    cities = sorted({city or "" for *_, city in LISTINGS})
+    rank = {city: i for i, city in enumerate(cities)}
+    rows = [(prop_id, price, rooms, CATEGORIES[category], rank[city or ""], 500, None, None, None)
+            for prop_id, price, rooms, category, city in LISTINGS]
+    columns = snapshot._chunk_columns(rows)
+    meta = {"built_at": 0, "rows": len(rows), "cities": cities, "categories": CATEGORIES}
+    generation = snapshot._publish(dict(columns, **snapshot._derived(columns)), meta, 0)
+    return snapshot.Snapshot(str(tmp_path / f"gen-{generation}"))
+
+
+# ===========================================================
+# THE STATEMENTS, EVALUATED IN PYTHON
+# ===========================================================
+def sort_key(expr):
+    """(column, NULL replacement) of a SEARCH_SORT_KEYS expression."""
+    column, default = re.fullmatch(r"COALESCE\(([\w.]+), (.+)\)", expr).groups()
+    if default.startswith("'"):
+        return column, default.strip("'")
+    return column, Decimal(default) if "." in default else int(default)
+
+
+def key_of(expr, row):
+    column, default = sort_key(expr)
+    return default if row[column] is None else row[column]
+
+
+def predicate(condition, take):
+    """A row test for one WHERE condition, consuming its parameters."""
+    if condition == "LOWER(a.city) = LOWER(%s)":
+        city = take()
+        return lambda r: r["a.city"] is not None and r["a.city"].lower() == city.lower()
+    if condition in ("p.price >= %s", "p.price <= %s"):
+        bound = Decimal(take())
+        if ">=" in condition:
+            return lambda r: r["p.price"] is not None and r["p.price"] >= bound
+        return lambda r: r["p.price"] is not None and r["p.price"] <= bound
+    if condition == "pc.category_name = %s":
+        category = take()
+        return lambda r: r["pc.category_name"] == category
+    if condition == "pd.rooms = %s":
+        rooms = int(take())
+        return lambda r: r["pd.rooms"] == rooms
+    seek = re.fullmatch(r"\((.+), p\.prop_id\) ([<>]) \(%s, %s\)", condition)
+    if seek:
+        expr, op = seek.groups()
+        # Postgres casts the text parameter to the sort key's type.
+        cursor = (type(sort_key(expr)[1])(take()), int(take()))
+        if op == ">":
+            return lambda r: (key_of(expr, r), r["p.prop_id"]) > cursor
+        return lambda r: (key_of(expr, r), r["p.prop_id"]) < cursor
+    raise AssertionError(f"unexpected search condition {condition!r}")
+
+
+def matching(where, take):
+    if where is None:
+        return list(ROWS)
+    tests = [predicate(c.strip(), take) for c in where.group(1).split(" AND ")]
+    return [r for r in ROWS if all(test(r) for test in tests)]
+
+
+def sql_page(filters, sort_by, after=None, before=None, limit=None):
+    """Prop ids of the page build_search_query's statement returns."""
+    sql, params = queries.build_search_query(filters, sort_by, after=after, before=before,
+                                             limit=limit)
+    params = list(params)
+    take = lambda: params.pop(0)  # noqa: E731
+    rows = matching(re.search(r"\bWHERE (.+?)\s+ORDER BY", sql, re.S), take)
+    expr, direction, tie = re.search(
+        r"ORDER BY (.+) (ASC|DESC), p\.prop_id (ASC|DESC)", sql).groups()
+    assert direction == tie
+    limit_value = take() if "LIMIT %s" in sql else None
+    assert not params, "unused parameters"
+    rows.sort(key=lambda r: (key_of(expr, r), r["p.prop_id"]), reverse=direction == "DESC")
+    return [r["p.prop_id"] for r in rows[:limit_value]]
+
+
+def sql_facets(filters):
+    """The [facet, value, count] triples of the facet_counts CTE."""
+    sql, params = queries._facet_counts(filters)
+    params = list(params)
+    rows = matching(re.search(r"\bWHERE (.+?)\s+GROUP BY", sql, re.S), lambda: params.pop(0))
+    assert not params, "unused parameters"
+    edges = [Decimal(e) for e in re.search(r"ARRAY\[([\d, ]+)\]", sql).group(1).split(", ")]
+    city_limit = int(re.search(r"rank <= (\d+)", sql).group(1))
+    counts = {facet: Counter() for facet in ("category", "city", "price", "rooms")}
+    for r in rows:
+        counts["category"][r["pc.category_name"]] += 1
+        if r["pd.rooms"] is not None:
+            counts["rooms"][str(r["pd.rooms"])] += 1
+        if r["p.price"] is not None:
+            counts["price"][str(bisect.bisect_right(edges, r["p.price"]))] += 1
+        if r["a.city"] is not None:
+            counts["city"][r["a.city"]] += 1
+    triples = []
+    for facet, counter in counts.items():
+        ranked = sorted(counter.items(), key=lambda item: (-item[1], item[0]))
+        if facet == "city":
+            ranked = ranked[:city_limit]
+        triples.extend([facet, value, n] for value, n in ranked)
+    triples.sort(key=lambda t: (t[0], -t[2], t[1]))
+    return triples
+
+
+def cursor_of(prop_id, sort_by):
+    """The (sort value, prop_id) cursor /search puts in its page links."""
+    row = next(r for r in ROWS if r["p.prop_id"] == prop_id)
+    return str(key_of(queries.SEARCH_SORT_KEYS[sort_by], row)), prop_id
+
+
+# ===========================================================
+# TESTS
+# ===========================================================
+@pytest.mark.parametrize("sort_by", snapshot.SORTS)
+@pytest.mark.parametrize("values", FILTER_CASES)
+def test_pages_match(snap, values, sort_by):
+    filters = search_filters(**values)
+    everything = sql_page(filters, sort_by)
+    assert snap.search(filters, sort_by)[0] == everything
+
+    # Forward with "after" cursors, one page of 7 at a time.
+    pages, after = [], None
+    while True:
+        sql_ids = sql_page(filters, sort_by, after=after, limit=7)
+        assert snap.search(filters, sort_by, after=after, limit=7)[0] == sql_ids
+        pages.append(sql_ids)
+        if len(sql_ids) < 7:
+            break
+        after = cursor_of(sql_ids[-1], sort_by)
+    assert sum(pages, []) == everything
+
+    # And back again with "before" cursors from the last page.
+    for page, newer in zip(reversed(pages[:-1]), reversed(pages[1:])):
+        if not newer:
+            continue
+        before = cursor_of(newer[0], sort_by)
+        sql_ids = sql_page(filters, sort_by, before=before, limit=7)
+        assert snap.search(filters, sort_by, before=before, limit=7)[0] == sql_ids
+        assert sql_ids == page[::-1]
+
+
+@pytest.mark.parametrize("values", FILTER_CASES)
+def test_facet_counts_match(snap, values):
+    filters = search_filters(**values)
+    expected = sql_facets(filters)
+    assert snap.facet_counts(snap._mask(filters)) == expected
+    assert snap.search(filters, "price", limit=7, facets=True)[1] == expected
+
+
+def test_combined_statement_keeps_both_parameter_lists():
+    filters = search_filters(city="boston", min_price="1000", rooms="2")
+    after = ("1999.99", 40)
+    _, facet_params = queries._facet_counts(filters)
+    _, page_params = queries.build_search_query(filters, "price", after=after, limit=8)
+    _, params = queries.build_search_query(filters, "price", after=after, limit=8, facets=True)
+    assert params == tuple(facet_params) + page_params
+
+
+@pytest.mark.parametrize("values, sort_by", [
+    ({"q": "garden"}, "price"),
+    ({"available_from": "2026-01-01", "available_to": "2026-01-05"}, "price"),
+    ({"q": "garden"}, "relevance"),
+    ({"min_price": "cheap"}, "price"),
+])
+def test_snapshot_defers_to_sql(snap, values, sort_by):
+    assert snap.search(search_filters(**values), sort_by) is None
+
+
+def test_listings_deleted_since_the_snapshot_do_not_cut_pages_short(snap, monkeypatch):
+    app = pytest.importorskip("app")
+    monkeypatch.setattr(app, "SEARCH_PAGE_SIZE", 7)
+    filters = search_filters()
+    everything = sql_page(filters, "price")
+    # The last row of page one and the extra row that says there is more,
+    # then the whole third page.
+    deleted = {everything[6], everything[7], *everything[14:22]}
+    expr = queries.SEARCH_SORT_KEYS["price"]
+    by_id = {r["p.prop_id"]: r for r in ROWS}
+
+    def run_query(sql, params, fetch):
+        return [(i, "", by_id[i]["a.city"], "", by_id[i]["p.price"], by_id[i]["pd.rooms"],
+                 by_id[i]["pc.category_name"], None, key_of(expr, by_id[i]))
+                for i in params[0] if i not in deleted]
+
+    monkeypatch.setattr(app, "run_query", run_query)
+    pages, after = [], None
+    while True:
+        rows, counts = app.snapshot_search(snap, filters, "price", after, None, True)
+        assert counts == sql_facets(filters)
+        pages.append([r[0] for r in rows[:7]])
+        if len(rows) <= 7:
+            break
+        after = cursor_of(rows[6][0], "price")
+    assert all(len(page) == 7 for page in pages[:-1])
+    assert sum(pages, []) == [i for i in everything if i not in deleted]
@@ -0,0 +1,308 @@
+"""Span-based request tracing exported as OTLP JSON.
+
+A sampled request becomes a root span with a child span for every SQL
+statement, pool checkout, template render, streamed page body and result
+cache lookup, so a slow request shows which step ate its latency budget.
+
+Sampling is decided once, at the start of the request (head sampling):
+TRACE_SAMPLE_RATE is the fraction of requests traced (default 0, tracing
+off). While tracing is on, an incoming W3C ``traceparent`` header is
+honoured: a request the caller sampled keeps its trace id and is always
+traced, one the caller did not sample is never traced. Sampled
+responses carry an ``X-Trace-Id`` header.
+
+Finished traces are exported by a background thread, one OTLP/JSON
+``ExportTraceServiceRequest`` per trace: POSTed to TRACE_EXPORT_URL when
+set (e.g. http://localhost:4318/v1/traces on a local collector), otherwise
+appended as one line to TRACE_FILE, which an OpenTelemetry collector's
+file receiver or any JSON tool can read.
+"""
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+from flask import before_render_template, request, template_rendered
+
+import cache
+import db
+
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0"))
+TRACE_FILE = os.environ.get("TRACE_FILE", "traces.jsonl")
+TRACE_EXPORT_URL = os.environ.get("TRACE_EXPORT_URL")
+SERVICE_NAME = os.environ.get("TRACE_SERVICE_NAME", "werent-homes")
+
+MAX_SPANS = 1000       # per trace; later spans are counted, not kept
+QUEUE_SIZE = 200
+
+# OTLP span kinds and status codes.
+KIND_INTERNAL, KIND_SERVER, KIND_CLIENT = 1, 2, 3
+STATUS_ERROR = 2
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+log = logging.getLogger(__name__)
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "kind", "start", "end", "attributes", "error")
+
+    def __init__(self, name, parent_id, kind=KIND_INTERNAL, start=None, attributes=None):
+        self.name = name
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start = start or time.time_ns()
+        self.end = None
+        self.attributes = attributes or {}
+        self.error = False
+
+    def to_otlp(self, trace_id):
+        span = {
+            "traceId": trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end or time.time_ns()),
+            "attributes": [_attribute(k, v) for k, v in self.attributes.items()],
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.error:
+            span["status"] = {"code": STATUS_ERROR}
+        return span
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class Trace:
+    """Spans of one sampled request; ``stack`` holds the open ones."""
+
+    def __init__(self, trace_id, root):
+        self.trace_id = trace_id
+        self.root = root
+        self.spans = [root]
+        self.stack = [root]
+        self.dropped = 0
+        self.streamed = False
+
+    def add(self, span):
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+        return span
+
+    def child(self, name, kind=KIND_INTERNAL, start=None, attributes=None):
+        return self.add(Span(name, self.stack[-1].span_id, kind, start, attributes))
+
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Time a block as a child of the current span (no-op when unsampled)."""
+    trace = _current.get()
+    if trace is None:
+        yield None
+        return
+    current = trace.child(name, attributes=attributes)
+    trace.stack.append(current)
+    try:
+        yield current
+    except Exception:
+        current.error = True
+        raise
+    finally:
+        current.end = time.time_ns()
+        trace.stack.remove(current)
+
+
+def _completed(name, seconds, kind=KIND_INTERNAL, **attributes):
+    # Hooks fire after the fact, so the span is reconstructed from its duration.
+    trace = _current.get()
+    if trace is not None:
+        end = time.time_ns()
+        trace.child(name, kind, end - int(seconds * 1e9), attributes).end = end
+
+
+# ===========================================================
+# INSTRUMENTATION
+# ===========================================================
+def _on_query(sql, params, seconds, rows):
+    statement = " ".join(sql.split())
+    _completed(statement.split(" ", 1)[0].upper(), seconds, KIND_CLIENT,
+               **{"db.system": "postgresql", "db.statement": statement, "db.rows": rows})
+
+
+def _on_checkout(seconds):
+    _completed("pool checkout", seconds)
+
+
+def _on_cache_lookup(name, result, seconds):
+    _completed(f"cache {name}", seconds, **{"cache.result": result})
+
+
+def _before_render(app, template, context, **extra):
+    trace = _current.get()
+    if trace is not None:
+        trace.stack.append(trace.child(f"render {template.name}"))
+
+
+def _rendered(app, template, context, **extra):
+    trace = _current.get()
+    if trace is not None and len(trace.stack) > 1:
+        trace.stack.pop().end = time.time_ns()
+
+
+def _sampled():
+    """(trace id, parent span id) for a traced request, or None."""
+    match = TRACEPARENT.match(request.headers.get("traceparent", ""))
+    if match:
+        trace_id, parent_id, flags = match.groups()
+        return (trace_id, parent_id) if int(flags, 16) & 1 else None
+    if random.random() < TRACE_SAMPLE_RATE:
+        return "%032x" % random.getrandbits(128), None
+    return None
+
+
+def start_trace():
+    sampled = _sampled()
+    if sampled is None:
+        _current.set(None)
+        return
+    trace_id, parent_id = sampled
+    root = Span(f"{request.method} {request.url_rule or request.path}", parent_id, KIND_SERVER,
+                attributes={"http.method": request.method, "http.target": request.path,
+                            "flask.endpoint": request.endpoint or ""})
+    _current.set(Trace(trace_id, root))
+
+
+def _finish_after_stream(body, trace):
+    _current.set(trace)
+    trace.stack.append(trace.child("stream body"))
+    try:
+        yield from body
+    finally:
+        trace.stack.pop().end = time.time_ns()
+        _current.set(None)
+        _finish(trace)
+
+
+def record_response(response):
+    trace = _current.get()
+    if trace is None:
+        return response
+    trace.root.attributes["http.status_code"] = response.status_code
+    trace.root.error = response.status_code >= 500
+    response.headers["X-Trace-Id"] = trace.trace_id
+    if response.is_streamed:
+        # The request is torn down before a streamed body is sent.
+        trace.streamed = True
+        response.response = _finish_after_stream(response.response, trace)
+    return response
+
+
+def end_trace(exc):
+    trace = _current.get()
+    if trace is None:
+        return
+    _current.set(None)
+    if exc is not None:
+        trace.root.error = True
+    if not trace.streamed:
+        _finish(trace)
+
+
+def _finish(trace):
+    now = time.time_ns()
+    for open_span in trace.stack:
+        open_span.end = open_span.end or now
+    if trace.dropped:
+        trace.root.attributes["trace.dropped_spans"] = trace.dropped
+    _ensure_exporter()
+    try:
+        _queue.put_nowait(trace)
+    except queue.Full:
+        pass  # tracing must never slow the request down
+
+
+# ===========================================================
+# EXPORT
+# ===========================================================
+_queue = queue.Queue(QUEUE_SIZE)
+_exporter_pid = None
+_start_lock = threading.Lock()
+
+
+def to_otlp(trace):
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [_attribute("service.name", SERVICE_NAME),
+                                        _attribute("process.pid", os.getpid())]},
+            "scopeSpans": [{
+                "scope": {"name": "werent.tracing"},
+                "spans": [s.to_otlp(trace.trace_id) for s in trace.spans],
+            }],
+        }]
+    }
+
+
+def export(trace):
+    payload = json.dumps(to_otlp(trace))
+    if TRACE_EXPORT_URL:
+        req = urllib.request.Request(
+            TRACE_EXPORT_URL, payload.encode(), {"Content-Type": "application/json"})
+        urllib.request.urlopen(req, timeout=2).close()
+    else:
+        with open(TRACE_FILE, "a") as f:
+            f.write(payload + "\n")
+
+
+def _run():
+    while True:
+        trace = _queue.get()
+        try:
+            export(trace)
+        except Exception:
+            log.exception("trace export failed")
+
+
+def _ensure_exporter():
+    global _exporter_pid
+    if _exporter_pid == os.getpid():
+        return
+    with _start_lock:
+        if _exporter_pid != os.getpid():
+            _exporter_pid = os.getpid()
+            threading.Thread(target=_run, name="trace-exporter", daemon=True).start()
+
+
+def init_app(app):
+    if TRACE_SAMPLE_RATE <= 0:
+        return
+    db.add_hook("query", _on_query)
+    db.add_hook("checkout", _on_checkout)
+    cache.add_hook(_on_cache_lookup)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+    app.before_request(start_trace)
+    app.after_request(record_response)
+    app.teardown_request(end_trace)